@@ -1,12 +1,137 @@
 import os
-from sqlalchemy import create_engine
+import threading
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import NullPool
 
 DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///test.db")
+# Connection pool of both engines for databases other than SQLite
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", "30"))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"
+# "performance" opens SQLite databases in WAL mode with the pragmas below and serializes writes (see
+# enable_sqlite_performance_mode), "default" keeps the SQLite defaults
+SQLITE_MODE = os.environ.get("SQLITE_MODE", "default")
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+# Negative sizes are in KiB, as for the cache_size pragma
+SQLITE_CACHE_SIZE = int(os.environ.get("SQLITE_CACHE_SIZE", "-65536"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "30000"))
+# Driver of the async engine for every database of DATABASE_URL
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+
+def _is_sqlite(database_url: str):
+    return database_url.startswith("sqlite")
+
+def _async_database_url(database_url: str):
+    """
+    To get the url of the async engine by swapping the driver of the database url,
+    e.g. postgresql+psycopg2://... becomes postgresql+asyncpg://...
+    """
+    scheme, address = database_url.split("://", 1)
+    return f"{ASYNC_DRIVERS.get(scheme.split('+')[0], scheme)}://{address}"
+
+def _pool_options(database_url: str):
+    """
+    To get the connection pool options of an engine. SQLite connections are cheap and local, they are not sized
+    """
+    if _is_sqlite(database_url):
+        return {}
+    return {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "pool_timeout": DB_POOL_TIMEOUT,
+            "pool_pre_ping": DB_POOL_PRE_PING}
+
+_sqlite_writer_lock = threading.Lock()
+_WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+
+def enable_sqlite_performance_mode(sync_engine, serialize_writes: bool = True):
+    """
+    To tune every new connection of a SQLite engine for concurrent use:
+        1. WAL journaling so readers never wait on the writer and the writer never waits on readers, with
+        synchronous=NORMAL (durable at every checkpoint instead of every commit), memory mapped reads and a larger
+        page cache
+        2. The BEGIN pysqlite emits before the first write statement of a transaction is a BEGIN IMMEDIATE, which
+        waits for the database write lock (busy_timeout) instead of failing with "database is locked". pysqlite
+        emits no BEGIN before reads, so the reads before the first write are not under the lock: a transaction
+        that must read under it writes first (see utils.begin_write). Read-only transactions never take the lock
+        3. With serialize_writes, every write transaction of the engine also holds one process-wide writer lock from
+        its first write statement until it ends, so writers of the threadpool queue up in the process instead of
+        polling the database lock. Engines driven from the event loop (aiosqlite) must not block it and rely on 2.
+    """
+    @event.listens_for(sync_engine, "connect")
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.close()
+        dbapi_connection.isolation_level = "IMMEDIATE"
+
+    if not serialize_writes:
+        return
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def acquire_writer(conn, cursor, statement, parameters, context, executemany):
+        if not conn.info.get("sqlite_writer") and statement.lstrip()[:7].upper().startswith(_WRITE_STATEMENTS):
+            _sqlite_writer_lock.acquire()
+            conn.info["sqlite_writer"] = True
+
+    def release_writer(connection_info):
+        if connection_info.pop("sqlite_writer", False):
+            _sqlite_writer_lock.release()
+
+    event.listen(sync_engine, "commit", lambda conn: release_writer(conn.info))
+    event.listen(sync_engine, "rollback", lambda conn: release_writer(conn.info))
+    event.listen(sync_engine, "reset", lambda dbapi_connection, connection_record, reset_state:
+                 release_writer(connection_record.info))
+
+
+engine = create_engine(DATABASE_URL, **_pool_options(DATABASE_URL),
+                       connect_args={"check_same_thread": False} if _is_sqlite(DATABASE_URL) else {})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+if _is_sqlite(DATABASE_URL) and SQLITE_MODE == "performance":
+    enable_sqlite_performance_mode(engine)
+
+# Async engine of the async route handlers, which wait on the database without holding a thread of the request
+# threadpool. It is created on first use (see get_async_engine), so the application, its scripts and its tests import
+# without the async driver of the database
+_async_engine = None
+_async_sessionmaker = None
+_async_engine_lock = threading.Lock()
+
+def get_async_engine():
+    """
+    To get the async engine, created on first use. SQLite connections are opened per session so they never outlive
+    the event loop that opened them
+    """
+    global _async_engine, _async_sessionmaker
+    with _async_engine_lock:
+        if _async_engine is None:
+            async_database_url = _async_database_url(DATABASE_URL)
+            try:
+                async_engine = create_async_engine(async_database_url, **_pool_options(DATABASE_URL),
+                                                   **({"poolclass": NullPool} if _is_sqlite(DATABASE_URL) else {}))
+            except ImportError as error:
+                raise RuntimeError(f"The async engine of {async_database_url.split('://', 1)[0]} could not be "
+                                   f"created, its driver is not installed ({error}). Install the requirements of "
+                                   f"the application") from error
+            if _is_sqlite(DATABASE_URL) and SQLITE_MODE == "performance":
+                enable_sqlite_performance_mode(async_engine.sync_engine, serialize_writes=False)
+            _async_sessionmaker = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+            _async_engine = async_engine
+    return _async_engine
+
+def async_session():
+    """
+    To open a session of the async engine, creating the engine on first use
+    """
+    get_async_engine()
+    return _async_sessionmaker()
+
 Base = declarative_base()
 
 def get_db():
@@ -15,3 +140,7 @@ def get_db():
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with async_session() as db:
+        yield db
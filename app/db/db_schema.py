@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, Integer, String, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from app.db.base import Base
 
@@ -38,6 +38,8 @@ class Cluster(Base):
     available_cpu = Column(Integer)
     available_ram = Column(Integer)
     available_gpu = Column(Integer)
+    # Incremented by every capacity change written through the ledger (see resource_management.CapacityLedger)
+    version = Column(Integer, nullable=False, default=0, server_default="0")
 
 # Deployment Model
 class Deployment(Base):
@@ -52,5 +54,11 @@ class Deployment(Base):
     priority = Column(Integer, unique=True)
     cluster_id = Column(Integer, ForeignKey("clusters.id"))
     status = Column(String)
+    # Lead (highest priority) member of the group the deployment is gang scheduled with, itself included, if any
+    # (see app.services.groups)
+    group_id = Column(Integer, ForeignKey("deployments.id"), nullable=True, index=True)
 
     cluster = relationship("Cluster")
+
+    # Serves the deployment list filters: a cluster, a status and a priority range walked in priority order
+    __table_args__ = (Index("ix_deployments_cluster_status_priority", "cluster_id", "status", "priority"),)
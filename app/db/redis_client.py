@@ -0,0 +1,115 @@
+import os
+import threading
+
+import redis
+import redis.asyncio
+
+REDIS_HOST = os.environ.get('REDIS_HOST', 'localhost')
+REDIS_PORT = int(os.environ.get('REDIS_PORT', '6379'))
+REDIS_DATABASE_INDEX = int(os.environ.get('REDIS_DATABASE_INDEX', '0'))
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', '50'))
+# Seconds to wait for a free connection once all REDIS_MAX_CONNECTIONS are checked out
+REDIS_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', '5'))
+REDIS_SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT', '5'))
+REDIS_CONNECT_TIMEOUT = float(os.environ.get('REDIS_CONNECT_TIMEOUT', '2'))
+
+
+class InstrumentedConnectionPool(redis.BlockingConnectionPool):
+    """
+    Blocking connection pool keeping count of its checkouts, and of the ones that had to wait for a connection or
+    timed out because the pool was saturated
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._metrics_lock = threading.Lock()
+        self.in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+
+    def get_connection(self, command_name, *keys, **options):
+        with self._metrics_lock:
+            self.checkouts += 1
+            if self.pool.empty():
+                self.waits += 1
+        try:
+            connection = super().get_connection(command_name, *keys, **options)
+        except redis.exceptions.ConnectionError as error:
+            if str(error) == "No connection available.":
+                with self._metrics_lock:
+                    self.timeouts += 1
+            raise
+        with self._metrics_lock:
+            self.in_use += 1
+        return connection
+
+    def release(self, connection):
+        with self._metrics_lock:
+            self.in_use -= 1
+        super().release(connection)
+
+
+_pool = None
+
+def init_redis_pool():
+    """
+    Create the application wide redis connection pool, if not created yet, and return it
+    """
+    global _pool
+    if _pool is None:
+        _pool = InstrumentedConnectionPool(
+            host=REDIS_HOST,
+            port=REDIS_PORT,
+            db=REDIS_DATABASE_INDEX,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            timeout=REDIS_POOL_TIMEOUT,
+            socket_timeout=REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+        )
+    return _pool
+
+def close_redis_pool():
+    """
+    Disconnect every connection of the application wide redis connection pool
+    """
+    global _pool
+    if _pool is not None:
+        _pool.disconnect()
+        _pool = None
+
+def get_redis_client():
+    """
+    To get a redis client backed by the application wide connection pool. Clients are cheap, connections are only
+    taken from the pool for the duration of a command or pipeline. Responses are not decoded since the scheduler
+    stores binary deployment records
+    """
+    return redis.StrictRedis(connection_pool=init_redis_pool())
+
+def get_async_redis_client():
+    """
+    To get an asyncio redis client with a connection of its own, for the long blocking reads of the event streams,
+    which must neither block the event loop nor hold a connection of the application wide pool
+    """
+    return redis.asyncio.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DATABASE_INDEX,
+                               socket_connect_timeout=REDIS_CONNECT_TIMEOUT)
+
+def redis_pool_metrics():
+    """
+    To get the usage and saturation of the application wide redis connection pool
+    """
+    pool = _pool
+    if pool is None:
+        return {"max_connections": REDIS_MAX_CONNECTIONS, "created": 0, "in_use": 0, "idle": 0, "saturation": 0.0,
+                "checkouts": 0, "waits": 0, "timeouts": 0}
+    created = len(pool._connections)
+    return {
+        "max_connections": pool.max_connections,
+        "created": created,
+        "in_use": pool.in_use,
+        "idle": created - pool.in_use,
+        "saturation": pool.in_use / pool.max_connections,
+        "checkouts": pool.checkouts,
+        "waits": pool.waits,
+        "timeouts": pool.timeouts,
+    }
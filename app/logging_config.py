@@ -0,0 +1,43 @@
+import json
+import logging
+import os
+
+# Level of the application logs, DEBUG logs every resource allocation and status change of the scheduler
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+# "text" for human readable lines, "json" for one json object per line with the extra fields of every record
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+
+# Attributes every log record has, the others were given as extra fields
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a log record as a json object holding its time, level, logger, message and extra fields
+    """
+
+    def format(self, record: logging.LogRecord):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging():
+    """
+    To send the logs of the application to stderr with the level and format of the environment
+    """
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger = logging.getLogger("app")
+    logger.handlers = [handler]
+    logger.setLevel(LOG_LEVEL)
@@ -1,23 +1,88 @@
+import asyncio
+import contextlib
+import logging
+
+import redis
 from fastapi import FastAPI
-from app.routes import user, cluster, deployment, organization
+from app.routes import user, cluster, deployment, organization, metrics
 from app.db.base import engine, Base
+from sqlalchemy import inspect, text
+from app.db.db_schema import Deployment
+from app.db.redis_client import init_redis_pool, close_redis_pool
+from app.services.scheduler import migrate_global_queues
+from app.services.memory_scheduler import flush_journal
+from app.services import reconcile, scheduler, preemption
+from app.logging_config import configure_logging
 
-app = FastAPI()
-
-app.include_router(user.router, prefix="/users", tags=["users"])
-app.include_router(organization.router, prefix="/organizations", tags=["organizations"])
-app.include_router(cluster.router, prefix="/clusters", tags=["clusters"])
-app.include_router(deployment.router, prefix="/deployments", tags=["deployments"])
+configure_logging()
+logger = logging.getLogger(__name__)
 
 
 def on_startup():
     """
-    Create all tables in the database (if they don't already exist)
+    Create all tables in the database (if they don't already exist), open the redis connection pool and migrate
+    legacy scheduler queues
     """
     Base.metadata.create_all(bind=engine)
-    print("Database tables initialized successfully.")
+    # create_all skips the tables that exist, columns and indexes added to them later are created here
+    if "version" not in {column["name"] for column in inspect(engine).get_columns("clusters")}:
+        with engine.begin() as connection:
+            connection.execute(text("ALTER TABLE clusters ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+    if "group_id" not in {column["name"] for column in inspect(engine).get_columns("deployments")}:
+        with engine.begin() as connection:
+            connection.execute(text("ALTER TABLE deployments ADD COLUMN group_id INTEGER REFERENCES deployments(id)"))
+    for index in Deployment.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+    logger.info("Database tables initialized successfully.")
+    init_redis_pool()
+    if scheduler.SCHEDULER_ENGINE == "lua" and preemption.PREEMPTION_POLICY != "greedy":
+        logger.warning("The lua scheduler engine always preempts greedily, PREEMPTION_POLICY=%s is ignored.",
+                       preemption.PREEMPTION_POLICY)
+    try:
+        migrated = migrate_global_queues()
+        if migrated:
+            logger.info("Migrated %d deployments from the legacy scheduler queues.", migrated)
+    except redis.exceptions.ConnectionError:
+        logger.warning("Redis is not reachable, skipped the scheduler queue migration.")
+
+
+def on_shutdown():
+    """
+    Write the pending scheduler journal and close the redis connections of the application
+    """
+    flush_journal()
+    close_redis_pool()
 
-app.add_event_handler("startup", on_startup)
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    To start the application, with the reconcile worker scheduling the queued intents in the "tick" scheduling mode,
+    and to stop it once the intents left are scheduled, handing the reconciler lease over to the other workers
+    """
+    on_startup()
+    worker = asyncio.create_task(reconcile.reconcile_worker()) if reconcile.SCHEDULING_MODE == "tick" else None
+    yield
+    if worker is not None:
+        worker.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await worker
+        try:
+            while await asyncio.to_thread(reconcile.reconcile_once):
+                pass
+            reconcile.resign()
+        except redis.exceptions.ConnectionError:
+            logger.warning("Redis is not reachable, the queued scheduling intents are left for the next start.")
+    on_shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+
+app.include_router(user.router, prefix="/users", tags=["users"])
+app.include_router(organization.router, prefix="/organizations", tags=["organizations"])
+app.include_router(cluster.router, prefix="/clusters", tags=["clusters"])
+app.include_router(deployment.router, prefix="/deployments", tags=["deployments"])
+app.include_router(metrics.router, prefix="/metrics", tags=["metrics"])
 
 
 # Root route
@@ -1,20 +1,23 @@
-from app.services.auth import validate_user_access, get_token
-from fastapi import APIRouter, HTTPException, Depends, Query
-from sqlalchemy.orm import Session
-from app.schemas.cluster import ClusterCreate, ClusterResponse
+from app.services.auth import validate_user_access_async, get_token
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.schemas.cluster import ClusterCreate, ClusterResponse, ClusterPage
 from app.db import db_schema
-from app.db.base import get_db
-from sqlalchemy import or_
+from app.db.base import get_async_db
+from app.utils import select_fields, fetch_page, export_ndjson
+from app.services.placement import update_cluster
+from sqlalchemy import or_, select
 
 
 router = APIRouter()
 
 @router.post("/create/", response_model=ClusterResponse)
-def create_cluster(cluster: ClusterCreate, token: str = Depends(get_token), db: Session = Depends(get_db)):
+async def create_cluster(cluster: ClusterCreate, token: str = Depends(get_token),
+                         db: AsyncSession = Depends(get_async_db)):
     """
     API to create a new cluster
     """
-    validate_user_access(token, db)
+    await validate_user_access_async(token, db)
     new_cluster = db_schema.Cluster(
         name=cluster.name,
         total_ram=cluster.total_ram,
@@ -25,28 +28,52 @@ def create_cluster(cluster: ClusterCreate, token: str = Depends(get_token), db:
         available_gpu=cluster.total_gpu
     )
     db.add(new_cluster)
-    db.commit()
-    db.refresh(new_cluster)
+    await db.commit()
+    await db.refresh(new_cluster)
+    update_cluster(new_cluster.id, (new_cluster.available_cpu, new_cluster.available_ram, new_cluster.available_gpu))
     return new_cluster
 
 @router.get("/get_cluster/", response_model=ClusterResponse)
-def get_cluster(token: str = Depends(get_token), cluster_id: int = Query(None, alias="id"),
-                cluster_name: str = Query(None), db: Session = Depends(get_db)):
+async def get_cluster(token: str = Depends(get_token), cluster_id: int = Query(None, alias="id"),
+                      cluster_name: str = Query(None), db: AsyncSession = Depends(get_async_db)):
     """
     API to get cluster details based on either name or id of the cluster
     """
     if not cluster_id and not cluster_name:
         raise HTTPException(status_code=400, detail="Either 'cluster_id' or 'cluster_name' must be provided")
-    validate_user_access(token, db)
-    cluster = db.query(db_schema.Cluster).filter(
+    await validate_user_access_async(token, db)
+    cluster = (await db.execute(select(db_schema.Cluster).where(
         or_(
             db_schema.Cluster.id == cluster_id,
             db_schema.Cluster.name == cluster_name
         )
-    ).first()
+    ))).scalars().first()
     if not cluster:
         raise HTTPException(status_code=404, detail="Cluster not found")
     if cluster_id and cluster_name and (cluster.id != cluster_id or cluster.name != cluster_name):
         raise HTTPException(status_code=400, detail="Given Cluster id and Cluster name do not correspond "
                                                     "to the same cluster")
     return cluster
+
+@router.get("/list/", response_model=ClusterPage)
+async def list_clusters(token: str = Depends(get_token), fields: str = Query(None),
+                        limit: int = Query(100, ge=1, le=1000), cursor: str = Query(None),
+                        db: AsyncSession = Depends(get_async_db)):
+    """
+    API to list clusters by id, one page at a time. fields selects a comma separated subset of the cluster fields
+    and the next_cursor of a page fetches the following one
+    """
+    await validate_user_access_async(token, db)
+    columns = select_fields(fields, db_schema.Cluster, ClusterResponse)
+    items, next_cursor = await fetch_page(db, columns, db_schema.Cluster.id, [], cursor, limit)
+    return {"items": items, "next_cursor": next_cursor}
+
+@router.get("/export/")
+async def export_clusters(request: Request, token: str = Depends(get_token), fields: str = Query(None),
+                          db: AsyncSession = Depends(get_async_db)):
+    """
+    API to stream every cluster as newline delimited json, one cluster per line in id order
+    """
+    await validate_user_access_async(token, db)
+    columns = select_fields(fields, db_schema.Cluster, ClusterResponse)
+    return export_ndjson(request, select(*columns).order_by(db_schema.Cluster.id))
@@ -1,24 +1,39 @@
-from fastapi import APIRouter, HTTPException, Depends, Query
+from typing import List
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, Header, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError
-from app.schemas.deployment import DeploymentCreate, DeploymentResponse
-from app.utils import validate_deployment_details, update_status_in_db
-from app.services.auth import validate_user_access, get_token
-from app.services.scheduler import new_deploy, complete_deploy
-from app.db.base import get_db
+from app.schemas.deployment import (DeploymentCreate, DeploymentResponse, DeploymentBatchCreate, DeploymentBatchResponse,
+                                    DeploymentPage, DeploymentGroupCreate, DeploymentGroupResponse)
+from app.utils import (validate_deployment_details, validate_deployment_resources, select_fields,
+                       fetch_page, export_ndjson, begin_write, lock_clusters)
+from app.services.auth import validate_user_access, validate_user_access_async, get_token
+from app.services.scheduler import new_deploy, new_deploy_batch
+from app.services.resource_management import CapacityLedger
+from app.services.placement import place_deployment
+from app.services.events import publish_status_changes, is_valid_cursor, stream_events
+from app.services.groups import queued_group, expand_group_changes, complete_deployment
+from app.services import reconcile
+from app.db.base import get_db, get_async_db
 from app.db import db_schema
-from sqlalchemy import or_
+from sqlalchemy import or_, select
 
 
 router = APIRouter()
 
 @router.post("/create/", response_model=DeploymentResponse)
-def create_deployment(deployment: DeploymentCreate, token:str = Depends(get_token), db: Session = Depends(get_db)):
+def create_deployment(deployment: DeploymentCreate, http_response: Response, token:str = Depends(get_token),
+                      db: Session = Depends(get_db)):
     """
-    API to create a new deployment within the given cluster
+    API to create a new deployment within the given cluster, or within the best fitting cluster when none is given.
+    With SCHEDULING_MODE set to "tick" the deployment is recorded as pending and scheduled by the next tick of the
+    reconcile worker, the API answering 202 right away
     """
     validate_user_access(token, db)
-    cluster = validate_deployment_details(deployment, db)
+    # Queued for the next tick, the cluster is only read: the reconcile worker locks it to schedule
+    cluster = validate_deployment_details(deployment, db, lock=reconcile.SCHEDULING_MODE != "tick")
+    ledger = CapacityLedger([cluster])
     new_deployment = db_schema.Deployment(
         name=deployment.name,
         image_path=deployment.image_path,
@@ -33,59 +48,252 @@ def create_deployment(deployment: DeploymentCreate, token:str = Depends(get_toke
         raise HTTPException(status_code=400, detail="Failed to create deployment")
     try:
         db.add(new_deployment)
-        db.commit()
+        db.flush()
     except IntegrityError:
         db.rollback()
         raise HTTPException(status_code=409, detail="Priority should be unique")
-    db.refresh(new_deployment)
-    status_change = new_deploy(new_deployment, cluster)
-    update_status_in_db(status_change, db)
+    if reconcile.SCHEDULING_MODE == "tick":
+        response = DeploymentResponse.model_validate(new_deployment, from_attributes=True)
+        db.commit()
+        reconcile.enqueue_intent("new", response.id)
+        publish_status_changes(response.cluster_id, {response.id: (None, response.status)})
+        http_response.status_code = 202
+        return response
+    status_change = expand_group_changes(new_deploy(new_deployment, cluster), db)
+    ledger.apply(db, status_change)
+    # Built before the commit expires the deployment, which would take one more query to reload
+    response = DeploymentResponse.model_validate(new_deployment, from_attributes=True)
+    db.commit()
+    publish_status_changes(response.cluster_id, {response.id: (None, response.status), **status_change})
+    return response
+
+@router.post("/create_batch/", response_model=DeploymentBatchResponse)
+def create_deployments(batch: DeploymentBatchCreate, token: str = Depends(get_token), db: Session = Depends(get_db)):
+    """
+    API to create many deployments at once. The user is validated once, every deployment is validated on its own and
+    reported with its id and status or its error, the valid ones are inserted in one transaction and placed by one
+    scheduling pass per cluster, highest priority first
+    """
+    validate_user_access(token, db)
+    requested = batch.deployments
+    placement_errors = {}
+    for index, deployment in enumerate(requested):
+        if deployment.cluster_id is None:
+            try:
+                deployment.cluster_id = place_deployment(deployment, db)
+            except HTTPException as error:
+                placement_errors[index] = error
+    clusters = {cluster.id: cluster for cluster in lock_clusters({deployment.cluster_id for deployment in requested},
+                                                                   db)}
+    ledger = CapacityLedger(clusters.values())
+    taken_names = {name for (name,) in db.query(db_schema.Deployment.name).filter(
+        db_schema.Deployment.name.in_({deployment.name for deployment in requested}))}
+    taken_priorities = {priority for (priority,) in db.query(db_schema.Deployment.priority).filter(
+        db_schema.Deployment.priority.in_({deployment.priority for deployment in requested}))}
+
+    results, new_deployments = [], []
+    for index, deployment in enumerate(requested):
+        result = {"index": index, "name": deployment.name}
+        results.append(result)
+        cluster = clusters.get(deployment.cluster_id)
+        try:
+            if index in placement_errors:
+                raise placement_errors[index]
+            if not cluster:
+                raise HTTPException(status_code=404, detail="Cluster ID not found")
+            validate_deployment_resources(deployment, cluster)
+            if deployment.name in taken_names:
+                raise HTTPException(status_code=409, detail="Name should be unique")
+            if deployment.priority in taken_priorities:
+                raise HTTPException(status_code=409, detail="Priority should be unique")
+        except HTTPException as error:
+            result["error"] = error.detail
+            continue
+        taken_names.add(deployment.name)
+        taken_priorities.add(deployment.priority)
+        new_deployments.append((result, db_schema.Deployment(**deployment.model_dump(), status="Pending")))
+
+    try:
+        db.add_all([new_deployment for _, new_deployment in new_deployments])
+        db.flush()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Name and priority should be unique")
+
+    status_change, events = {}, {}
+    for cluster_id, cluster in clusters.items():
+        cluster_deployments = [new_deployment for _, new_deployment in new_deployments
+                               if new_deployment.cluster_id == cluster_id]
+        if not cluster_deployments:
+            continue
+        cluster_status_change = expand_group_changes(new_deploy_batch(cluster_deployments, cluster), db)
+        for new_deployment in cluster_deployments:
+            if new_deployment.id in cluster_status_change:
+                new_deployment.status = cluster_status_change[new_deployment.id][1]
+        status_change.update(cluster_status_change)
+        events[cluster_id] = {**cluster_status_change, **{new_deployment.id: (None, new_deployment.status)
+                                                          for new_deployment in cluster_deployments}}
+    ledger.apply(db, status_change)
+
+    for result, new_deployment in new_deployments:
+        result.update(id=new_deployment.id, cluster_id=new_deployment.cluster_id, status=new_deployment.status)
+    db.commit()
+    for cluster_id, cluster_events in events.items():
+        publish_status_changes(cluster_id, cluster_events)
+    return {"created": len(new_deployments), "failed": len(requested) - len(new_deployments), "deployments": results}
+
+@router.post("/create_group/", response_model=DeploymentGroupResponse)
+def create_deployment_group(group: DeploymentGroupCreate, token: str = Depends(get_token),
+                            db: Session = Depends(get_db)):
+    """
+    API to create deployments that run together or not at all on the group cluster, or on the best fitting cluster
+    for the demand of all of them when none is given. The group is scheduled in one pass at the priority of its
+    highest priority member, preempting lower priority deployments as a whole
+    """
+    validate_user_access(token, db)
+    if any(member.cluster_id not in (None, group.cluster_id) for member in group.deployments):
+        raise HTTPException(status_code=422, detail="Members of a group run on the cluster of the group")
+    cluster = validate_deployment_details(group, db)
+    ledger = CapacityLedger([cluster])
+    members = [db_schema.Deployment(**{**member.model_dump(), "cluster_id": cluster.id}, status="Pending")
+               for member in group.deployments]
+    try:
+        db.add_all(members)
+        db.flush()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Name and priority should be unique")
+
+    queued = queued_group(members)
+    status_change = expand_group_changes(new_deploy(queued, cluster), db)
+    for member in members:
+        member.group_id = queued.id
+        member.status = queued.status
+    ledger.apply(db, status_change)
+    response = DeploymentGroupResponse(
+        group_id=queued.id, cluster_id=cluster.id, status=queued.status,
+        deployments=[DeploymentResponse.model_validate(member, from_attributes=True) for member in members])
     db.commit()
-    return new_deployment
+    publish_status_changes(cluster.id, {**{member.id: (None, queued.status) for member in members}, **status_change})
+    return response
 
 @router.get("/get_deployment/", response_model=DeploymentResponse)
-def get_deployment(token: str = Depends(get_token), deployment_id: int = Query(None, alias="id"), deployment_name: str = Query(None),
-                db: Session = Depends(get_db)):
+async def get_deployment(token: str = Depends(get_token), deployment_id: int = Query(None, alias="id"),
+                         deployment_name: str = Query(None), db: AsyncSession = Depends(get_async_db)):
     """
     API to fetch details of a given deployment within a given cluster
     """
     if not deployment_id and not deployment_name:
         raise HTTPException(status_code=400, detail="Either 'deployment_id' or 'deployment_name' must be provided")
-    validate_user_access(token, db)
-    deployment = db.query(db_schema.Deployment).filter(
+    await validate_user_access_async(token, db)
+    deployment = (await db.execute(select(db_schema.Deployment).where(
         or_(
             db_schema.Deployment.id == deployment_id,
             db_schema.Deployment.name == deployment_name
         )
-    ).first()
+    ))).scalars().first()
     if not deployment:
         raise HTTPException(status_code=404, detail="Deployment not found")
     return deployment
 
+@router.get("/list/", response_model=DeploymentPage)
+async def list_deployments(token: str = Depends(get_token), cluster_id: int = Query(None), status: str = Query(None),
+                           min_priority: int = Query(None), max_priority: int = Query(None),
+                           sort: str = Query("id", pattern="^(id|priority)$"), fields: str = Query(None),
+                           limit: int = Query(100, ge=1, le=1000), cursor: str = Query(None),
+                           db: AsyncSession = Depends(get_async_db)):
+    """
+    API to list deployments one page at a time, filtered by cluster, status and priority range and sorted by id or
+    priority. fields selects a comma separated subset of the deployment fields and the next_cursor of a page fetches
+    the following one
+    """
+    await validate_user_access_async(token, db)
+    columns = select_fields(fields, db_schema.Deployment, DeploymentResponse)
+    conditions = []
+    if cluster_id is not None:
+        conditions.append(db_schema.Deployment.cluster_id == cluster_id)
+    if status is not None:
+        conditions.append(db_schema.Deployment.status == status)
+    if min_priority is not None:
+        conditions.append(db_schema.Deployment.priority >= min_priority)
+    if max_priority is not None:
+        conditions.append(db_schema.Deployment.priority <= max_priority)
+    items, next_cursor = await fetch_page(db, columns, getattr(db_schema.Deployment, sort), conditions, cursor, limit)
+    return {"items": items, "next_cursor": next_cursor}
+
+@router.get("/export/")
+async def export_deployments(request: Request, token: str = Depends(get_token), cluster_id: int = Query(None),
+                             fields: str = Query(None), db: AsyncSession = Depends(get_async_db)):
+    """
+    API to stream every deployment, or every deployment of a cluster, as newline delimited json, one deployment per
+    line in id order
+    """
+    await validate_user_access_async(token, db)
+    columns = select_fields(fields, db_schema.Deployment, DeploymentResponse)
+    statement = select(*columns).order_by(db_schema.Deployment.id)
+    if cluster_id is not None:
+        statement = statement.where(db_schema.Deployment.cluster_id == cluster_id)
+    return export_ndjson(request, statement)
+
+@router.get("/events/")
+async def deployment_events(token: str = Depends(get_token), cluster_id: List[int] = Query(None),
+                            deployment_id: List[int] = Query(None), cursor: str = Query(None),
+                            last_event_id: str = Header(None), db: AsyncSession = Depends(get_async_db)):
+    """
+    API to stream the status changes of deployments as Server-Sent Events, optionally only the ones of some clusters
+    or deployments. Streams from now on, or from right after cursor (or the Last-Event-ID header of a reconnecting
+    client) to resume without missing events
+    """
+    await validate_user_access_async(token, db)
+    cursor = cursor or last_event_id
+    if cursor is not None and not is_valid_cursor(cursor):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return StreamingResponse(stream_events(cursor, cluster_id or (), deployment_id or ()),
+                             media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 @router.post("/complete/", response_model=DeploymentResponse)
-def finish_deployment(token: str = Depends(get_token), deployment_id: int = Query(None, alias="id"),
-                      deployment_name: str = Query(None), db: Session = Depends(get_db)):
+def finish_deployment(http_response: Response, token: str = Depends(get_token),
+                      deployment_id: int = Query(None, alias="id"), deployment_name: str = Query(None),
+                      db: Session = Depends(get_db)):
     """
-    API to change the deployment status to complete
+    API to change the status of a running or pending deployment to complete, along with the other members of its
+    group if any. A pending deployment is cancelled, it leaves the pending queue without freeing anything, and a
+    completed one answers 409. With SCHEDULING_MODE set to "tick" the completion is left to the next tick of the reconcile worker, the API answering
+    202 with the deployment unchanged
     """
     if not deployment_id and not deployment_name:
         raise HTTPException(status_code=400, detail="Either 'deployment_id' or 'deployment_name' must be provided")
     validate_user_access(token, db)
-    deployment = db.query(db_schema.Deployment).filter(
-        or_(
-            db_schema.Deployment.id == deployment_id,
-            db_schema.Deployment.name == deployment_name
-        )
-    ).first()
-    if not deployment:
+    begin_write(db)
+    # The deployment and its cluster in one query, both locked until the commit
+    deployment_filter = or_(
+        db_schema.Deployment.id == deployment_id,
+        db_schema.Deployment.name == deployment_name
+    )
+    row = db.execute(select(db_schema.Deployment, db_schema.Cluster).join(
+        db_schema.Cluster, db_schema.Cluster.id == db_schema.Deployment.cluster_id
+    ).where(deployment_filter).with_for_update()).first()
+    if not row:
+        if db.query(db_schema.Deployment.id).filter(deployment_filter).first():
+            raise HTTPException(status_code=404, detail="Cluster ID not found")
         raise HTTPException(status_code=404, detail="Deployment not found")
+    deployment, cluster = row
+    # Only a queued deployment can be completed, completing it again would free its resources twice
+    if deployment.status not in ("Running", "Pending"):
+        raise HTTPException(status_code=409, detail=f"Only a running or pending deployment can be completed, "
+                                                    f"this one is {deployment.status}")
+    if reconcile.SCHEDULING_MODE == "tick":
+        response = DeploymentResponse.model_validate(deployment, from_attributes=True)
+        db.rollback()
+        reconcile.enqueue_intent("complete", response.id)
+        http_response.status_code = 202
+        return response
 
-    cluster = db.query(db_schema.Cluster).filter(db_schema.Cluster.id == deployment.cluster_id).first()
-    if not cluster:
-        raise HTTPException(status_code=404, detail="Cluster ID not found")
-
-    status_change = complete_deploy(deployment, cluster)
-    update_status_in_db(status_change, db)
+    ledger = CapacityLedger([cluster])
+    completed, status_change = complete_deployment(deployment, cluster, db)
+    status_change = expand_group_changes(status_change, db)
+    ledger.apply(db, status_change)
+    response = DeploymentResponse.model_validate(deployment, from_attributes=True)
     db.commit()
-    db.refresh(deployment)
-    return deployment
+    publish_status_changes(response.cluster_id, {**completed, **status_change})
+    return response
@@ -0,0 +1,35 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.services.auth import validate_user_access_async, get_token, user_cache_metrics
+from app.db.base import get_async_db
+from app.db.redis_client import redis_pool_metrics
+from app.services.preemption import preemption_metrics
+
+
+router = APIRouter()
+
+@router.get("/redis_pool/")
+async def get_redis_pool_metrics(token: str = Depends(get_token), db: AsyncSession = Depends(get_async_db)):
+    """
+    API to fetch the usage and saturation of the redis connection pool
+    """
+    await validate_user_access_async(token, db)
+    return redis_pool_metrics()
+
+
+@router.get("/auth_cache/")
+async def get_auth_cache_metrics(token: str = Depends(get_token), db: AsyncSession = Depends(get_async_db)):
+    """
+    API to fetch the size and the hit and miss counters of the token to user cache
+    """
+    await validate_user_access_async(token, db)
+    return user_cache_metrics()
+
+
+@router.get("/preemption/")
+async def get_preemption_metrics(token: str = Depends(get_token), db: AsyncSession = Depends(get_async_db)):
+    """
+    API to fetch the preemption policy and the counters of the deployments it preempted
+    """
+    await validate_user_access_async(token, db)
+    return preemption_metrics()
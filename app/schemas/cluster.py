@@ -1,10 +1,12 @@
-from pydantic import BaseModel
+from typing import Any, Dict, List, Optional
+from pydantic import BaseModel, Field
+from app.schemas.deployment import RESOURCE_BOUNDS
 
 class ClusterCreate(BaseModel):
     name: str
-    total_ram: int
-    total_cpu: float
-    total_gpu: int
+    total_ram: int = Field(**RESOURCE_BOUNDS)
+    total_cpu: float = Field(**RESOURCE_BOUNDS)
+    total_gpu: int = Field(**RESOURCE_BOUNDS)
 
 
 class ClusterResponse(BaseModel):
@@ -17,3 +19,7 @@ class ClusterResponse(BaseModel):
     available_cpu: float
     available_gpu: int
 
+
+class ClusterPage(BaseModel):
+    items: List[Dict[str, Any]]
+    next_cursor: Optional[str] = None
@@ -1,12 +1,17 @@
-from pydantic import BaseModel
+from typing import Any, Dict, List, Optional
+from pydantic import BaseModel, Field
+
+# Bounds of a resource amount, which the scheduler packs as an unsigned 32 bit integer in the redis records
+RESOURCE_BOUNDS = {"ge": 0, "lt": 2 ** 32}
 
 class DeploymentCreate(BaseModel):
     name: str
-    cluster_id: int
+    # Without a cluster the deployment is placed on the best fitting cluster (see placement.place_deployment)
+    cluster_id: Optional[int] = None
     image_path: str
-    ram_required: int
-    cpu_required: int
-    gpu_required: int
+    ram_required: int = Field(**RESOURCE_BOUNDS)
+    cpu_required: int = Field(**RESOURCE_BOUNDS)
+    gpu_required: int = Field(**RESOURCE_BOUNDS)
     priority: int
 
 
@@ -20,3 +25,54 @@ class DeploymentResponse(BaseModel):
     gpu_required: int
     status: str
     priority: int
+    group_id: Optional[int] = None
+
+
+class DeploymentBatchCreate(BaseModel):
+    deployments: List[DeploymentCreate]
+
+
+class DeploymentBatchItem(BaseModel):
+    index: int
+    name: str
+    id: Optional[int] = None
+    cluster_id: Optional[int] = None
+    status: Optional[str] = None
+    error: Optional[str] = None
+
+
+class DeploymentBatchResponse(BaseModel):
+    created: int
+    failed: int
+    deployments: List[DeploymentBatchItem]
+
+
+class DeploymentPage(BaseModel):
+    items: List[Dict[str, Any]]
+    next_cursor: Optional[str] = None
+
+
+class DeploymentGroupCreate(BaseModel):
+    # Every member runs on the group cluster, without one the group is placed on the best fitting cluster for the
+    # demand of all its members
+    cluster_id: Optional[int] = None
+    deployments: List[DeploymentCreate] = Field(min_length=1)
+
+    @property
+    def cpu_required(self):
+        return sum(deployment.cpu_required for deployment in self.deployments)
+
+    @property
+    def ram_required(self):
+        return sum(deployment.ram_required for deployment in self.deployments)
+
+    @property
+    def gpu_required(self):
+        return sum(deployment.gpu_required for deployment in self.deployments)
+
+
+class DeploymentGroupResponse(BaseModel):
+    group_id: int
+    cluster_id: int
+    status: str
+    deployments: List[DeploymentResponse]
@@ -1,22 +1,56 @@
 import os
+import asyncio
+import threading
+import time
 import bcrypt
+from sqlalchemy import select
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.db.db_schema import User
 from app.schemas.user import UserCreate
 from fastapi import HTTPException, Header
 from jose import JWTError, jwt
 from datetime import datetime, timedelta, timezone
 from typing import Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 SECRET_KEY = os.environ.get("JWT_SECRET_KEY", "my_secret_key")
 ALGORITHM = os.environ.get("JWT_ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
+# bcrypt cost factor of new password hashes, and threads hashing and verifying passwords apart from the request threads
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", "4"))
+# Most tokens whose user is cached, and seconds a cached user is trusted before the database is read again
+AUTH_CACHE_SIZE = int(os.environ.get("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL = int(os.environ.get("AUTH_CACHE_TTL", "60"))
+
+# Token -> (time the entry expires, CachedUser), least recently used first
+_user_cache = OrderedDict()
+_user_cache_lock = threading.Lock()
+_user_cache_counters = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+# bcrypt releases the GIL, so password work runs on its own bounded pool of threads and a burst of logins queues
+# there instead of taking the threads every other request runs on
+_password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+
+
+class CachedUser:
+    """
+    The user resolved from an access token, as kept in the token cache. It has the same attribute names as the
+    User model
+    """
+    __slots__ = ("id", "username", "organization_id")
+
+    def __init__(self, id: int, username: str, organization_id: Optional[int]):
+        self.id = id
+        self.username = username
+        self.organization_id = organization_id
 
 def hash_password(password: str):
     """
     Hash a password using bcrypt.
     """
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
     hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
     return hashed.decode('utf-8')
 
@@ -26,6 +60,19 @@ def verify_password(plain_password: str, hashed_password: str):
     """
     return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
 
+async def hash_password_async(password: str):
+    """
+    Hash a password on the password worker pool.
+    """
+    return await asyncio.get_running_loop().run_in_executor(_password_executor, hash_password, password)
+
+async def verify_password_async(plain_password: str, hashed_password: str):
+    """
+    Verify a password on the password worker pool.
+    """
+    return await asyncio.get_running_loop().run_in_executor(_password_executor, verify_password, plain_password,
+                                                            hashed_password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -52,53 +99,142 @@ def verify_token(token: str):
         raise credentials_exception
 
 
-def create_user(db: Session, user: UserCreate):
+async def _get_user_credentials(db: AsyncSession, username: str):
+    """
+    To get the id, username and hashed password of the user with the given username, or None. The read transaction
+    is ended right away so no pooled database connection is held while the password is hashed or verified
+    """
+    credentials = (await db.execute(select(User.id, User.username, User.hashed_password)
+                                    .where(User.username == username))).first()
+    await db.rollback()
+    return credentials
+
+async def create_user(db: AsyncSession, user: UserCreate):
     """
     Create a new user with the hashed password and associate them with the organization.
+    Hashing runs on the password worker pool, so the event loop never blocks
     """
     # Check if the username already exists
-    existing_user = db.query(User).filter(User.username == user.username).first()
+    existing_user = await _get_user_credentials(db, user.username)
     if existing_user:
         raise HTTPException(status_code=409, detail="Username already exists")
 
     # Hash the password and store the user
-    hashed_password = hash_password(user.password)
+    hashed_password = await hash_password_async(user.password)
     db_user = User(username=user.username, hashed_password=hashed_password, organization_id=None)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
 
 
-def authenticate_user(db: Session, username: str, password: str):
+async def authenticate_user(db: AsyncSession, username: str, password: str):
     """
     Authenticate a user by checking if the username exists and the password matches.
     """
-    db_user = db.query(User).filter(User.username == username).first()
+    db_user = await _get_user_credentials(db, username)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    if not verify_password(password, db_user.hashed_password):
+    if not await verify_password_async(password, db_user.hashed_password):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     # Generate JWT token
     access_token = create_access_token(data={"sub": db_user.username})
     return {"id": db_user.id, "username": db_user.username, "access_token": access_token, "token_type": "bearer"}
 
 
-def validate_user_access(token: str, db: Session):
+def _get_cached_user(token: str):
+    """
+    To get the cached user of the token, or None if the token is not cached or its entry expired
+    """
+    with _user_cache_lock:
+        entry = _user_cache.get(token)
+        if entry is not None and entry[0] > time.monotonic():
+            _user_cache.move_to_end(token)
+            _user_cache_counters["hits"] += 1
+            return entry[1]
+        if entry is not None:
+            del _user_cache[token]
+            _user_cache_counters["evictions"] += 1
+        _user_cache_counters["misses"] += 1
+        return None
+
+def _cache_user(token: str, token_expiry, cached_user: CachedUser):
+    """
+    To cache the user of a verified token until the cache TTL passes or the token expires, whichever comes first,
+    evicting the least recently used tokens beyond AUTH_CACHE_SIZE
+    """
+    time_to_live = AUTH_CACHE_TTL
+    if token_expiry is not None:
+        time_to_live = min(time_to_live, token_expiry - time.time())
+    if time_to_live <= 0 or AUTH_CACHE_SIZE <= 0:
+        return
+    with _user_cache_lock:
+        _user_cache[token] = (time.monotonic() + time_to_live, cached_user)
+        _user_cache.move_to_end(token)
+        while len(_user_cache) > AUTH_CACHE_SIZE:
+            _user_cache.popitem(last=False)
+            _user_cache_counters["evictions"] += 1
+
+def invalidate_cached_user(username: str):
     """
-    Validate whether the given token corresponds to a user and return the user if exists
+    To drop every cached token of the user, once the user changed
+    """
+    with _user_cache_lock:
+        tokens = [token for token, (_, cached_user) in _user_cache.items() if cached_user.username == username]
+        for token in tokens:
+            del _user_cache[token]
+        _user_cache_counters["invalidations"] += len(tokens)
+
+def user_cache_metrics():
+    """
+    To get the size and the hit, miss, eviction and invalidation counters of the token cache
+    """
+    with _user_cache_lock:
+        return {"size": len(_user_cache), "max_size": AUTH_CACHE_SIZE, **_user_cache_counters}
+
+def _verified_payload(token: str):
+    """
+    To get the payload of a token that is not cached, after verifying it names a user
     """
     payload = verify_token(token)
-    username = payload.get("sub")
-    if not username:
+    if not payload.get("sub"):
         raise HTTPException(status_code=401, detail="Invalid token")
+    return payload
 
-    db_user = db.query(User).filter(User.username == username).first()
+def _remember_user(token: str, payload: dict, db_user: Optional[User]):
+    """
+    To cache the user a token resolved to and return it
+    """
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
+    cached_user = CachedUser(db_user.id, db_user.username, db_user.organization_id)
+    _cache_user(token, payload.get("exp"), cached_user)
+    return cached_user
 
-    return db_user
+def validate_user_access(token: str, db: Session):
+    """
+    Validate whether the given token corresponds to a user and return the user if exists.
+    Resolved tokens are cached (see _cache_user), so a known token needs neither decoding nor a database query
+    """
+    cached_user = _get_cached_user(token)
+    if cached_user is not None:
+        return cached_user
+
+    payload = _verified_payload(token)
+    return _remember_user(token, payload, db.query(User).filter(User.username == payload["sub"]).first())
+
+async def validate_user_access_async(token: str, db: AsyncSession):
+    """
+    Validate whether the given token corresponds to a user and return the user if exists, from async routes
+    """
+    cached_user = _get_cached_user(token)
+    if cached_user is not None:
+        return cached_user
+
+    payload = _verified_payload(token)
+    db_user = (await db.execute(select(User).where(User.username == payload["sub"]))).scalars().first()
+    return _remember_user(token, payload, db_user)
 
 def get_token(authorization: str = Header(...)):
     """
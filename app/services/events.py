@@ -0,0 +1,90 @@
+import json
+import logging
+import os
+import re
+
+import redis
+
+from app.db.redis_client import get_redis_client, get_async_redis_client
+
+logger = logging.getLogger(__name__)
+
+# Redis stream of the status changes of every deployment, one entry per change. Entry ids are the resume cursors of
+# the event stream clients
+DEPLOYMENT_EVENTS = "DEPLOYMENT_EVENTS"
+# Approximate number of most recent events kept in the stream, a client resuming from an older cursor misses the
+# events trimmed meanwhile
+EVENT_STREAM_MAX_LEN = int(os.environ.get("EVENT_STREAM_MAX_LEN", "100000"))
+# Milliseconds an event stream waits for new events before sending a keepalive comment
+EVENT_STREAM_BLOCK_MS = int(os.environ.get("EVENT_STREAM_BLOCK_MS", "15000"))
+# Most events read from redis per round trip
+EVENT_STREAM_BATCH_SIZE = 100
+
+_CURSOR = re.compile(r"^\d+-\d+$")
+
+
+def is_valid_cursor(cursor: str):
+    """
+    To check that a resume cursor is an event id
+    """
+    return bool(_CURSOR.match(cursor))
+
+def publish_status_changes(cluster_id: int, status_change: dict, redis_client=None):
+    """
+    To add the status changes of a scheduling decision, {deployment id: (old status, new status)}, to the event
+    stream in one round trip. Publishing happens once the decision is committed and never fails the request, a
+    client missing the events can still read the deployment
+    """
+    if not status_change:
+        return
+    if redis_client is None:
+        redis_client = get_redis_client()
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for deployment_id, (old_status, new_status) in status_change.items():
+            pipe.xadd(DEPLOYMENT_EVENTS, {"cluster_id": cluster_id, "deployment_id": deployment_id,
+                                          "old_status": old_status or "", "new_status": new_status},
+                      maxlen=EVENT_STREAM_MAX_LEN, approximate=True)
+        pipe.execute()
+    except redis.exceptions.RedisError as error:
+        logger.warning("Failed to publish %d deployment status changes: %s", len(status_change), error)
+
+def _event(event_id: bytes, fields: dict):
+    """
+    To decode an entry of the event stream
+    """
+    return {
+        "cursor": event_id.decode(),
+        "cluster_id": int(fields[b"cluster_id"]),
+        "deployment_id": int(fields[b"deployment_id"]),
+        "old_status": fields[b"old_status"].decode() or None,
+        "new_status": fields[b"new_status"].decode(),
+    }
+
+async def stream_events(cursor: str = None, cluster_ids=(), deployment_ids=()):
+    """
+    To yield the status change events of the given clusters and deployments (all of them when none is given) as
+    Server-Sent Events, from right after the cursor or from now on without one. Every event carries its cursor as
+    SSE id, so a reconnecting client resumes with its Last-Event-ID. The stream is read with blocking XREADs on a
+    connection of its own, and a keepalive comment is sent whenever no event came for EVENT_STREAM_BLOCK_MS
+    """
+    cluster_ids, deployment_ids = set(cluster_ids), set(deployment_ids)
+    async with get_async_redis_client() as redis_client:
+        if cursor is None:
+            # The id of the latest event rather than "$", which would skip the events added between two reads
+            latest = await redis_client.xrevrange(DEPLOYMENT_EVENTS, count=1)
+            cursor = latest[0][0].decode() if latest else "0-0"
+        while True:
+            reply = await redis_client.xread({DEPLOYMENT_EVENTS: cursor}, count=EVENT_STREAM_BATCH_SIZE,
+                                             block=EVENT_STREAM_BLOCK_MS)
+            if not reply:
+                yield ": keepalive\n\n"
+                continue
+            for event_id, fields in reply[0][1]:
+                event = _event(event_id, fields)
+                cursor = event["cursor"]
+                if cluster_ids and event["cluster_id"] not in cluster_ids:
+                    continue
+                if deployment_ids and event["deployment_id"] not in deployment_ids:
+                    continue
+                yield f"id: {cursor}\nevent: status_change\ndata: {json.dumps(event)}\n\n"
@@ -0,0 +1,60 @@
+"""
+Gang scheduling of deployment groups: the members of a group run together on one cluster or not at all.
+
+A group is queued as a single deployment: the id and priority of its lead member, the highest priority one, with the
+summed demand of every member. Each engine places, preempts, backfills and completes it like any other deployment, in
+one step whatever the number of members, so it can never run partially. The members share the status of the lead, and
+the status changes of a lead are copied to its members before they are written and published.
+"""
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from app.db.db_schema import Deployment
+from app.services.resources import demand_of
+from app.services.scheduler import QueuedDeployment, complete_deploy
+
+
+def lead_member(members):
+    """
+    To get the member a group is queued as, the highest priority one
+    """
+    return max(members, key=lambda member: member.priority)
+
+def queued_group(members):
+    """
+    To get the deployment a group is scheduled as: the id, priority and status of its lead with the demand of all
+    the members
+    """
+    lead = lead_member(members)
+    demand = [sum(column) for column in zip(*map(demand_of, members))]
+    return QueuedDeployment(lead.id, *demand, lead.priority, lead.status)
+
+def expand_group_changes(status_change: dict, db: Session):
+    """
+    To add the other members of the groups whose lead is in the status changes of a decision, with the change of
+    their lead. One query, and none when nothing changed
+    """
+    if not status_change:
+        return status_change
+    members = db.execute(select(Deployment.id, Deployment.group_id).where(
+        Deployment.group_id.in_(list(status_change)), Deployment.id != Deployment.group_id))
+    expanded = dict(status_change)
+    for member_id, group_id in members:
+        expanded[member_id] = status_change[group_id]
+    return expanded
+
+def complete_deployment(deployment: Deployment, cluster, db: Session):
+    """
+    To complete a deployment, or the whole group of a member, freeing its resources in one scheduling pass. Returns
+    the {id: (old status, "Completed")} of the completed deployments and the status changes of the pass
+    """
+    if deployment.group_id is None:
+        completed = {deployment.id: (deployment.status, "Completed")}
+        return completed, complete_deploy(deployment, cluster)
+    members = db.execute(select(Deployment).where(Deployment.group_id == deployment.group_id)
+                         .with_for_update()).scalars().all()
+    completed = {member.id: (member.status, "Completed") for member in members}
+    status_change = complete_deploy(queued_group(members), cluster)
+    for member in members:
+        member.status = "Completed"
+    return completed, status_change
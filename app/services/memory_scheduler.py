@@ -0,0 +1,323 @@
+import contextlib
+import logging
+import queue
+import threading
+import time
+
+import redis
+from sortedcontainers import SortedList
+
+from app.db.redis_client import get_redis_client
+from app.db.db_schema import Deployment, Cluster
+from app.services import scheduler, preemption
+from app.services.resource_management import check_resource_availability, allocate_resources, free_resources
+from app.services.resources import RESOURCES, demand_of, available_of, fits
+
+logger = logging.getLogger(__name__)
+
+# Most scheduling decisions written to redis in one MULTI/EXEC block by the journal writer
+JOURNAL_BATCH_SIZE = 100
+# Seconds to wait before writing the journal to redis again after a failure
+JOURNAL_RETRY_DELAY = 1
+
+# In-memory queues by cluster id, the lock only guards the dict: every cluster is scheduled under its own lock
+_clusters = {}
+_clusters_lock = threading.Lock()
+_journal = queue.Queue()
+_journal_writer = None
+_journal_writer_lock = threading.Lock()
+
+
+class ClusterQueues:
+    """
+    The running and pending queues of one cluster kept in memory, as sorted lists of (priority, id), with the
+    queued deployments by id. The pending demand lists hold (demand, id) of every pending deployment for cpu, ram
+    and gpu, to find the smallest pending demand of each resource cheaply. The decisions on the cluster are taken
+    under its lock, after the queues are loaded from redis
+    """
+    __slots__ = ("running", "pending", "pending_demands", "deployments", "lock", "loaded")
+
+    def __init__(self):
+        self.running = SortedList()
+        self.pending = SortedList()
+        self.pending_demands = tuple(SortedList() for _ in RESOURCES)
+        self.deployments = {}
+        self.lock = threading.Lock()
+        self.loaded = False
+
+
+def _add(queues: ClusterQueues, deployment):
+    """
+    To add a queued deployment to the queue of its status
+    """
+    queues.deployments[deployment.id] = deployment
+    if deployment.status == "Running":
+        queues.running.add((deployment.priority, deployment.id))
+    else:
+        queues.pending.add((deployment.priority, deployment.id))
+        for demand_list, demand in zip(queues.pending_demands, demand_of(deployment)):
+            demand_list.add((demand, deployment.id))
+
+def _remove(queues: ClusterQueues, deployment):
+    """
+    To remove a queued deployment from the queue of its status
+    """
+    del queues.deployments[deployment.id]
+    if deployment.status == "Running":
+        queues.running.remove((deployment.priority, deployment.id))
+    else:
+        queues.pending.remove((deployment.priority, deployment.id))
+        for demand_list, demand in zip(queues.pending_demands, demand_of(deployment)):
+            demand_list.remove((demand, deployment.id))
+
+def _load_cluster_queues(queues: ClusterQueues, cluster_id: int):
+    """
+    To fill the in-memory queues of a cluster from its redis queues and deployment records, which the journal
+    keeps up to date with every decision
+    """
+    pipe = get_redis_client().pipeline(transaction=True)
+    pipe.zrange(scheduler._cluster_key(scheduler.RUNNING_QUEUE, cluster_id), 0, -1, withscores=True)
+    pipe.zrange(scheduler._cluster_key(scheduler.PENDING_QUEUE, cluster_id), 0, -1, withscores=True)
+    pipe.hgetall(scheduler._cluster_key(scheduler.DEPLOYMENT_RECORDS, cluster_id))
+    running, pending, records = pipe.execute()
+
+    for entries, status in ((running, "Running"), (pending, "Pending")):
+        for member, priority in entries:
+            _add(queues, scheduler._unpack_record(member, records[member], priority, status))
+    queues.loaded = True
+
+def _get_cluster_queues(cluster_id: int):
+    """
+    To get the in-memory queues of a cluster, to be loaded under its lock the first time the cluster is scheduled
+    """
+    with _clusters_lock:
+        queues = _clusters.get(cluster_id)
+        if queues is None:
+            queues = _clusters[cluster_id] = ClusterQueues()
+        return queues
+
+@contextlib.contextmanager
+def _locked_cluster_queues(cluster_id: int):
+    """
+    To hold the lock of the in-memory queues of a cluster, loaded from redis if they are not yet
+    """
+    queues = _get_cluster_queues(cluster_id)
+    with queues.lock:
+        if not queues.loaded:
+            _load_cluster_queues(queues, cluster_id)
+        yield queues
+
+def drop_cluster_queues():
+    """
+    To forget the in-memory queues of every cluster once the redis queues were rewritten (see restore.rebuild), so
+    they are loaded again the next time each cluster is scheduled
+    """
+    with _clusters_lock:
+        _clusters.clear()
+
+def _move(queues: ClusterQueues, moved: dict, deployment, new_status: str):
+    """
+    To move a deployment to the queue of its new status (out of the queues once completed) and record the move for
+    the journal with the status it had before the decision, None for a new deployment
+    """
+    if deployment.id in queues.deployments:
+        _remove(queues, deployment)
+        moved.setdefault(deployment.id, (deployment, deployment.status))
+    else:
+        moved.setdefault(deployment.id, (deployment, None))
+    deployment.status = new_status
+    if new_status != "Completed":
+        _add(queues, deployment)
+
+def _find_best_fit_pending(queues: ClusterQueues, cluster: Cluster):
+    """
+    To find the highest priority pending deployment that fits the available resources of the cluster. Nothing fits
+    once any available resource of the cluster is below the smallest pending demand of that resource
+    """
+    available = available_of(cluster)
+    if not queues.pending or not fits([demand_list[0][0] for demand_list in queues.pending_demands], available):
+        return None
+    for _, deployment_id in reversed(queues.pending):
+        pending_deployment = queues.deployments[deployment_id]
+        if check_resource_availability(cluster, pending_deployment):
+            return pending_deployment
+    return None
+
+def _deploy_pending_resource(queues: ClusterQueues, cluster: Cluster, status_change, moved):
+    """
+    To fill in lower priority deployment of the pending queue if possible for max utilization
+    """
+    while True:
+        pending_deployment = _find_best_fit_pending(queues, cluster)
+        if pending_deployment is None:
+            break
+
+        scheduler._update_status_change(status_change, pending_deployment, "Running")
+        _move(queues, moved, pending_deployment, "Running")
+        allocate_resources(cluster, pending_deployment)
+
+def _write_journal():
+    """
+    To write the journaled decisions to redis in order, batching the decisions queued meanwhile into one MULTI/EXEC
+    block. A failed write is retried until redis is reachable again so no decision is lost or reordered
+    """
+    while True:
+        entries = [_journal.get()]
+        while len(entries) < JOURNAL_BATCH_SIZE and not _journal.empty():
+            entries.append(_journal.get_nowait())
+
+        while True:
+            try:
+                pipe = get_redis_client().pipeline(transaction=True)
+                for cluster_id, moved in entries:
+                    scheduler._write_moves(pipe, cluster_id, moved)
+                pipe.execute()
+                break
+            except redis.exceptions.RedisError as error:
+                logger.warning("Failed to journal %d scheduling decisions, retrying: %s", len(entries), error)
+                time.sleep(JOURNAL_RETRY_DELAY)
+
+        for _ in entries:
+            _journal.task_done()
+
+def _journal_moves(cluster_id: int, moved: dict):
+    """
+    To queue the moves of a decision for the journal writer, as snapshots since the queued deployments keep
+    changing with later decisions
+    """
+    global _journal_writer
+    if not moved:
+        return
+    snapshot = {deployment_id: (scheduler.QueuedDeployment(deployment.id, *demand_of(deployment), deployment.priority,
+                                                           deployment.status), origin)
+                for deployment_id, (deployment, origin) in moved.items()}
+    _journal.put((cluster_id, snapshot))
+    # A single writer, so the decisions are written in the order they were taken
+    with _journal_writer_lock:
+        if _journal_writer is None:
+            _journal_writer = threading.Thread(target=_write_journal, name="scheduler-journal", daemon=True)
+            _journal_writer.start()
+
+def flush_journal():
+    """
+    To wait until every journaled decision is written to redis
+    """
+    _journal.join()
+
+def _preempt_for(queues: ClusterQueues, cluster: Cluster, deployment, status_change, moved):
+    """
+    To move lower priority running deployments to the pending queue until the new deployment runs, with the
+    preemption policy, like scheduler._preempt_for
+    """
+    if preemption.PREEMPTION_POLICY == "min_cost":
+        candidates = [queues.deployments[running_id] for priority, running_id in
+                      queues.running.islice(0, preemption.PREEMPTION_MAX_CANDIDATES) if priority < deployment.priority]
+        victims = preemption.choose_victims(candidates, preemption.deficit(cluster, deployment))
+        if victims is not None:
+            for victim in victims:
+                free_resources(cluster, victim)
+                scheduler._update_status_change(status_change, victim, "Pending")
+                _move(queues, moved, victim, "Pending")
+            _move(queues, moved, deployment, "Running")
+            allocate_resources(cluster, deployment)
+            preemption.record_preemptions(len(victims))
+            return
+        if len(candidates) < preemption.PREEMPTION_MAX_CANDIDATES:
+            _move(queues, moved, deployment, "Pending")
+            return
+
+    _preempt_greedy(queues, cluster, deployment, status_change, moved)
+
+def _preempt_greedy(queues: ClusterQueues, cluster: Cluster, deployment, status_change, moved):
+    """
+    To move lower priority running deployments to the pending queue, lowest first, until the new deployment fits and
+    runs, or to move the new deployment to the pending queue once a higher priority deployment is the lowest running
+    """
+    preempted = 0
+    for priority, running_id in list(queues.running):
+        if priority > deployment.priority:
+            _move(queues, moved, deployment, "Pending")
+            break
+
+        running_deployment = queues.deployments[running_id]
+        free_resources(cluster, running_deployment)
+        scheduler._update_status_change(status_change, running_deployment, "Pending")
+        _move(queues, moved, running_deployment, "Pending")
+        preempted += 1
+
+        if check_resource_availability(cluster, deployment):
+            _move(queues, moved, deployment, "Running")
+            allocate_resources(cluster, deployment)
+            break
+    if preempted:
+        preemption.record_preemptions(preempted)
+
+def _queued_copy(deployment: Deployment):
+    """
+    To create the queued deployment kept in memory for a new deployment
+    """
+    return scheduler.QueuedDeployment(deployment.id, *demand_of(deployment), deployment.priority, deployment.status)
+
+def new_deploy(new_deployment: Deployment, cluster: Cluster):
+    """
+    To deploy new deployment with the same algorithm as scheduler.new_deploy, deciding on the in-memory queues of the
+    cluster and journaling the decision to redis in the background
+    """
+    with _locked_cluster_queues(cluster.id) as queues:
+        status_change, moved = {}, {}
+        deployment = _queued_copy(new_deployment)
+
+        if check_resource_availability(cluster, deployment):
+            _move(queues, moved, deployment, "Running")
+            allocate_resources(cluster, deployment)
+        else:
+            _preempt_for(queues, cluster, deployment, status_change, moved)
+            _deploy_pending_resource(queues, cluster, status_change, moved)
+
+        new_deployment.status = deployment.status
+        _journal_moves(cluster.id, moved)
+        return status_change
+
+def new_deploy_batch(new_deployments, cluster: Cluster):
+    """
+    To deploy many new deployments of one cluster with the same algorithm as scheduler.new_deploy_batch, the new
+    deployments being given from the highest priority
+    """
+    with _locked_cluster_queues(cluster.id) as queues:
+        status_change, moved = {}, {}
+        deployments = [_queued_copy(new_deployment) for new_deployment in new_deployments]
+
+        for deployment in deployments:
+            if check_resource_availability(cluster, deployment):
+                _move(queues, moved, deployment, "Running")
+                allocate_resources(cluster, deployment)
+            else:
+                _preempt_for(queues, cluster, deployment, status_change, moved)
+        _deploy_pending_resource(queues, cluster, status_change, moved)
+
+        for new_deployment, deployment in zip(new_deployments, deployments):
+            new_deployment.status = deployment.status
+        _journal_moves(cluster.id, moved)
+        return status_change
+
+def complete_deploy(deployment: Deployment, cluster: Cluster):
+    """
+    To complete a deployment with the same algorithm as scheduler.complete_deploy, deciding on the in-memory
+    queues of the cluster and journaling the decision to redis in the background
+    """
+    with _locked_cluster_queues(cluster.id) as queues:
+        status_change, moved = {}, {}
+
+        queued_deployment = queues.deployments.get(deployment.id)
+        origin = deployment.status
+        if queued_deployment is not None:
+            origin = queued_deployment.status
+            _move(queues, moved, queued_deployment, "Completed")
+        deployment.status = 'Completed'
+        # Only a running deployment holds resources, a pending one just leaves the pending queue
+        if origin == "Running":
+            free_resources(cluster, deployment)
+            _deploy_pending_resource(queues, cluster, status_change, moved)
+
+        _journal_moves(cluster.id, moved)
+        return status_change
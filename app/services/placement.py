@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+
+from fastapi import HTTPException
+from sortedcontainers import SortedList
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from app.db.db_schema import Cluster
+from app.services.resources import TOTAL, AVAILABLE, demand_of, fits
+
+# Seconds the capacity index is trusted before it is reloaded from the database, to pick up the changes of the other
+# API workers. Changes made by this worker are applied to the index as they are written
+PLACEMENT_INDEX_REFRESH = float(os.environ.get("PLACEMENT_INDEX_REFRESH", "5"))
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def _bucket(amount):
+    """
+    Bucket of an amount of resource on a power of two scale: bucket 0 holds zero and bucket b > 0 holds amounts
+    from 2 ** (b - 1) to 2 ** b - 1 (the scale of the pending bucket index of the scheduler)
+    """
+    return max(int(amount), 0).bit_length()
+
+
+class CapacityIndex:
+    """
+    The available (cpu, ram, gpu) of every cluster, bucketed by the power of two bucket of each resource. Every
+    bucket holds its clusters sorted by total available resources, and the occupied buckets are sorted by the sum of
+    their resource buckets, so a best fit looks at the occupied buckets from the smallest that can fit the demand and
+    at their smallest clusters only
+    """
+    __slots__ = ("available", "buckets", "bucket_order", "loaded_at")
+
+    def __init__(self, clusters=()):
+        self.available = {}
+        self.buckets = {}
+        self.bucket_order = SortedList()
+        self.loaded_at = time.monotonic()
+        for cluster_id, available in clusters:
+            self.set(cluster_id, available)
+
+    def set(self, cluster_id: int, available):
+        """
+        To add a cluster to the index, or move it to the bucket of its new available resources
+        """
+        self.remove(cluster_id)
+        available = tuple(available)
+        bucket = tuple(_bucket(amount) for amount in available)
+        self.available[cluster_id] = available
+        if bucket not in self.buckets:
+            self.buckets[bucket] = SortedList()
+            self.bucket_order.add((sum(bucket), bucket))
+        self.buckets[bucket].add((sum(available), cluster_id))
+
+    def remove(self, cluster_id: int):
+        """
+        To remove a cluster from the index, dropping its bucket once empty
+        """
+        available = self.available.pop(cluster_id, None)
+        if available is None:
+            return
+        bucket = tuple(_bucket(amount) for amount in available)
+        clusters = self.buckets[bucket]
+        clusters.remove((sum(available), cluster_id))
+        if not clusters:
+            del self.buckets[bucket]
+            self.bucket_order.remove((sum(bucket), bucket))
+
+    def best_fit(self, demand):
+        """
+        To find the cluster with the least available resources that fits the demand, the lowest id first among equal
+        ones. The occupied buckets are looked at from the smallest that can hold the demand: buckets with a resource
+        below the bucket of the demand are skipped, the clusters of buckets above the demand in every resource all
+        fit, and only the clusters of buckets on the bucket of the demand are checked one by one. Every bucket has a
+        floor, the least total resources its clusters can have, and the scan stops once no bucket left can beat the
+        best cluster found. Returns None when no cluster fits
+        """
+        demand = tuple(demand)
+        demand_bucket = tuple(_bucket(amount) for amount in demand)
+        best = None
+        for level, bucket in self.bucket_order.irange((sum(demand_bucket),)):
+            if best is not None and _level_floor(level, len(bucket)) >= best[0]:
+                break
+            if any(resource_bucket < needed for resource_bucket, needed in zip(bucket, demand_bucket)):
+                continue
+            if best is not None and _bucket_floor(bucket) >= best[0]:
+                continue
+            all_fit = all(resource_bucket > needed for resource_bucket, needed in zip(bucket, demand_bucket))
+            for entry in self.buckets[bucket]:
+                if best is not None and entry >= best:
+                    break
+                if all_fit or fits(demand, self.available[entry[1]]):
+                    best = entry
+                    break
+        return best[1] if best else None
+
+
+def _bucket_floor(bucket):
+    """
+    To get the least total resources of the clusters of a bucket, the sum of the smallest amount of each resource
+    bucket
+    """
+    return sum(1 << (resource_bucket - 1) for resource_bucket in bucket if resource_bucket)
+
+def _level_floor(level: int, resources: int):
+    """
+    To get a floor of the total resources of the clusters of every bucket whose resource buckets sum to level: one
+    resource at least is in a bucket of level / resources or above
+    """
+    return 1 << (-(-level // resources) - 1) if level else 0
+
+def _load_index(db: Session):
+    """
+    To build the capacity index from the available resources of every cluster in the database
+    """
+    rows = db.execute(select(Cluster.id, *(getattr(Cluster, attribute) for attribute in AVAILABLE)))
+    return CapacityIndex((cluster_id, available) for cluster_id, *available in rows)
+
+def update_cluster(cluster_id: int, available):
+    """
+    To record the available resources of a cluster once they are written. Nothing to do while the index is not
+    loaded, the load reads them
+    """
+    with _index_lock:
+        if _index is not None:
+            _index.set(cluster_id, available)
+
+def reset_index():
+    """
+    To drop the capacity index, so the next placement reloads it from the database
+    """
+    global _index
+    with _index_lock:
+        _index = None
+
+def place_deployment(deployment, db: Session):
+    """
+    To choose the cluster of a deployment given without one: the best fit among the clusters with enough available
+    resources now, whose index entry is charged with the demand right away so concurrent placements spread out. When
+    no cluster has room, the smallest cluster large enough for the deployment, where it waits as pending
+    """
+    global _index
+    demand = demand_of(deployment)
+    with _index_lock:
+        if _index is None or time.monotonic() - _index.loaded_at > PLACEMENT_INDEX_REFRESH:
+            _index = _load_index(db)
+        cluster_id = _index.best_fit(demand)
+        if cluster_id is not None:
+            _index.set(cluster_id, (free - needed for free, needed in zip(_index.available[cluster_id], demand)))
+            return cluster_id
+
+    totals = [getattr(Cluster, attribute) for attribute in TOTAL]
+    cluster_id = db.execute(select(Cluster.id).where(
+        *(total >= needed for total, needed in zip(totals, demand))
+    ).order_by(sum(totals[1:], totals[0]), Cluster.id).limit(1)).scalar()
+    if cluster_id is None:
+        raise HTTPException(status_code=422, detail="Not Enough Resources on any cluster for this deployment")
+    return cluster_id
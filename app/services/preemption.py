@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+
+from app.services.resources import RESOURCES, demand_of, available_of
+
+# "greedy" preempts the running deployments of lower priority lowest first until the new deployment fits,
+# "min_cost" preempts the fewest of them whose resources cover what the new deployment lacks (see choose_victims)
+PREEMPTION_POLICY = os.environ.get("PREEMPTION_POLICY", "greedy")
+# Lowest priority running deployments the min_cost search chooses from
+PREEMPTION_MAX_CANDIDATES = int(os.environ.get("PREEMPTION_MAX_CANDIDATES", "64"))
+# Milliseconds the min_cost search may take before settling for the cheapest set found so far
+PREEMPTION_SEARCH_BUDGET_MS = float(os.environ.get("PREEMPTION_SEARCH_BUDGET_MS", "2"))
+# Search nodes visited between two checks of the time budget
+_BUDGET_CHECK_INTERVAL = 256
+
+_metrics_lock = threading.Lock()
+_metrics = {"preempting_decisions": 0, "preemptions": 0, "searches": 0, "search_timeouts": 0}
+
+
+def deficit(cluster, deployment):
+    """
+    To get the (cpu, ram, gpu) the cluster lacks to run the deployment
+    """
+    return tuple(max(needed - free, 0) for needed, free in zip(demand_of(deployment), available_of(cluster)))
+
+def _covers(freed, missing):
+    return all(amount >= needed for amount, needed in zip(freed, missing))
+
+def choose_victims(candidates, missing):
+    """
+    To choose the cheapest set of candidates (running deployments of lower priority, lowest first) whose resources
+    cover the missing (cpu, ram, gpu): the fewest deployments, then the lowest priorities. The greedy set, the
+    lowest priority prefix that covers, is the first bound. A depth first search then tries the candidates that cover
+    the most of what is missing first, and prunes the branches that cannot beat the best set or cannot cover the
+    missing resources with the candidates left. Once PREEMPTION_SEARCH_BUDGET_MS is spent the best set found so far
+    is returned. Returns the victims lowest priority first, or None when all the candidates together do not cover
+    """
+    missing = tuple(missing)
+    freed, best = [0] * len(RESOURCES), None
+    for count, candidate in enumerate(candidates, start=1):
+        freed = [amount + demand for amount, demand in zip(freed, demand_of(candidate))]
+        if _covers(freed, missing):
+            best = list(candidates[:count])
+            break
+    if best is None:
+        return None
+    if len(best) == 1:
+        return best
+
+    def coverage(candidate):
+        return sum(min(demand, needed) / needed for demand, needed in zip(demand_of(candidate), missing) if needed)
+
+    ordered = sorted(candidates, key=lambda candidate: (-coverage(candidate), candidate.priority))
+    # Resources of the candidates from every position on, to prune branches that cannot cover anymore
+    remaining = [(0,) * len(RESOURCES)] * (len(ordered) + 1)
+    for index in range(len(ordered) - 1, -1, -1):
+        remaining[index] = tuple(amount + demand for amount, demand in
+                                 zip(remaining[index + 1], demand_of(ordered[index])))
+    lowest_priority = min(candidate.priority for candidate in candidates)
+
+    best_cost = (len(best), sum(victim.priority for victim in best))
+    deadline = time.perf_counter() + PREEMPTION_SEARCH_BUDGET_MS / 1000
+    chosen, visited, timed_out = [], 0, False
+
+    def search(start, freed, priorities):
+        nonlocal best, best_cost, visited, timed_out
+        visited += 1
+        if visited % _BUDGET_CHECK_INTERVAL == 0 and time.perf_counter() > deadline:
+            timed_out = True
+        if timed_out:
+            return
+        if _covers(freed, missing):
+            cost = (len(chosen), priorities)
+            if cost < best_cost:
+                best, best_cost = list(chosen), cost
+            return
+        # One more victim at least: it must not make the set larger than the best, or as large and not cheaper
+        if (len(chosen) + 1, priorities + lowest_priority) >= best_cost:
+            return
+        for index in range(start, len(ordered)):
+            if not _covers([amount + rest for amount, rest in zip(freed, remaining[index])], missing):
+                return
+            candidate = ordered[index]
+            chosen.append(candidate)
+            search(index + 1, [amount + demand for amount, demand in zip(freed, demand_of(candidate))],
+                   priorities + candidate.priority)
+            chosen.pop()
+            if timed_out:
+                return
+
+    search(0, [0] * len(RESOURCES), 0)
+    with _metrics_lock:
+        _metrics["searches"] += 1
+        _metrics["search_timeouts"] += timed_out
+    return sorted(best, key=lambda victim: victim.priority)
+
+def record_preemptions(count: int):
+    """
+    To count the running deployments a decision preempted
+    """
+    if not count:
+        return
+    with _metrics_lock:
+        _metrics["preempting_decisions"] += 1
+        _metrics["preemptions"] += count
+
+def preemption_metrics():
+    """
+    To get the preemption policy with the number of decisions that preempted, of preempted deployments, of min_cost
+    searches and of searches stopped by the time budget
+    """
+    with _metrics_lock:
+        return {"policy": PREEMPTION_POLICY, **_metrics}
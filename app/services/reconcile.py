@@ -0,0 +1,312 @@
+"""
+Scheduling in ticks: with SCHEDULING_MODE set to "tick", creating and completing a deployment only record it and
+queue a scheduling intent, and the reconcile worker started with the application takes the decisions in the
+background.
+
+Every SCHEDULING_TICK_MS the worker claims the queued intents and schedules them cluster by cluster, each cluster in
+its own transaction: the cluster is locked, gets one completion pass per completed deployment and a single batch pass
+(scheduler.new_deploy_batch) for all its new deployments, and its status changes and capacity deltas are then written
+in bulk through a capacity ledger and committed. A burst of submissions costs one pass per cluster and tick instead of
+one per request.
+
+A single worker of all the API processes reconciles at a time: it holds the SCHEDULING_RECONCILER lease, renewed
+every tick, and the others only take it over once it expired. Claimed intents are moved to a processing list until
+the transaction of their cluster commits, so the worker taking the lease over pushes back the intents a crashed
+reconciler left claimed. The intents of a cluster that fails before its scheduling passes are pushed back to the head
+of the queue for the next tick. Once a pass wrote to the redis queues of the cluster they differ from the database,
+so the queues of the cluster are rebuilt from it before its intents are pushed back. The other clusters of the tick
+are committed on their own.
+"""
+import asyncio
+import logging
+import os
+import uuid
+
+import redis
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from app.db.base import SessionLocal
+from app.db.db_schema import Deployment
+from app.db.redis_client import get_redis_client
+from app.services.events import publish_status_changes
+from app.services.restore import rebuild_queues
+from app.services.groups import expand_group_changes, complete_deployment
+from app.services.resource_management import CapacityLedger
+from app.services.scheduler import new_deploy_batch
+from app.utils import lock_clusters
+
+logger = logging.getLogger(__name__)
+
+# "sync" schedules a deployment inside the request creating or completing it, "tick" queues the request as an
+# intent scheduled by the reconcile worker
+SCHEDULING_MODE = os.environ.get("SCHEDULING_MODE", "sync")
+# Milliseconds between two scheduling ticks of the reconcile worker
+SCHEDULING_TICK_MS = float(os.environ.get("SCHEDULING_TICK_MS", "50"))
+# Most intents scheduled by one tick, the ones left wait for the next tick
+SCHEDULING_TICK_MAX_INTENTS = int(os.environ.get("SCHEDULING_TICK_MAX_INTENTS", "10000"))
+# Milliseconds the reconciler lease lasts without being renewed, longer than the slowest tick
+SCHEDULING_LEASE_MS = int(os.environ.get("SCHEDULING_LEASE_MS", "10000"))
+
+# Redis list of the intents waiting for a tick, "<new|complete>:<deployment id>" in arrival order
+SCHEDULING_INTENTS = "SCHEDULING_INTENTS"
+# Redis list of the intents claimed by a tick and not scheduled yet
+SCHEDULING_INTENTS_PROCESSING = "SCHEDULING_INTENTS_PROCESSING"
+# Redis key holding the id of the worker reconciling, expiring after SCHEDULING_LEASE_MS
+SCHEDULING_RECONCILER = "SCHEDULING_RECONCILER"
+
+# Id of the reconcile worker of this process
+_reconciler_id = uuid.uuid4().hex
+
+
+class ClusterOutOfSync(Exception):
+    """
+    Raised when scheduling the intents of a cluster failed after a scheduling pass wrote to its redis queues
+    """
+
+
+def enqueue_intent(operation: str, deployment_id: int, redis_client=None):
+    """
+    To queue the creation ("new") or completion ("complete") of a committed deployment for the next tick
+    """
+    if redis_client is None:
+        redis_client = get_redis_client()
+    redis_client.rpush(SCHEDULING_INTENTS, f"{operation}:{deployment_id}")
+
+def _claim_intents(redis_client):
+    """
+    To move up to SCHEDULING_TICK_MAX_INTENTS intents from the queue to the processing list, in arrival order
+    """
+    count = min(redis_client.llen(SCHEDULING_INTENTS), SCHEDULING_TICK_MAX_INTENTS)
+    if not count:
+        return []
+    pipe = redis_client.pipeline(transaction=False)
+    for _ in range(count):
+        pipe.lmove(SCHEDULING_INTENTS, SCHEDULING_INTENTS_PROCESSING, "LEFT", "RIGHT")
+    # None once another worker emptied the queue first
+    return [entry for entry in pipe.execute() if entry is not None]
+
+def _parse_intent(entry):
+    """
+    To read an intent entry as its operation and deployment id
+    """
+    operation, deployment_id = (entry.decode() if isinstance(entry, bytes) else entry).split(":")
+    return operation, int(deployment_id)
+
+def _requeue_orphaned_intents(redis_client):
+    """
+    To push the intents left claimed by a previous reconciler back to the head of the queue, in arrival order. It may
+    have stopped anywhere in a tick, so the queues of their clusters are first rebuilt from the database
+    """
+    entries = redis_client.lrange(SCHEDULING_INTENTS_PROCESSING, 0, -1)
+    if not entries:
+        return
+    intents = [_parse_intent(entry) for entry in entries]
+    with SessionLocal() as db:
+        cluster_of = dict(db.execute(select(Deployment.id, Deployment.cluster_id).where(
+            Deployment.id.in_({deployment_id for _, deployment_id in intents}))).all())
+    cluster_intents = {}
+    for operation, deployment_id in intents:
+        if deployment_id in cluster_of:
+            cluster_intents.setdefault(cluster_of[deployment_id], []).append((operation, deployment_id))
+    for cluster_id, orphaned in cluster_intents.items():
+        _resync_cluster(cluster_id, orphaned, redis_client)
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.delete(SCHEDULING_INTENTS_PROCESSING)
+    pipe.lpush(SCHEDULING_INTENTS, *reversed(entries))
+    pipe.execute()
+    logger.warning("Requeued %d scheduling intents left claimed by a previous reconciler", len(entries))
+
+def _lead(redis_client):
+    """
+    To take or renew the reconciler lease. Returns whether this worker is the reconciler, a worker taking the lease
+    over requeues the intents its previous holder left claimed
+    """
+    with redis_client.pipeline(transaction=True) as pipe:
+        try:
+            pipe.watch(SCHEDULING_RECONCILER)
+            holder = pipe.get(SCHEDULING_RECONCILER)
+            holder = holder.decode() if isinstance(holder, bytes) else holder
+            if holder not in (None, _reconciler_id):
+                return False
+            pipe.multi()
+            pipe.set(SCHEDULING_RECONCILER, _reconciler_id, px=SCHEDULING_LEASE_MS)
+            pipe.execute()
+        except redis.WatchError:
+            return False
+    if holder is None:
+        _requeue_orphaned_intents(redis_client)
+    return True
+
+def resign(redis_client=None):
+    """
+    To give the reconciler lease up, so another worker takes it over at its next tick instead of once it expired
+    """
+    if redis_client is None:
+        redis_client = get_redis_client()
+    with redis_client.pipeline(transaction=True) as pipe:
+        try:
+            pipe.watch(SCHEDULING_RECONCILER)
+            holder = pipe.get(SCHEDULING_RECONCILER)
+            if (holder.decode() if isinstance(holder, bytes) else holder) != _reconciler_id:
+                return
+            pipe.multi()
+            pipe.delete(SCHEDULING_RECONCILER)
+            pipe.execute()
+        except redis.WatchError:
+            pass
+
+def _release_intents(redis_client, entries, requeue: bool = False):
+    """
+    To take claimed intents off the processing list, pushing them back to the head of the queue when requeued
+    """
+    if not entries:
+        return
+    pipe = redis_client.pipeline(transaction=True)
+    for entry in entries:
+        pipe.lrem(SCHEDULING_INTENTS_PROCESSING, 1, entry)
+    if requeue:
+        pipe.lpush(SCHEDULING_INTENTS, *reversed(entries))
+    pipe.execute()
+
+def _merge_status_change(status_change: dict, changes: dict):
+    """
+    To add the status changes of a pass to the ones of the previous passes of the tick, keeping the first old status
+    """
+    for deployment_id, (old_status, new_status) in changes.items():
+        old_status = status_change.pop(deployment_id, (old_status, None))[0]
+        if old_status != new_status:
+            status_change[deployment_id] = (old_status, new_status)
+
+def schedule_intents(intents, db: Session):
+    """
+    To schedule intents in one transaction, one batch pass per cluster for the new deployments after the
+    completions. A deployment both created and completed within the tick is completed without being scheduled.
+    Returns the status changes to publish by cluster, and raises ClusterOutOfSync when it fails after a pass
+    """
+    creating = {deployment_id for operation, deployment_id in intents if operation == "new"}
+    completing = {deployment_id for operation, deployment_id in intents if operation == "complete"}
+    deployments = {deployment.id: deployment for deployment in db.execute(
+        select(Deployment).where(Deployment.id.in_(creating | completing))).scalars()}
+    clusters = {cluster.id: cluster for cluster in lock_clusters(
+        {deployment.cluster_id for deployment in deployments.values()}, db)}
+    ledger = CapacityLedger(clusters.values())
+
+    new_deployments = {cluster_id: [] for cluster_id in clusters}
+    events = {cluster_id: {} for cluster_id in clusters}
+    status_change = {}
+    passes_run = False
+    try:
+        for operation, deployment_id in intents:
+            deployment = deployments.get(deployment_id)
+            if deployment is None or deployment.cluster_id not in clusters or deployment.status == "Completed":
+                continue
+            if operation == "new":
+                # Scheduled already when the intent is replayed after the tick committed
+                if deployment_id not in completing and deployment.status == "Pending":
+                    new_deployments[deployment.cluster_id].append(deployment)
+            elif deployment_id in creating:
+                # Never queued, there is nothing to free
+                _merge_status_change(events[deployment.cluster_id], {deployment_id: (deployment.status, "Completed")})
+                deployment.status = "Completed"
+            else:
+                passes_run = True
+                completed, changes = complete_deployment(deployment, clusters[deployment.cluster_id], db)
+                changes = expand_group_changes(changes, db)
+                _merge_status_change(events[deployment.cluster_id], {**completed, **changes})
+                _merge_status_change(status_change, changes)
+
+        for cluster_id, cluster_deployments in new_deployments.items():
+            if not cluster_deployments:
+                continue
+            passes_run = True
+            changes = expand_group_changes(new_deploy_batch(cluster_deployments, clusters[cluster_id]), db)
+            for new_deployment in cluster_deployments:
+                if new_deployment.id in changes:
+                    new_deployment.status = changes[new_deployment.id][1]
+            _merge_status_change(events[cluster_id], {**changes, **{
+                new_deployment.id: ("Pending", new_deployment.status) for new_deployment in cluster_deployments}})
+            _merge_status_change(status_change, changes)
+
+        ledger.apply(db, status_change)
+        db.commit()
+    except Exception as error:
+        if passes_run:
+            raise ClusterOutOfSync(*clusters) from error
+        raise
+    return events
+
+def _resync_cluster(cluster_id: int, intents, redis_client):
+    """
+    To rebuild the redis queues of a cluster from the database after a failed tick, leaving out the pending
+    deployments the tick was creating: their intents schedule them again
+    """
+    creating = {deployment_id for operation, deployment_id in intents if operation == "new"}
+    with SessionLocal() as db:
+        pending = db.execute(select(Deployment.id).where(Deployment.id.in_(creating),
+                                                         Deployment.status == "Pending")).scalars().all()
+        rebuild_queues(db, redis_client, cluster_ids=[cluster_id], exclude_ids=pending)
+
+def reconcile_once(redis_client=None):
+    """
+    To run one tick if this worker is the reconciler: claim the queued intents and schedule them in one transaction
+    per cluster. Returns the number of intents done, the ones of a failed cluster being requeued
+    """
+    if redis_client is None:
+        redis_client = get_redis_client()
+    if not _lead(redis_client):
+        return 0
+    entries = _claim_intents(redis_client)
+    if not entries:
+        return 0
+    intents = {entry: _parse_intent(entry) for entry in entries}
+    with SessionLocal() as db:
+        cluster_of = dict(db.execute(select(Deployment.id, Deployment.cluster_id).where(
+            Deployment.id.in_({deployment_id for _, deployment_id in intents.values()}))).all())
+    cluster_entries = {}
+    for entry, (_, deployment_id) in intents.items():
+        cluster_entries.setdefault(cluster_of.get(deployment_id), []).append(entry)
+    # Intents of deployments deleted since, there is nothing to schedule
+    done = cluster_entries.pop(None, [])
+    _release_intents(redis_client, done)
+
+    for cluster_id, entries in cluster_entries.items():
+        cluster_intents = [intents[entry] for entry in entries]
+        with SessionLocal() as db:
+            try:
+                events = schedule_intents(cluster_intents, db)
+            except ClusterOutOfSync:
+                db.rollback()
+                logger.exception("Failed to schedule %d intents of cluster %s after its scheduling passes, its "
+                                 "queues are rebuilt and the intents requeued", len(entries), cluster_id)
+                _resync_cluster(cluster_id, cluster_intents, redis_client)
+                _release_intents(redis_client, entries, requeue=True)
+                continue
+            except Exception:
+                db.rollback()
+                logger.exception("Failed to schedule %d intents of cluster %s, they are requeued", len(entries),
+                                 cluster_id)
+                _release_intents(redis_client, entries, requeue=True)
+                continue
+        _release_intents(redis_client, entries)
+        done += entries
+        try:
+            for event_cluster_id, cluster_events in events.items():
+                publish_status_changes(event_cluster_id, cluster_events)
+        except Exception:
+            logger.exception("Failed to publish the status changes of cluster %s", cluster_id)
+    return len(done)
+
+async def reconcile_worker():
+    """
+    To run a tick every SCHEDULING_TICK_MS until cancelled. Ticks run in a thread since the scheduler and the
+    database session are synchronous, and a tick that took longer than the interval is followed by the next at once
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        try:
+            await asyncio.to_thread(reconcile_once)
+        except Exception:
+            logger.exception("Scheduling tick failed")
+        await asyncio.sleep(max(SCHEDULING_TICK_MS / 1000 - (loop.time() - started), 0))
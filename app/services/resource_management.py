@@ -1,33 +1,107 @@
+import logging
+
+from fastapi import HTTPException
+from sqlalchemy import update, case, and_, or_
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
 from app.db.db_schema import Cluster, Deployment
+from app.utils import update_status_in_db
+from app.services import placement
+from app.services.resources import AVAILABLE, demand_of, available_of, fits
+
+logger = logging.getLogger(__name__)
+
+
+def fitting(deployments, available):
+    """
+    To get the deployments of a candidate set whose demand fits the available vector, in order
+    """
+    return [deployment for deployment in deployments if fits(demand_of(deployment), available)]
+
+def _set_available(cluster: Cluster, available):
+    for attribute, amount in zip(AVAILABLE, available):
+        setattr(cluster, attribute, amount)
 
 def check_resource_availability(cluster: Cluster, deployment: Deployment):
     """
     Check if the cluster has sufficient resources for the deployment
     """
-    if (cluster.available_ram >= deployment.ram_required and
-        cluster.available_cpu >= deployment.cpu_required and
-        cluster.available_gpu >= deployment.gpu_required):
-        return True
-    return False
+    return fits(demand_of(deployment), available_of(cluster))
 
 def allocate_resources(cluster: Cluster, deployment: Deployment):
     """
     Allocates resources for a deployment and updates the cluster's resource availability.
     """
-    cluster.available_ram -= deployment.ram_required
-    cluster.available_cpu -= deployment.cpu_required
-    cluster.available_gpu -= deployment.gpu_required
-
+    _set_available(cluster, [free - needed for free, needed in zip(available_of(cluster), demand_of(deployment))])
     deployment.status = "Running"
-
-    print(f"Resources allocated for deployment {deployment.id} on cluster {cluster.id}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Resources allocated for deployment %s on cluster %s", deployment.id, cluster.id,
+                     extra={"deployment_id": deployment.id, "cluster_id": cluster.id})
 
 def free_resources(cluster: Cluster, deployment: Deployment):
     """
     Free resources for a deployment and updates the cluster's resource availability.
     """
-    cluster.available_ram += deployment.ram_required
-    cluster.available_cpu += deployment.cpu_required
-    cluster.available_gpu += deployment.gpu_required
+    _set_available(cluster, [free + needed for free, needed in zip(available_of(cluster), demand_of(deployment))])
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Resources freed by deployment %s on cluster %s", deployment.id, cluster.id,
+                     extra={"deployment_id": deployment.id, "cluster_id": cluster.id})
+
+
+class CapacityLedger:
+    """
+    The capacity changes of one scheduling decision. The ledger is opened on the clusters of the decision before it
+    is taken and records their available resources and version. The scheduler then allocates and frees resources on
+    the cluster objects as usual, and apply adds the resulting deltas of every cluster in one UPDATE, conditioned on
+    the version read, in the transaction of the status updates. Clusters are never written back from the objects, so
+    a cluster changed meanwhile is detected instead of overwritten
+    """
+    __slots__ = ("_opening",)
+
+    def __init__(self, clusters):
+        self._opening = {cluster.id: (cluster, cluster.version, available_of(cluster)) for cluster in clusters}
+
+    def deltas(self):
+        """
+        To get the (cpu, ram, gpu) delta of every cluster whose available resources changed since the ledger opened
+        """
+        deltas = {}
+        for cluster_id, (cluster, _, opening) in self._opening.items():
+            delta = tuple(now - before for now, before in zip(available_of(cluster), opening))
+            if any(delta):
+                deltas[cluster_id] = delta
+        return deltas
+
+    def apply(self, db: Session, status_change: dict):
+        """
+        To write the status changes and the capacity deltas of the decision. Raises a 409 when a cluster was changed
+        by someone else since the ledger opened, the caller rolls back the transaction
+        """
+        update_status_in_db(status_change, db)
+        deltas = self.deltas()
+        if deltas:
+            self._write_deltas(db, deltas)
+        for cluster_id, (cluster, _, _) in self._opening.items():
+            placement.update_cluster(cluster_id, available_of(cluster))
+
+    def _write_deltas(self, db: Session, deltas: dict):
+        """
+        To add the capacity deltas of every cluster in one UPDATE conditioned on the versions read
+        """
+        values = {attribute: getattr(Cluster, attribute) + case(
+            {cluster_id: cluster_delta[index] for cluster_id, cluster_delta in deltas.items()}, value=Cluster.id,
+            else_=0) for index, attribute in enumerate(AVAILABLE)}
+        read_versions = or_(*(and_(Cluster.id == cluster_id, Cluster.version == self._opening[cluster_id][1])
+                              for cluster_id in deltas))
+        result = db.execute(update(Cluster).where(read_versions).values(**values, version=Cluster.version + 1),
+                            execution_options={"synchronize_session": False})
+        if result.rowcount != len(deltas):
+            raise HTTPException(status_code=409, detail="Cluster capacity changed concurrently, retry the request")
+
+        # The objects already hold the new resources, record them as persisted so the session does not write them
+        for cluster_id in deltas:
+            cluster, version, _ = self._opening[cluster_id]
+            for attribute in AVAILABLE:
+                set_committed_value(cluster, attribute, getattr(cluster, attribute))
+            set_committed_value(cluster, "version", version + 1)
 
-    print(f"Resources free on cluster {cluster.id} of deployment {deployment.id}")
\ No newline at end of file
@@ -0,0 +1,20 @@
+from operator import attrgetter
+
+# Dimensions of the resource vectors, in order. A deployment requires <resource>_required of each and a cluster has
+# total_<resource> and available_<resource>
+RESOURCES = ("cpu", "ram", "gpu")
+REQUIRED = tuple(f"{resource}_required" for resource in RESOURCES)
+TOTAL = tuple(f"total_{resource}" for resource in RESOURCES)
+AVAILABLE = tuple(f"available_{resource}" for resource in RESOURCES)
+# Resource vector required by a deployment and held or available on a cluster, as tuples read in one call
+# (attrgetter of more than one attribute returns a tuple)
+demand_of = attrgetter(*REQUIRED)
+total_of = attrgetter(*TOTAL)
+available_of = attrgetter(*AVAILABLE)
+
+
+def fits(demand, available):
+    """
+    To check that every resource of a demand vector fits in an available vector
+    """
+    return all(needed <= free for needed, free in zip(demand, available))
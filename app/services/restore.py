@@ -0,0 +1,181 @@
+"""
+Bulk import of deployments and rebuild of the scheduler queues from the database.
+
+    python -m app.services.restore import deployments.ndjson
+    python -m app.services.restore rebuild
+
+import reads newline delimited json deployments, as written by GET /deployments/export/, inserts them in batches and
+rebuilds the queues. rebuild recomputes the available resources of every cluster from its running deployments and
+rewrites the redis queues of every cluster from the deployments table, e.g. after redis was flushed. Both stream the
+rows, so memory stays bounded whatever the number of deployments. Run them while no deployment is being scheduled,
+and restart the application afterwards with the memory scheduler engine.
+"""
+import argparse
+import json
+import sys
+
+from sqlalchemy import insert, select, update, func
+from sqlalchemy.orm import Session
+
+from app.db.base import SessionLocal
+from app.db.db_schema import Deployment, Cluster
+from app.db.redis_client import get_redis_client
+from app.services import scheduler, memory_scheduler
+from app.services.resources import REQUIRED, TOTAL, AVAILABLE
+
+# Deployments inserted per INSERT statement, and written to redis per pipeline while rebuilding the queues
+RESTORE_BATCH_SIZE = 1000
+# Fields of an imported deployment, the id is optional and kept when given
+IMPORT_FIELDS = ("name", "image_path", "cpu_required", "ram_required", "gpu_required", "priority", "cluster_id")
+
+
+def _import_row(line_number: int, line: str):
+    """
+    To get the insert values of the deployment on one line of the import
+    """
+    record = json.loads(line)
+    missing = [field for field in IMPORT_FIELDS if record.get(field) is None]
+    if missing:
+        raise ValueError(f"Line {line_number}: missing {', '.join(missing)}")
+    row = {field: record[field] for field in IMPORT_FIELDS}
+    row["status"] = record.get("status") or "Pending"
+    row["group_id"] = record.get("group_id")
+    if record.get("id") is not None:
+        row["id"] = record["id"]
+    return row
+
+def import_deployments(lines, db: Session):
+    """
+    To insert the deployments of newline delimited json lines in batches of RESTORE_BATCH_SIZE rows, committing every
+    batch. A batch is one executemany of insert(), which SQLAlchemy sends as multi-row INSERT ... VALUES statements
+    without compiling a statement per batch. Rows with and without an id go to separate batches since every row of
+    one INSERT must have the same columns. On PostgreSQL the id sequence is moved past the largest id once rows
+    kept their ids, so the deployments created afterwards do not reuse them. Returns the number of imported
+    deployments
+    """
+    imported, batch, kept_ids = 0, [], False
+
+    def flush():
+        db.execute(insert(Deployment), batch)
+        db.commit()
+        batch.clear()
+
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        row = _import_row(line_number, line)
+        if batch and (len(batch) == RESTORE_BATCH_SIZE or ("id" in row) != ("id" in batch[0])):
+            flush()
+        batch.append(row)
+        imported += 1
+        kept_ids = kept_ids or "id" in row
+    if batch:
+        flush()
+    if kept_ids and db.get_bind().dialect.name == "postgresql":
+        db.execute(select(func.setval(func.pg_get_serial_sequence(Deployment.__tablename__, "id"),
+                                      select(func.max(Deployment.id)).scalar_subquery())))
+        db.commit()
+    return imported
+
+def recompute_available_resources(db: Session):
+    """
+    To set the available resources of every cluster to its total resources less the demand of its running
+    deployments, in one UPDATE computed by the database. The version of every cluster is bumped, so a scheduling
+    decision taken on the resources read before fails instead of applying its deltas on top
+    """
+    values = {}
+    for required, total, available in zip(REQUIRED, TOTAL, AVAILABLE):
+        running_demand = (select(func.coalesce(func.sum(getattr(Deployment, required)), 0))
+                          .where(Deployment.cluster_id == Cluster.id, Deployment.status == "Running")
+                          .scalar_subquery())
+        values[available] = getattr(Cluster, total) - running_demand
+    db.execute(update(Cluster).values(**values, version=Cluster.version + 1))
+    db.commit()
+
+def _clear_cluster_queues(redis_client, cluster_ids):
+    """
+    To delete every queue, demand index, bucket and record of the clusters. The bucket keys of all the clusters are
+    found by one scan of the keyspace, and deleted RESTORE_BATCH_SIZE keys per DELETE
+    """
+    queues = (scheduler.RUNNING_QUEUE, scheduler.PENDING_QUEUE, scheduler.PENDING_BUCKETS,
+              scheduler.DEPLOYMENT_RECORDS) + scheduler.PENDING_DEMAND_QUEUES
+    tags = {scheduler._cluster_key("", cluster_id) for cluster_id in cluster_ids}
+    keys = [scheduler._cluster_key(queue, cluster_id) for cluster_id in cluster_ids for queue in queues]
+    for key in redis_client.scan_iter(match=f"{scheduler.PENDING_BUCKET}_*", count=RESTORE_BATCH_SIZE):
+        key = key.decode() if isinstance(key, bytes) else key
+        if key[key.rindex(":"):] in tags:
+            keys.append(key)
+    for start in range(0, len(keys), RESTORE_BATCH_SIZE):
+        redis_client.delete(*keys[start:start + RESTORE_BATCH_SIZE])
+
+def rebuild_queues(db: Session, redis_client=None, cluster_ids=None, exclude_ids=()):
+    """
+    To rebuild the redis queues of every cluster, or of the given ones, from the deployments table: the queues of the
+    clusters are cleared, then their running and pending deployments, but the excluded ones, are read through a
+    server side cursor and written to the queues of their cluster, one pipeline per RESTORE_BATCH_SIZE deployments.
+    The members of a group are summed up into the one deployment the group is queued as (see groups.queued_group).
+    The decisions of the memory scheduler engine are written first and its in-memory queues dropped afterwards, to
+    be loaded again from the rebuilt ones. Returns the number of queued deployments
+    """
+    if redis_client is None:
+        redis_client = get_redis_client()
+    memory_scheduler.flush_journal()
+
+    queued_id = func.coalesce(Deployment.group_id, Deployment.id)
+    conditions = [Deployment.status.in_(("Running", "Pending")), queued_id.not_in(exclude_ids)]
+    if cluster_ids is None:
+        cluster_ids = db.execute(select(Cluster.id)).scalars().all()
+    else:
+        conditions.append(Deployment.cluster_id.in_(cluster_ids))
+    _clear_cluster_queues(redis_client, cluster_ids)
+
+    queued = 0
+    statement = (select(queued_id, func.sum(Deployment.cpu_required), func.sum(Deployment.ram_required),
+                        func.sum(Deployment.gpu_required), func.max(Deployment.priority), func.min(Deployment.cluster_id),
+                        func.min(Deployment.status))
+                 .where(*conditions)
+                 .group_by(queued_id)
+                 .execution_options(yield_per=RESTORE_BATCH_SIZE))
+    for rows in db.execute(statement).partitions():
+        pipe = redis_client.pipeline(transaction=False)
+        for deployment_id, cpu, ram, gpu, priority, cluster_id, status in rows:
+            deployment = scheduler.QueuedDeployment(deployment_id, cpu, ram, gpu, priority, status)
+            scheduler._save_record(pipe, cluster_id, deployment)
+            if status == "Running":
+                pipe.zadd(scheduler._cluster_key(scheduler.RUNNING_QUEUE, cluster_id), {str(deployment_id): priority})
+            else:
+                scheduler._add_pending(pipe, cluster_id, deployment)
+        pipe.execute()
+        queued += len(rows)
+    db.rollback()
+    memory_scheduler.drop_cluster_queues()
+    return queued
+
+def rebuild(db: Session, redis_client=None):
+    """
+    To recompute the available resources of every cluster and rebuild the redis queues from the database
+    """
+    recompute_available_resources(db)
+    return rebuild_queues(db, redis_client)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_command = commands.add_parser("import", help="import deployments, then rebuild the queues")
+    import_command.add_argument("path", help="newline delimited json file of deployments, - for stdin")
+    commands.add_parser("rebuild", help="rebuild the queues and available resources from the database")
+    args = parser.parse_args()
+
+    with SessionLocal() as db:
+        if args.command == "import":
+            if args.path == "-":
+                print(f"Imported {import_deployments(sys.stdin, db)} deployments")
+            else:
+                with open(args.path) as lines:
+                    print(f"Imported {import_deployments(lines, db)} deployments")
+        print(f"Queued {rebuild(db)} running and pending deployments")
+
+
+if __name__ == "__main__":
+    main()
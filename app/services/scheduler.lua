@@ -0,0 +1,262 @@
+-- Atomic preempt-and-backfill pass over the queues of one cluster.
+-- Server-side version of new_deploy / complete_deploy in app/services/scheduler.py, run as a single script so the
+-- whole pass costs one round trip and cannot interleave with a pass of another API worker.
+--
+-- Only single-node Redis is supported: which bucket queues a pass touches depends on the demands it reads, so the
+-- script builds their names itself instead of receiving them in KEYS. They share the hash tag of the declared keys,
+-- but Redis Cluster and proxies only guarantee access to declared keys, so use the python or memory engine there.
+--
+-- KEYS[1]  running queue of the cluster
+-- KEYS[2]  pending queue of the cluster
+-- KEYS[3]  pending cpu demand queue of the cluster
+-- KEYS[4]  pending ram demand queue of the cluster
+-- KEYS[5]  pending gpu demand queue of the cluster
+-- KEYS[6]  pending bucket counts of the cluster, the bucket queues themselves are named
+--          PENDING_BUCKET_<bucket>:{<cluster id>} after the hash tag of KEYS[1] by the script (see bucket_queue)
+-- KEYS[7]  deployment records of the cluster
+-- ARGV[1]  "new" to deploy the given deployment, "complete" to complete it
+-- ARGV[2]  available cpu of the cluster
+-- ARGV[3]  available ram of the cluster
+-- ARGV[4]  available gpu of the cluster
+-- ARGV[5]  id of the deployment
+-- ARGV[6]  priority of the deployment
+-- ARGV[7]  packed record of the deployment (see _pack_record)
+-- ARGV[8]  status of the deployment before the pass, the queue a completed deployment is removed from
+--
+-- Returns {available cpu, available ram, available gpu, status of the deployment,
+--          id, old status, new status, ...} for every other deployment whose status changed.
+
+local running_queue = KEYS[1]
+local pending_queue = KEYS[2]
+local demand_queues = {cpu = KEYS[3], ram = KEYS[4], gpu = KEYS[5]}
+local bucket_counts = KEYS[6]
+local records = KEYS[7]
+local cluster_tag = string.match(running_queue, ':({[^}]*})$')
+local backfill_batch_size = 100
+
+local available = {cpu = tonumber(ARGV[2]), ram = tonumber(ARGV[3]), gpu = tonumber(ARGV[4])}
+local changes = {}
+local changed_ids = {}
+
+-- Little-endian unsigned 32-bit integer at the given offset of a packed record
+local function uint32(record, offset)
+    local b1, b2, b3, b4 = string.byte(record, offset, offset + 3)
+    return b1 + b2 * 256 + b3 * 65536 + b4 * 16777216
+end
+
+local function unpack_record(id, record, priority, status)
+    return {id = id, cpu = uint32(record, 1), ram = uint32(record, 5), gpu = uint32(record, 9),
+            priority = tonumber(priority), status = status}
+end
+
+local function load(id, priority, status)
+    return unpack_record(id, redis.call('HGET', records, id), priority, status)
+end
+
+local function fits(deployment)
+    return available.ram >= deployment.ram and available.cpu >= deployment.cpu and available.gpu >= deployment.gpu
+end
+
+local function allocate(deployment)
+    available.ram = available.ram - deployment.ram
+    available.cpu = available.cpu - deployment.cpu
+    available.gpu = available.gpu - deployment.gpu
+    deployment.status = 'Running'
+end
+
+local function free(deployment)
+    available.ram = available.ram + deployment.ram
+    available.cpu = available.cpu + deployment.cpu
+    available.gpu = available.gpu + deployment.gpu
+end
+
+local function update_status_change(deployment, new_status)
+    local state = changes[deployment.id]
+    if state == nil then
+        state = {deployment.status, deployment.status}
+        changes[deployment.id] = state
+        table.insert(changed_ids, deployment.id)
+    end
+    state[2] = new_status
+end
+
+local function demand_bucket(demand)
+    local bucket = 0
+    while demand >= 1 do
+        bucket = bucket + 1
+        demand = math.floor(demand / 2)
+    end
+    return bucket
+end
+
+local function pending_bucket(deployment)
+    return demand_bucket(deployment.cpu) .. '.' .. demand_bucket(deployment.ram) .. '.' .. demand_bucket(deployment.gpu)
+end
+
+local function bucket_queue(bucket)
+    return 'PENDING_BUCKET_' .. bucket .. ':' .. cluster_tag
+end
+
+local function add_pending(deployment)
+    local pending_member = deployment.id
+    local bucket = pending_bucket(deployment)
+    redis.call('ZADD', pending_queue, deployment.priority, pending_member)
+    for resource, demand_queue in pairs(demand_queues) do
+        redis.call('ZADD', demand_queue, deployment[resource], pending_member)
+    end
+    redis.call('ZADD', bucket_queue(bucket), deployment.priority, pending_member)
+    redis.call('HINCRBY', bucket_counts, bucket, 1)
+end
+
+local function remove_pending(deployment)
+    local pending_member = deployment.id
+    local bucket = pending_bucket(deployment)
+    redis.call('ZREM', pending_queue, pending_member)
+    for _, demand_queue in pairs(demand_queues) do
+        redis.call('ZREM', demand_queue, pending_member)
+    end
+    redis.call('ZREM', bucket_queue(bucket), pending_member)
+    redis.call('HINCRBY', bucket_counts, bucket, -1)
+end
+
+local function can_fit_any_pending()
+    for resource, demand_queue in pairs(demand_queues) do
+        local smallest = redis.call('ZRANGE', demand_queue, 0, 0, 'WITHSCORES')
+        if #smallest == 0 or available[resource] < tonumber(smallest[2]) then
+            return false
+        end
+    end
+    return true
+end
+
+local function bucket_bound(bucket)
+    if bucket == 0 then
+        return 0, 0
+    end
+    return 2 ^ (bucket - 1), 2 ^ bucket - 1
+end
+
+-- Highest priority pending deployment that fits, see _find_best_fit_pending
+local function find_best_fit_pending()
+    if not can_fit_any_pending() then
+        return nil
+    end
+
+    local best_member, best_priority
+    local straddling = {}
+    local buckets = redis.call('HGETALL', bucket_counts)
+    for index = 1, #buckets, 2 do
+        if tonumber(buckets[index + 1]) > 0 then
+            local cpu_bucket, ram_bucket, gpu_bucket = string.match(buckets[index], '^(%d+)%.(%d+)%.(%d+)$')
+            local smallest_cpu, largest_cpu = bucket_bound(tonumber(cpu_bucket))
+            local smallest_ram, largest_ram = bucket_bound(tonumber(ram_bucket))
+            local smallest_gpu, largest_gpu = bucket_bound(tonumber(gpu_bucket))
+            if fits({cpu = smallest_cpu, ram = smallest_ram, gpu = smallest_gpu}) then
+                if fits({cpu = largest_cpu, ram = largest_ram, gpu = largest_gpu}) then
+                    local head = redis.call('ZREVRANGE', bucket_queue(buckets[index]), 0, 0, 'WITHSCORES')
+                    if #head > 0 and (best_priority == nil or tonumber(head[2]) > best_priority) then
+                        best_member, best_priority = head[1], tonumber(head[2])
+                    end
+                else
+                    table.insert(straddling, bucket_queue(buckets[index]))
+                end
+            end
+        end
+    end
+
+    for _, queue in ipairs(straddling) do
+        local start, done = 0, false
+        while not done do
+            local pending = redis.call('ZREVRANGE', queue, start, start + backfill_batch_size - 1, 'WITHSCORES')
+            done = #pending < 2 * backfill_batch_size
+            for index = 1, #pending, 2 do
+                local priority = tonumber(pending[index + 1])
+                if best_priority ~= nil and priority < best_priority then
+                    done = true
+                    break
+                end
+                if fits(load(pending[index], priority, 'Pending')) then
+                    best_member, best_priority = pending[index], priority
+                    done = true
+                    break
+                end
+            end
+            start = start + backfill_batch_size
+        end
+    end
+
+    if best_member == nil then
+        return nil
+    end
+    return load(best_member, best_priority, 'Pending')
+end
+
+local function deploy_pending_resource()
+    while true do
+        local pending_deployment = find_best_fit_pending()
+        if pending_deployment == nil then
+            break
+        end
+        remove_pending(pending_deployment)
+        update_status_change(pending_deployment, 'Running')
+        allocate(pending_deployment)
+        redis.call('ZADD', running_queue, pending_deployment.priority, pending_deployment.id)
+    end
+end
+
+local deployment
+if ARGV[1] == 'new' then
+    deployment = unpack_record(ARGV[5], ARGV[7], ARGV[6], 'Pending')
+    redis.call('HSET', records, deployment.id, ARGV[7])
+    if fits(deployment) then
+        allocate(deployment)
+        redis.call('ZADD', running_queue, deployment.priority, deployment.id)
+    else
+        while true do
+            local lowest = redis.call('ZRANGE', running_queue, 0, 0, 'WITHSCORES')
+            if #lowest == 0 then
+                break
+            end
+            if tonumber(lowest[2]) > deployment.priority then
+                add_pending(deployment)
+                break
+            end
+
+            redis.call('ZREM', running_queue, lowest[1])
+            local running_deployment = load(lowest[1], lowest[2], 'Running')
+            free(running_deployment)
+            update_status_change(running_deployment, 'Pending')
+            running_deployment.status = 'Pending'
+            add_pending(running_deployment)
+
+            if fits(deployment) then
+                allocate(deployment)
+                redis.call('ZADD', running_queue, deployment.priority, deployment.id)
+                break
+            end
+        end
+        deploy_pending_resource()
+    end
+else
+    deployment = unpack_record(ARGV[5], ARGV[7], ARGV[6], 'Completed')
+    if ARGV[8] == 'Running' then
+        redis.call('ZREM', running_queue, deployment.id)
+        redis.call('HDEL', records, deployment.id)
+        free(deployment)
+        deploy_pending_resource()
+    elseif ARGV[8] == 'Pending' then
+        remove_pending(deployment)
+        redis.call('HDEL', records, deployment.id)
+    end
+end
+
+local result = {available.cpu, available.ram, available.gpu, deployment.status}
+for _, id in ipairs(changed_ids) do
+    local state = changes[id]
+    if state[1] ~= state[2] then
+        table.insert(result, id)
+        table.insert(result, state[1])
+        table.insert(result, state[2])
+    end
+end
+return result
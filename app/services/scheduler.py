@@ -1,53 +1,247 @@
+import heapq
 import os
+import struct
 
 import redis
-from app.services.resource_management import check_resource_availability, allocate_resources, free_resources
+from fastapi import HTTPException
+
+from app.db.redis_client import get_redis_client
+from app.services.resource_management import (check_resource_availability, allocate_resources, free_resources,
+                                              fitting)
+from app.services.resources import RESOURCES, demand_of, available_of, fits
+from app.services import preemption
 from app.db.db_schema import Deployment, Cluster
 
+# Queues hold deployment ids scored by priority, the resources of each queued deployment live in DEPLOYMENT_RECORDS
+RUNNING_QUEUE = "RUNNING_QUEUE"
+PENDING_QUEUE = "PENDING_QUEUE"
+DEPLOYMENT_RECORDS = "DEPLOYMENT_RECORDS"
+# Pending deployments scored by their demand of each resource, to find the smallest pending request cheaply
+PENDING_DEMAND_QUEUES = tuple(f"PENDING_{resource.upper()}_DEMAND" for resource in RESOURCES)
+# Secondary index of pending deployments bucketed by demand: PENDING_BUCKET_<cpu>.<ram>.<gpu> sorted sets scored by
+# priority, and a PENDING_BUCKETS hash counting the members of every bucket (see _demand_bucket)
+PENDING_BUCKET = "PENDING_BUCKET"
+PENDING_BUCKETS = "PENDING_BUCKETS"
+# Pre per-cluster layout, where backfill rebuilt the pending queue into the other one of the pair on every pass
+LEGACY_PENDING_QUEUES = ("PENDING_QUEUE_1", "PENDING_QUEUE_2")
+# Number of pending deployments read per round trip while backfilling
+BACKFILL_BATCH_SIZE = 100
+# Number of times a scheduling pass is planned again when the queues change underneath it before giving up
+SCHEDULER_MAX_RETRIES = int(os.environ.get("SCHEDULER_MAX_RETRIES", 5))
+
+# "python" runs the scheduling pass client side, "lua" runs it as one atomic script inside redis, "memory" decides on
+# queues kept in the process and journals every decision to redis in the background (see memory_scheduler)
+SCHEDULER_ENGINE = os.environ.get("SCHEDULER_ENGINE", "python")
+
+with open(os.path.join(os.path.dirname(__file__), "scheduler.lua")) as script_file:
+    _SCHEDULING_SCRIPT_SOURCE = script_file.read()
+_scheduling_script = None
+
+# Record of a queued deployment: its demand of every resource as little-endian unsigned 32-bit integers
+_RECORD = struct.Struct("<" + "I" * len(RESOURCES))
+assert RESOURCES == ("cpu", "ram", "gpu"), "QueuedDeployment and scheduler.lua only schedule cpu, ram and gpu"
 
-def _make_key(deployment: Deployment):
+
+class QueuedDeployment:
     """
-    Create a key to store deployment information in redis sorted set
+    The part of a deployment the scheduler works with, rebuilt from its queue entry and record. It has the same
+    attribute names as the Deployment model, so both can be passed to the resource management functions
     """
-    return (f"{deployment.id}|{deployment.image_path}|{deployment.cpu_required}|{deployment.ram_required}|"
-            f"{deployment.gpu_required}|{deployment.priority}|{deployment.cluster_id}|{deployment.status}|"
-            f"{deployment.name}")
+    __slots__ = ("id", "cpu_required", "ram_required", "gpu_required", "priority", "status")
+
+    def __init__(self, id: int, cpu_required: int, ram_required: int, gpu_required: int, priority: int, status: str):
+        self.id = id
+        self.cpu_required = cpu_required
+        self.ram_required = ram_required
+        self.gpu_required = gpu_required
+        self.priority = priority
+        self.status = status
 
-def _from_key(key: str):
+
+def _pack_record(deployment):
     """
-    Create deployment object based on db schema from the value stored in redis sorted set
+    Create the packed record of the deployment's resource demand stored in redis
     """
-    key = key.split('|')
-    return Deployment(
-        id=int(key[0]),
-        image_path=key[1],
-        cpu_required=int(key[2]),
-        ram_required = int(key[3]),
-        gpu_required = int(key[4]),
-        priority = int(key[5]),
-        cluster_id = int(key[6]),
-        status = key[7],
-        name=key[8]
-    )
+    return _RECORD.pack(*demand_of(deployment))
 
-def _get_redis_info():
+def _unpack_record(deployment_id, record: bytes, priority, status: str):
     """
-    To create a redis connection and required pending queue and running queue information
+    Create the queued deployment from its id, packed record and priority (the score of its queue entry)
     """
-    host = os.environ.get('REDIS_HOST', 'localhost')
-    port = int(os.environ.get('REDIS_PORT', '6379'))
-    redis_db_index = int(os.environ.get('REDIS_DATABASE_INDEX', '0'))
-    redis_client = redis.StrictRedis(host=host, port=port, db=redis_db_index, decode_responses=True)
+    cpu_required, ram_required, gpu_required = _RECORD.unpack(record)
+    return QueuedDeployment(int(deployment_id), cpu_required, ram_required, gpu_required, int(priority), status)
 
-    if redis_client.zcard("PENDING_QUEUE_1"):
-        pending_queue = "PENDING_QUEUE_1"
-        temp_queue = "PENDING_QUEUE_2"
-    else:
-        pending_queue = "PENDING_QUEUE_2"
-        temp_queue = "PENDING_QUEUE_1"
-    running_queue = "RUNNING_QUEUE"
+def _parse_legacy_member(member):
+    """
+    Create the queued deployment and its cluster id from a legacy
+    id|image_path|cpu|ram|gpu|priority|cluster|status|name queue member
+    """
+    fields = _as_str(member).split('|')
+    deployment = QueuedDeployment(int(fields[0]), int(fields[2]), int(fields[3]), int(fields[4]), int(fields[5]),
+                                  fields[7])
+    return deployment, int(fields[6])
+
+def _as_str(value):
+    """
+    To read a string reply of redis whether or not the client decodes responses
+    """
+    return value.decode() if isinstance(value, bytes) else value
+
+def _cluster_key(queue_name: str, cluster_id: int):
+    """
+    Create the per-cluster redis key of a queue. The cluster id is wrapped in a hash tag ({...}) so that all the
+    queues of one cluster land on the same slot when redis runs in cluster mode
+    """
+    return f"{queue_name}:{{{cluster_id}}}"
+
+def _get_redis_info(cluster_id: int):
+    """
+    To get a redis client and required pending queue and running queue information of the given cluster.
+    Every cluster has its own queues, so scheduling one cluster never reads or preempts another cluster's
+    deployments and independent clusters can be scheduled in parallel
+    """
+    redis_client = get_redis_client()
+    pending_queue = _cluster_key(PENDING_QUEUE, cluster_id)
+    running_queue = _cluster_key(RUNNING_QUEUE, cluster_id)
 
-    return redis_client, pending_queue, running_queue, temp_queue
+    return redis_client, pending_queue, running_queue
+
+def _demand_bucket(demand: int):
+    """
+    Bucket of a resource demand on a power of two scale: bucket 0 holds zero demands and bucket b > 0 holds demands
+    from 2 ** (b - 1) to 2 ** b - 1
+    """
+    return max(int(demand), 0).bit_length()
+
+def _bucket_bounds(bucket: str):
+    """
+    To get the smallest and largest (cpu, ram, gpu) demand a deployment of the given bucket can have
+    """
+    buckets = [int(resource_bucket) for resource_bucket in bucket.split('.')]
+    smallest = tuple(1 << (resource_bucket - 1) if resource_bucket else 0 for resource_bucket in buckets)
+    largest = tuple((1 << resource_bucket) - 1 for resource_bucket in buckets)
+    return smallest, largest
+
+def _pending_bucket(deployment):
+    """
+    To get the bucket of the pending index a deployment belongs to
+    """
+    return '.'.join(str(_demand_bucket(demand)) for demand in demand_of(deployment))
+
+def _save_record(pipe, cluster_id: int, deployment):
+    """
+    To store the packed record of a deployment entering the queues of the cluster
+    """
+    pipe.hset(_cluster_key(DEPLOYMENT_RECORDS, cluster_id), str(deployment.id), _pack_record(deployment))
+
+def _add_pending(pipe, cluster_id: int, deployment):
+    """
+    To add a deployment to the pending queue of the cluster along with its resource demands and bucket index entry
+    """
+    member = str(deployment.id)
+    pipe.zadd(_cluster_key(PENDING_QUEUE, cluster_id), {member: deployment.priority})
+    for demand_queue, demand in zip(PENDING_DEMAND_QUEUES, demand_of(deployment)):
+        pipe.zadd(_cluster_key(demand_queue, cluster_id), {member: demand})
+    bucket = _pending_bucket(deployment)
+    pipe.zadd(_cluster_key(f"{PENDING_BUCKET}_{bucket}", cluster_id), {member: deployment.priority})
+    pipe.hincrby(_cluster_key(PENDING_BUCKETS, cluster_id), bucket, 1)
+
+def _remove_pending(pipe, cluster_id: int, deployment):
+    """
+    To remove a deployment from the pending queue of the cluster along with its resource demands and bucket index entry
+    """
+    member = str(deployment.id)
+    for queue in (PENDING_QUEUE,) + PENDING_DEMAND_QUEUES:
+        pipe.zrem(_cluster_key(queue, cluster_id), member)
+    bucket = _pending_bucket(deployment)
+    pipe.zrem(_cluster_key(f"{PENDING_BUCKET}_{bucket}", cluster_id), member)
+    pipe.hincrby(_cluster_key(PENDING_BUCKETS, cluster_id), bucket, -1)
+
+def _load_deployments(redis_client, cluster_id: int, entries, status: str):
+    """
+    To rebuild queued deployments of the cluster from (id, priority) queue entries, reading all their records
+    in one round trip
+    """
+    if not entries:
+        return []
+    records = redis_client.hmget(_cluster_key(DEPLOYMENT_RECORDS, cluster_id), [member for member, _ in entries])
+    return [_unpack_record(member, record, priority, status) for (member, priority), record in zip(entries, records)]
+
+def _legacy_queues(redis_client):
+    """
+    To find the queues still holding pipe-delimited members, as (key, is running queue, companion keys to drop)
+    tuples: the global queues, the per-cluster PENDING_QUEUE_1 / PENDING_QUEUE_2 pairs and per-cluster queues written
+    before members were reduced to deployment ids
+    """
+    queues = [(RUNNING_QUEUE, True, [])] + [(queue, False, []) for queue in LEGACY_PENDING_QUEUES]
+    queues += [(queue, False, []) for queue in redis_client.scan_iter(match="PENDING_QUEUE_[12]:*")]
+    for pattern, running in ((f"{RUNNING_QUEUE}:*", True), (f"{PENDING_QUEUE}:*", False)):
+        for queue in redis_client.scan_iter(match=pattern):
+            first_member = redis_client.zrange(queue, 0, 0)
+            if not first_member or '|' not in _as_str(first_member[0]):
+                continue
+            companions = []
+            if not running:
+                cluster_tag = _as_str(queue).split(':', 1)[1]
+                companions = [f"{demand_queue}:{cluster_tag}" for demand_queue in PENDING_DEMAND_QUEUES]
+                companions.append(f"{PENDING_BUCKETS}:{cluster_tag}")
+                companions += redis_client.scan_iter(match=f"{PENDING_BUCKET}_*:{cluster_tag}")
+            queues.append((queue, running, companions))
+    return queues
+
+def migrate_global_queues(redis_client=None):
+    """
+    Move the members of the legacy queues (see _legacy_queues) into the per-cluster queues and records, routed by the
+    cluster id stored in each member. The legacy keys are deleted, so running this more than once is a no-op.
+    Returns the number of migrated members
+    """
+    if redis_client is None:
+        redis_client = get_redis_client()
+
+    migrated = 0
+    for legacy_queue, running, companions in _legacy_queues(redis_client):
+        if not redis_client.exists(legacy_queue):
+            continue
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.delete(legacy_queue, *companions)
+        for member, _ in redis_client.zscan_iter(legacy_queue):
+            deployment, cluster_id = _parse_legacy_member(member)
+            _save_record(pipe, cluster_id, deployment)
+            if running:
+                pipe.zadd(_cluster_key(RUNNING_QUEUE, cluster_id), {str(deployment.id): deployment.priority})
+            else:
+                _add_pending(pipe, cluster_id, deployment)
+            migrated += 1
+        pipe.execute()
+
+    return migrated
+
+def _run_scheduling_script(operation: str, deployment: Deployment, cluster: Cluster):
+    """
+    To run a whole scheduling pass of the cluster atomically inside redis (see scheduler.lua), on single-node redis
+    only since the script accesses bucket queues that are not declared in its keys. The cluster's available
+    resources and the deployment's status are updated from the script result, the same way the python engine mutates
+    them, and the status_change dict is returned
+    """
+    global _scheduling_script
+    redis_client = get_redis_client()
+    if _scheduling_script is None:
+        _scheduling_script = redis_client.register_script(_SCHEDULING_SCRIPT_SOURCE)
+
+    queues = (RUNNING_QUEUE, PENDING_QUEUE) + PENDING_DEMAND_QUEUES + (PENDING_BUCKETS, DEPLOYMENT_RECORDS)
+    keys = [_cluster_key(queue, cluster.id) for queue in queues]
+    args = [operation, cluster.available_cpu, cluster.available_ram, cluster.available_gpu,
+            deployment.id, deployment.priority, _pack_record(deployment), deployment.status]
+    result = _scheduling_script(keys=keys, args=args, client=redis_client)
+
+    cluster.available_cpu, cluster.available_ram, cluster.available_gpu = (int(value) for value in result[:3])
+    deployment.status = _as_str(result[3])
+    status_change = {}
+    for index in range(4, len(result), 3):
+        status_change[int(result[index])] = (_as_str(result[index + 1]), _as_str(result[index + 2]))
+    # The script preempts greedily, every running deployment it moved to pending was preempted
+    preemption.record_preemptions(sum(change == ("Running", "Pending") for change in status_change.values()))
+    return status_change
 
 def _update_status_change(status_change, deployment, new_status):
     """
@@ -59,20 +253,221 @@ def _update_status_change(status_change, deployment, new_status):
         del status_change[deployment.id]
 
 
-def _deploy_pending_resource(redis_client, pending_queue, running_queue, temp_queue, cluster, status_change):
+def _find_best_fit_pending(redis_client, cluster: Cluster, moved: dict):
     """
-    To fill in lower priority deployment of the pending queue if possible for max utilization
+    To find the highest priority pending deployment that fits the available resources of the cluster, without walking
+    the whole pending queue. Deployments moved earlier in the pass (see _run_python_pass) are not written to redis
+    yet, so the ones moved to pending are candidates too and the ones moved out of pending are skipped.
+    In redis:
+        1. Every pending deployment needs at least the smallest pending demand of each resource, so nothing fits once
+        any available resource of the cluster is below that
+        2. Buckets whose largest demand fits the available resources fit as a whole, only their head is read
+        3. Buckets whose smallest demand does not fit are skipped
+        4. The remaining buckets straddle the available resources and are walked in priority order until a fitting
+        deployment is found or their priority drops below the best one found so far
+    Returns the pending deployment, or None if no pending deployment fits
     """
-    while redis_client.zcard(pending_queue) != 0:
-        pending_deployment_key, _ = redis_client.zpopmax(pending_queue)[0]
-        pending_deployment = _from_key(pending_deployment_key)
+    moved_out = {deployment_id for deployment_id, (_, origin) in moved.items() if origin == "Pending"}
+    available = available_of(cluster)
+    best_deployment = max(fitting((deployment for deployment, _ in moved.values() if deployment.status == "Pending"),
+                                  available), key=lambda deployment: deployment.priority, default=None)
+    best_entry = (best_deployment.id, best_deployment.priority) if best_deployment is not None else None
+
+    pipe = redis_client.pipeline(transaction=False)
+    for demand_queue in PENDING_DEMAND_QUEUES:
+        pipe.zrange(_cluster_key(demand_queue, cluster.id), 0, 0, withscores=True)
+    pipe.hgetall(_cluster_key(PENDING_BUCKETS, cluster.id))
+    *smallest_demands, bucket_counts = pipe.execute()
+    if not all(smallest_demands) or not fits([demand[0][1] for demand in smallest_demands], available):
+        return best_deployment
+
+    whole_buckets, straddling_buckets = [], []
+    for bucket, count in bucket_counts.items():
+        bucket = _as_str(bucket)
+        smallest, largest = _bucket_bounds(bucket)
+        if int(count) <= 0 or not fits(smallest, available):
+            continue
+        bucket_queue = _cluster_key(f"{PENDING_BUCKET}_{bucket}", cluster.id)
+        (whole_buckets if fits(largest, available) else straddling_buckets).append(bucket_queue)
+
+    pipe = redis_client.pipeline(transaction=False)
+    for bucket_queue in whole_buckets:
+        pipe.zrevrange(bucket_queue, 0, len(moved_out), withscores=True)
+    for head in pipe.execute():
+        head = [entry for entry in head if int(entry[0]) not in moved_out]
+        if head and (best_entry is None or head[0][1] > best_entry[1]):
+            best_entry, best_deployment = head[0], None
+
+    for bucket_queue in straddling_buckets:
+        start = 0
+        while True:
+            entries = redis_client.zrevrange(bucket_queue, start, start + BACKFILL_BATCH_SIZE - 1, withscores=True)
+            candidates = [entry for entry in entries if int(entry[0]) not in moved_out and
+                          (best_entry is None or entry[1] > best_entry[1])]
+            fitting_deployments = fitting(_load_deployments(redis_client, cluster.id, candidates, "Pending"),
+                                          available)
+            if fitting_deployments:
+                best_deployment = fitting_deployments[0]
+                best_entry = (best_deployment.id, best_deployment.priority)
+                break
+            if len(entries) < BACKFILL_BATCH_SIZE or (best_entry is not None and entries[-1][1] <= best_entry[1]):
+                break
+            start += BACKFILL_BATCH_SIZE
 
-        if check_resource_availability(cluster, pending_deployment):
-            _update_status_change(status_change, pending_deployment, "Running")
-            allocate_resources(cluster, pending_deployment)
-            redis_client.zadd(running_queue, {_make_key(pending_deployment): pending_deployment.priority})
+    if best_entry is None or best_deployment is not None:
+        return best_deployment
+    return _load_deployments(redis_client, cluster.id, [best_entry], "Pending")[0]
+
+def _move(moved: dict, deployment, new_status: str):
+    """
+    To record that the deployment changes status (and queue) during the pass, remembering its original status
+    """
+    moved.setdefault(deployment.id, (deployment, deployment.status))
+    deployment.status = new_status
+
+def _deploy_pending_resource(redis_client, cluster, status_change, moved):
+    """
+    To fill in lower priority deployment of the pending queue if possible for max utilization.
+    The highest priority pending deployment that fits is moved to the running queue until none fits anymore, which
+    places the same deployments as walking the pending queue in priority order since the free resources only shrink
+    """
+    while True:
+        pending_deployment = _find_best_fit_pending(redis_client, cluster, moved)
+        if pending_deployment is None:
+            break
+
+        _update_status_change(status_change, pending_deployment, "Running")
+        _move(moved, pending_deployment, "Running")
+        allocate_resources(cluster, pending_deployment)
+
+def _write_moves(pipe, cluster_id: int, moved: dict):
+    """
+    To queue the redis writes moving every deployment of the pass from its original queue to the queue of its
+    new status. A new deployment has no original queue and a completed one leaves the queues with its record
+    """
+    running_queue = _cluster_key(RUNNING_QUEUE, cluster_id)
+    for deployment, origin in moved.values():
+        if origin == deployment.status:
+            continue
+        if origin == "Running":
+            pipe.zrem(running_queue, str(deployment.id))
+        elif origin == "Pending":
+            _remove_pending(pipe, cluster_id, deployment)
         else:
-            redis_client.zadd(temp_queue, {_make_key(pending_deployment): pending_deployment.priority})
+            _save_record(pipe, cluster_id, deployment)
+
+        if deployment.status == "Running":
+            pipe.zadd(running_queue, {str(deployment.id): deployment.priority})
+        elif deployment.status == "Pending":
+            _add_pending(pipe, cluster_id, deployment)
+        else:
+            pipe.hdel(_cluster_key(DEPLOYMENT_RECORDS, cluster_id), str(deployment.id))
+
+def _running_by_priority(redis_client, running_queue: str, cluster_id: int, moved: dict):
+    """
+    To iterate the running deployments of the cluster from the lowest priority, as left by the deployments moved
+    earlier in the pass: the ones moved to running are included and the ones moved out of it are skipped
+    """
+    moved_ids = set(moved)
+    moved_running = sorted((deployment for deployment, _ in moved.values() if deployment.status == "Running"),
+                           key=lambda deployment: deployment.priority)
+
+    def queued_running():
+        start = 0
+        while True:
+            entries = redis_client.zrange(running_queue, start, start + BACKFILL_BATCH_SIZE - 1, withscores=True)
+            yield from _load_deployments(redis_client, cluster_id,
+                                         [entry for entry in entries if int(entry[0]) not in moved_ids], "Running")
+            if len(entries) < BACKFILL_BATCH_SIZE:
+                return
+            start += BACKFILL_BATCH_SIZE
+
+    return heapq.merge(moved_running, queued_running(), key=lambda deployment: deployment.priority)
+
+def _preempt_for(redis_client, running_queue: str, cluster: Cluster, new_deployment, status_change, moved,
+                 preempted):
+    """
+    To move lower priority running deployments to the pending queue until the new deployment fits and runs, with the
+    preemption policy (see preemption.PREEMPTION_POLICY). It must already be recorded in moved as a new deployment,
+    and the number of deployments it preempts is added to preempted
+    """
+    if preemption.PREEMPTION_POLICY == "min_cost":
+        candidates = []
+        for running_deployment in _running_by_priority(redis_client, running_queue, cluster.id, moved):
+            if (running_deployment.priority > new_deployment.priority or
+                    len(candidates) == preemption.PREEMPTION_MAX_CANDIDATES):
+                break
+            candidates.append(running_deployment)
+        victims = preemption.choose_victims(candidates, preemption.deficit(cluster, new_deployment))
+        if victims is not None:
+            for victim in victims:
+                free_resources(cluster, victim)
+                _update_status_change(status_change, victim, "Pending")
+                _move(moved, victim, "Pending")
+            allocate_resources(cluster, new_deployment)
+            preempted.append(len(victims))
+            return
+        if len(candidates) < preemption.PREEMPTION_MAX_CANDIDATES:
+            # Preempting every lower priority deployment would not make room, nothing is preempted
+            _move(moved, new_deployment, "Pending")
+            return
+
+    preempted.append(_preempt_greedy(redis_client, running_queue, cluster, new_deployment, status_change, moved))
+
+def _preempt_greedy(redis_client, running_queue: str, cluster: Cluster, new_deployment, status_change, moved):
+    """
+    To move lower priority running deployments to the pending queue, lowest first, until the new deployment fits
+    and runs. The new deployment is moved to the pending queue once a higher priority deployment is the lowest
+    running one. Returns the number of deployments preempted
+    """
+    preempted = 0
+    for running_deployment in _running_by_priority(redis_client, running_queue, cluster.id, moved):
+        if running_deployment.priority > new_deployment.priority:
+            _move(moved, new_deployment, "Pending")
+            break
+
+        free_resources(cluster, running_deployment)
+        _update_status_change(status_change, running_deployment, "Pending")
+        _move(moved, running_deployment, "Pending")
+        preempted += 1
+        if check_resource_availability(cluster, new_deployment):
+            allocate_resources(cluster, new_deployment)
+            break
+    else:
+        # Nothing left to preempt and the new deployment still does not fit, it is not queued
+        del moved[new_deployment.id]
+    return preempted
+
+def _run_python_pass(plan_pass, deployments, cluster: Cluster):
+    """
+    To run one scheduling pass of the python engine as a redis transaction. The running and pending queues of the
+    cluster are watched, plan_pass decides the whole pass from reads only while recording the deployments it moves,
+    and all the writes are then sent at once in a MULTI/EXEC block. If another worker changed the queues in the
+    meantime the transaction is discarded, the cluster and deployments are reset and the pass is planned again.
+    The preemptions of the pass are only counted once it is written, a discarded plan preempted nothing
+    """
+    redis_client, pending_queue, running_queue = _get_redis_info(cluster.id)
+    available = available_of(cluster)
+    statuses = [deployment.status for deployment in deployments]
+
+    with redis_client.pipeline(transaction=True) as pipe:
+        for _ in range(SCHEDULER_MAX_RETRIES):
+            status_change, moved, preempted = {}, {}, []
+            try:
+                pipe.watch(running_queue, pending_queue)
+                plan_pass(redis_client, running_queue, status_change, moved, preempted)
+                pipe.multi()
+                _write_moves(pipe, cluster.id, moved)
+                pipe.execute()
+                for count in preempted:
+                    preemption.record_preemptions(count)
+                return status_change
+            except redis.WatchError:
+                cluster.available_cpu, cluster.available_ram, cluster.available_gpu = available
+                for deployment, status in zip(deployments, statuses):
+                    deployment.status = status
+
+    raise HTTPException(status_code=409, detail="Cluster queues kept changing during scheduling, please retry")
 
 def new_deploy(new_deployment: Deployment, cluster: Cluster):
     """
@@ -86,56 +481,91 @@ def new_deploy(new_deployment: Deployment, cluster: Cluster):
         4. If not lower priority left, then add this to pending queue and check the pending queue to fill other
         possible deployments (_deploy_pending_resource takes care of this)
         5. Return a dict of status_change containing deployment ids which have change of the course of preempting
+    All the queue changes of the pass are written in one transaction (see _run_python_pass).
+    With SCHEDULER_ENGINE set to "lua" the same algorithm runs atomically inside redis, with "memory" it runs on the
+    in-memory queues of memory_scheduler
     """
-    status_change = {}
-    redis_client, pending_queue, running_queue, temp_queue = _get_redis_info()
+    if SCHEDULER_ENGINE == "lua":
+        return _run_scheduling_script("new", new_deployment, cluster)
+    if SCHEDULER_ENGINE == "memory":
+        from app.services import memory_scheduler
+        return memory_scheduler.new_deploy(new_deployment, cluster)
 
-    if check_resource_availability(cluster, new_deployment):
-        allocate_resources(cluster, new_deployment)
-        redis_client.zadd(running_queue, {_make_key(new_deployment): new_deployment.priority})
-        return status_change
+    def plan_pass(redis_client, running_queue, status_change, moved, preempted):
+        moved[new_deployment.id] = (new_deployment, None)
+        if check_resource_availability(cluster, new_deployment):
+            allocate_resources(cluster, new_deployment)
+            return
 
-    while redis_client.zcard(running_queue) != 0:
-        running_deployment_key, running_priority = redis_client.zpopmin(running_queue)[0]
+        _preempt_for(redis_client, running_queue, cluster, new_deployment, status_change, moved, preempted)
+        _deploy_pending_resource(redis_client, cluster, status_change, moved)
 
-        if running_priority > new_deployment.priority:
-            redis_client.zadd(running_queue, {running_deployment_key: running_priority})
-            redis_client.zadd(pending_queue, {_make_key(new_deployment): new_deployment.priority})
-            break
+    return _run_python_pass(plan_pass, [new_deployment], cluster)
 
-        running_deployment = _from_key(running_deployment_key)
-        free_resources(cluster, running_deployment)
-        _update_status_change(status_change, running_deployment, "Pending")
-        running_deployment.status = "Pending"
-        redis_client.zadd(pending_queue, {_make_key(running_deployment): running_deployment.priority})
 
-        if check_resource_availability(cluster, new_deployment):
-            allocate_resources(cluster, new_deployment)
-            redis_client.zadd(running_queue, {_make_key(new_deployment): new_deployment.priority})
-            break
-
-    _deploy_pending_resource(redis_client, pending_queue, running_queue, temp_queue, cluster, status_change)
+def new_deploy_batch(new_deployments, cluster: Cluster):
+    """
+    To deploy many new deployments of one cluster in a single scheduling pass
+    Algorithm:
+        1. The new deployments are placed from the highest priority, each one running if it fits, preempting lower
+        priority running deployments (not higher priority new ones) or going to the pending queue like in new_deploy
+        2. The pending queue is checked once for the whole batch to fill other possible deployments
+        3. Return a dict of status_change containing the ids of the deployments already queued whose status changed,
+        and of new deployments started by the backfill
+    With SCHEDULER_ENGINE set to "lua" the deployments are placed by one script run each, highest priority first
+    """
+    new_deployments = sorted(new_deployments, key=lambda deployment: deployment.priority, reverse=True)
+    if SCHEDULER_ENGINE == "lua":
+        status_change = {}
+        for new_deployment in new_deployments:
+            for deployment_id, (old_status, new_status) in new_deploy(new_deployment, cluster).items():
+                old_status = status_change.get(deployment_id, (old_status, None))[0]
+                status_change.pop(deployment_id, None)
+                if old_status != new_status:
+                    status_change[deployment_id] = (old_status, new_status)
+        return status_change
+    if SCHEDULER_ENGINE == "memory":
+        from app.services import memory_scheduler
+        return memory_scheduler.new_deploy_batch(new_deployments, cluster)
 
-    return status_change
+    def plan_pass(redis_client, running_queue, status_change, moved, preempted):
+        for new_deployment in new_deployments:
+            moved[new_deployment.id] = (new_deployment, None)
+            if check_resource_availability(cluster, new_deployment):
+                allocate_resources(cluster, new_deployment)
+            else:
+                _preempt_for(redis_client, running_queue, cluster, new_deployment, status_change, moved, preempted)
+        _deploy_pending_resource(redis_client, cluster, status_change, moved)
 
+    return _run_python_pass(plan_pass, new_deployments, cluster)
 
 def complete_deploy(deployment: Deployment, cluster: Cluster):
     """
-    To remove running deployment from running queue and mark it as complete
+    To remove a deployment from the queue of its status and mark it as complete
     Algorithm:
-        1. Remove the deployment from running queue and free resources from the cluster related to it
+        1. Remove the deployment from its queue, and free resources from the cluster related to it if it was running
+        (a pending deployment holds none, the pass ends there)
         2. Check any lower priority deployments from the pending queue to fill other possible
         deployments (_deploy_pending_resource takes care of this)
         3. Return a dict of status_change containing deployment ids which have changed from pending to running
+    All the queue changes of the pass are written in one transaction (see _run_python_pass).
+    With SCHEDULER_ENGINE set to "lua" the same algorithm runs atomically inside redis, with "memory" it runs on the
+    in-memory queues of memory_scheduler
     """
-    status_change = {}
-    redis_client, pending_queue, running_queue, temp_queue = _get_redis_info()
-
-    redis_client.zrem(running_queue, _make_key(deployment))
-    deployment.status = 'Completed'
+    if SCHEDULER_ENGINE == "lua":
+        return _run_scheduling_script("complete", deployment, cluster)
+    if SCHEDULER_ENGINE == "memory":
+        from app.services import memory_scheduler
+        return memory_scheduler.complete_deploy(deployment, cluster)
 
-    free_resources(cluster, deployment)
+    origin = deployment.status
 
-    _deploy_pending_resource(redis_client, pending_queue, running_queue, temp_queue, cluster, status_change)
+    def plan_pass(redis_client, running_queue, status_change, moved, preempted):
+        moved[deployment.id] = (deployment, origin)
+        deployment.status = 'Completed'
+        # Only a running deployment holds resources, a pending one just leaves the pending queue
+        if origin == "Running":
+            free_resources(cluster, deployment)
+            _deploy_pending_resource(redis_client, cluster, status_change, moved)
 
-    return status_change
+    return _run_python_pass(plan_pass, [deployment], cluster)
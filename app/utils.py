@@ -1,22 +1,156 @@
-from fastapi import HTTPException
+import base64
+import json
+import logging
+import zlib
+from typing import Optional
+from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
 from app.db import db_schema
+from app.db.base import async_session
+from sqlalchemy import select, update, false
 from sqlalchemy.orm import Session
 from app.schemas.deployment import DeploymentCreate
+from app.services.placement import place_deployment
 
-def validate_deployment_details(deployment: DeploymentCreate, db: Session):
-    cluster = db.query(db_schema.Cluster).filter(db_schema.Cluster.id == deployment.cluster_id).first()
+logger = logging.getLogger(__name__)
+
+# Rows fetched from the database cursor, serialized and sent per chunk of an export
+EXPORT_BATCH_SIZE = 1000
+
+def begin_write(db: Session):
+    """
+    To start the transaction of the session as a write transaction. SQLite has no row locks and ignores FOR UPDATE,
+    so an update matching no row takes the database write lock up front instead: concurrent writers wait for this
+    transaction to end before they read, like FOR UPDATE makes them wait on the locked rows elsewhere
+    """
+    if db.get_bind().dialect.name == "sqlite":
+        db.execute(update(db_schema.Cluster).where(false()).values(id=db_schema.Cluster.id))
+
+def lock_clusters(cluster_ids, db: Session):
+    """
+    To load clusters locked until the end of the transaction (SELECT ... FOR UPDATE, in id order so concurrent
+    requests lock them in the same order), so the requests scheduling on a cluster read its available resources
+    one after the other and none of their updates is lost
+    """
+    begin_write(db)
+    return db.query(db_schema.Cluster).filter(db_schema.Cluster.id.in_(cluster_ids)).order_by(
+        db_schema.Cluster.id).with_for_update().populate_existing().all()
+
+def validate_deployment_details(deployment: DeploymentCreate, db: Session, lock: bool = True):
+    if deployment.cluster_id is None:
+        deployment.cluster_id = place_deployment(deployment, db)
+    if lock:
+        clusters = lock_clusters([deployment.cluster_id], db)
+    else:
+        clusters = db.query(db_schema.Cluster).filter(db_schema.Cluster.id == deployment.cluster_id).all()
+    cluster = clusters[0] if clusters else None
     if not cluster:
         raise HTTPException(status_code=404, detail="Cluster ID not found")
+    validate_deployment_resources(deployment, cluster)
+    return cluster
+
+def validate_deployment_resources(deployment: DeploymentCreate, cluster: db_schema.Cluster):
     if (
             deployment.ram_required > cluster.total_ram or
             deployment.cpu_required > cluster.total_cpu or
             deployment.gpu_required > cluster.total_gpu
     ):
         raise HTTPException(status_code=422, detail="Not Enough Resources on the cluster for this deployment")
-    return cluster
 
 def update_status_in_db(status_change: dict, db: Session):
-    print(status_change)
+    logger.debug("Deployment status changes %s", status_change, extra={"status_change": status_change})
     updates = [{"id": deployment_id, "status": new_status[1]} for deployment_id, new_status in status_change.items()]
     db.bulk_update_mappings(db_schema.Deployment, updates)
-    return
\ No newline at end of file
+    return
+
+def select_fields(fields: Optional[str], model, response_model):
+    """
+    To get the columns of the model for a comma separated list of fields, all the fields of the response model
+    when none is given
+    """
+    allowed = list(response_model.model_fields)
+    names = [name.strip() for name in fields.split(",") if name.strip()] if fields else allowed
+    unknown = [name for name in names if name not in allowed]
+    if unknown or not names:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}. "
+                                                    f"Available fields: {', '.join(allowed)}")
+    return [getattr(model, name) for name in dict.fromkeys(names)]
+
+def encode_cursor(sort: str, value: int):
+    """
+    Create the opaque cursor of a page ending at the given value of the sort column
+    """
+    return base64.urlsafe_b64encode(f"{sort}:{value}".encode()).decode()
+
+def decode_cursor(cursor: str, sort: str):
+    """
+    To get the value of the sort column the previous page ended at
+    """
+    try:
+        cursor_sort, value = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        if cursor_sort != sort:
+            raise ValueError(cursor_sort)
+        return int(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def fetch_page(db, columns, sort_column, conditions, cursor: Optional[str], limit: int):
+    """
+    To fetch one page of rows with keyset pagination: rows are read in sort column order from right after the
+    cursor, so every page is one index range scan whatever its depth. Returns the rows as dicts of the selected
+    columns and the cursor of the next page (None on the last page)
+    """
+    sort = sort_column.key
+    if cursor:
+        conditions = [*conditions, sort_column > decode_cursor(cursor, sort)]
+    selected = columns if any(column is sort_column for column in columns) else [*columns, sort_column]
+    rows = (await db.execute(select(*selected).where(*conditions).order_by(sort_column).limit(limit + 1))).all()
+    names = [column.key for column in columns]
+    items = [{name: row._mapping[name] for name in names} for row in rows[:limit]]
+    next_cursor = encode_cursor(sort, rows[limit - 1]._mapping[sort]) if len(rows) > limit else None
+    return items, next_cursor
+
+async def _ndjson_chunks(statement, compress: bool):
+    """
+    To read the rows of a select statement through a server side cursor, EXPORT_BATCH_SIZE rows at a time, and
+    yield every batch as newline delimited json, gzip compressed on the fly when asked. The export opens its own
+    session since the session of the request is closed before the response body is streamed
+    """
+    # wbits=31 writes the gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    async with async_session() as db:
+        result = await db.stream(statement.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        async for rows in result.mappings().partitions():
+            chunk = "".join(json.dumps(dict(row)) + "\n" for row in rows).encode()
+            chunk = compressor.compress(chunk) if compressor else chunk
+            if chunk:
+                yield chunk
+    if compressor:
+        yield compressor.flush()
+
+def _accepts_gzip(accept_encoding: str):
+    """
+    To check that an Accept-Encoding header accepts gzip: listed, or matched by *, with a q-value above 0 (RFC 9110)
+    """
+    qualities = {}
+    for item in accept_encoding.lower().split(","):
+        coding, *parameters = (part.strip() for part in item.split(";"))
+        quality = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            qualities[coding] = quality
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
+def export_ndjson(request: Request, statement):
+    """
+    To stream the rows of a select statement as newline delimited json, gzip encoded when the client accepts it
+    """
+    compress = _accepts_gzip(request.headers.get("accept-encoding", ""))
+    headers = {"Vary": "Accept-Encoding", **({"Content-Encoding": "gzip"} if compress else {})}
+    return StreamingResponse(_ndjson_chunks(statement, compress), media_type="application/x-ndjson", headers=headers)
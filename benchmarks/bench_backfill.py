@@ -0,0 +1,71 @@
+"""
+Cost of complete_deploy when none of the pending deployments fit the freed resources, for growing backlogs.
+
+    python -m benchmarks.bench_backfill --sizes 100 1000 10000 --engine python
+"""
+import argparse
+import time
+
+import redis
+from app.db.db_schema import Cluster, Deployment
+from app.services import scheduler
+from benchmarks.counting_redis import CountingRedis
+
+CLUSTER_SIZE = 16
+
+
+def make_deployment(deployment_id, priority, size):
+    return Deployment(id=deployment_id, name=f"deployment-{deployment_id}", image_path="bench/image",
+                      cpu_required=size, ram_required=size, gpu_required=size, priority=priority,
+                      cluster_id=1, status="Pending")
+
+
+def prepare(fake_redis, backlog_size):
+    """
+    Fill the cluster with two running deployments and queue backlog_size pending deployments that are too large
+    for what completing the smaller running deployment frees
+    """
+    cluster = Cluster(id=1, name="bench", total_cpu=CLUSTER_SIZE, total_ram=CLUSTER_SIZE, total_gpu=CLUSTER_SIZE,
+                      available_cpu=CLUSTER_SIZE, available_ram=CLUSTER_SIZE, available_gpu=CLUSTER_SIZE)
+    top_priority = backlog_size + 10
+    scheduler.new_deploy(make_deployment(1, top_priority, CLUSTER_SIZE - 4), cluster)
+    small = make_deployment(2, top_priority + 1, 4)
+    scheduler.new_deploy(small, cluster)
+
+    pipe = fake_redis.pipeline(transaction=False)
+    for index in range(backlog_size):
+        deployment = make_deployment(index + 10, index + 1, 8)
+        scheduler._save_record(pipe, cluster.id, deployment)
+        scheduler._add_pending(pipe, cluster.id, deployment)
+    pipe.execute()
+    return cluster, small
+
+
+def measure(backlog_size, engine):
+    fake_redis = CountingRedis()
+    redis.StrictRedis = lambda *args, **kwargs: fake_redis
+    scheduler.SCHEDULER_ENGINE = engine
+    cluster, small = prepare(fake_redis, backlog_size)
+
+    fake_redis.reset_counters()
+    started = time.perf_counter()
+    status_change = scheduler.complete_deploy(small, cluster)
+    elapsed = time.perf_counter() - started
+    assert status_change == {}
+    return fake_redis.round_trips, fake_redis.commands, elapsed * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--engine", choices=["python", "lua"], default="python")
+    args = parser.parse_args()
+
+    print(f"{'backlog':>10} {'round trips':>12} {'commands':>10} {'ms':>10}")
+    for backlog_size in args.sizes:
+        round_trips, commands, elapsed_ms = measure(backlog_size, args.engine)
+        print(f"{backlog_size:>10} {round_trips:>12} {commands:>10} {elapsed_ms:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
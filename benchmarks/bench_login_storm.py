@@ -0,0 +1,82 @@
+"""
+Latency of get_deployment while idle and during a storm of logins, with real bcrypt hashing.
+
+    python -m benchmarks.bench_login_storm --logins 200 --requests 50
+
+Runs the application in process against a temporary SQLite database, with the SQLITE_MODE of the environment.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+
+
+async def timed_gets(client, token, deployment_id, count):
+    latencies = []
+    for _ in range(count):
+        started = time.perf_counter()
+        response = await client.get("/deployments/get_deployment/", headers={"Authorization": f"Bearer {token}"},
+                                    params={"id": deployment_id})
+        latencies.append((time.perf_counter() - started) * 1000)
+        assert response.status_code == 200
+    return latencies
+
+
+def summary(latencies):
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return f"p50 {quantiles[49]:8.2f} ms   p99 {quantiles[98]:8.2f} ms   max {max(latencies):8.2f} ms"
+
+
+async def run(logins, requests):
+    # The engines of app.db.base are created on import from DATABASE_URL, set by main beforehand
+    from app.db import db_schema
+    from app.db.base import Base, engine, SessionLocal
+    from app.main import app
+
+    Base.metadata.create_all(bind=engine)
+    user_data = {"username": "storm", "password": "storm-password"}
+    with SessionLocal() as db:
+        cluster = db_schema.Cluster(name="storm", total_cpu=1, total_ram=1, total_gpu=1, available_cpu=0,
+                                    available_ram=0, available_gpu=0)
+        db.add(cluster)
+        db.flush()
+        deployment = db_schema.Deployment(name="storm", image_path="bench/image", cpu_required=1, ram_required=1,
+                                          gpu_required=1, priority=1, cluster_id=cluster.id, status="Running")
+        db.add(deployment)
+        db.commit()
+        deployment_id = deployment.id
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        await client.post("/users/register/", json=user_data)
+        token = (await client.post("/users/login/", json=user_data)).json()["access_token"]
+
+        print(f"{'idle':>12}  {summary(await timed_gets(client, token, deployment_id, requests))}")
+
+        started = time.perf_counter()
+        storm = [asyncio.create_task(client.post("/users/login/", json=user_data)) for _ in range(logins)]
+        await asyncio.sleep(0.1)
+        during_storm = await timed_gets(client, token, deployment_id, requests)
+        responses = await asyncio.gather(*storm)
+        elapsed = time.perf_counter() - started
+        print(f"{'login storm':>12}  {summary(during_storm)}")
+        print(f"{logins} logins in {elapsed:.2f} s, {sum(r.status_code == 200 for r in responses)} succeeded")
+    engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+        asyncio.run(run(args.logins, args.requests))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Latency of choosing the best fitting cluster of a deployment with the capacity index of app.services.placement,
+against a scan of every cluster.
+
+    python -m benchmarks.bench_placement --clusters 1000 5000 20000 --placements 5000
+
+Clusters have random sizes and every placement takes the resources of its deployment from the chosen cluster, so the
+clusters fill up as the run goes.
+"""
+import argparse
+import random
+import statistics
+import time
+
+from app.services.placement import CapacityIndex
+from app.services.resources import fits
+
+
+def scan_best_fit(available, demand):
+    best = None
+    for cluster_id, free in available.items():
+        if fits(demand, free) and (best is None or (sum(free), cluster_id) < best):
+            best = (sum(free), cluster_id)
+    return best[1] if best else None
+
+
+def run(clusters, placements, seed, use_index):
+    rng = random.Random(seed)
+    sizes = {cluster_id: tuple(rng.choice((64, 128, 256, 512, 1024)) for _ in range(3))
+             for cluster_id in range(clusters)}
+    index = CapacityIndex(sizes.items())
+    available = dict(sizes)
+
+    latencies, placed = [], 0
+    for _ in range(placements):
+        demand = tuple(rng.randint(1, 64) for _ in range(3))
+        started = time.perf_counter()
+        cluster_id = index.best_fit(demand) if use_index else scan_best_fit(available, demand)
+        if cluster_id is not None:
+            available[cluster_id] = tuple(free - needed for free, needed in zip(available[cluster_id], demand))
+            if use_index:
+                index.set(cluster_id, available[cluster_id])
+            placed += 1
+        latencies.append((time.perf_counter() - started) * 1_000_000)
+
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return placed, quantiles[49], quantiles[98]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clusters", type=int, nargs="+", default=[1000, 5000, 20000])
+    parser.add_argument("--placements", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    print(f"{'clusters':>9} {'method':>6} {'placed':>7} {'p50 us':>9} {'p99 us':>9}")
+    for clusters in args.clusters:
+        for use_index in (True, False):
+            placed, p50, p99 = run(clusters, args.placements, args.seed, use_index)
+            print(f"{clusters:>9} {'index' if use_index else 'scan':>6} {placed:>7} {p50:>9.1f} {p99:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
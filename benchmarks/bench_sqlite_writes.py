@@ -0,0 +1,117 @@
+"""
+Concurrent deployment writes and reads on a SQLite file, with the default SQLite settings and with the performance
+mode of app.db.base (WAL, pragmas, BEGIN IMMEDIATE and serialized writers).
+
+    python -m benchmarks.bench_sqlite_writes --writers 8 --readers 8 --transactions 200
+
+Every writer inserts deployments and updates the resources of their cluster in one transaction, like a deployment
+create, while every reader keeps fetching clusters and deployments.
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from app.db import db_schema
+from app.db.base import Base, enable_sqlite_performance_mode
+
+
+def prepare(database_url, performance):
+    engine = create_engine(database_url, connect_args={"check_same_thread": False})
+    if performance:
+        enable_sqlite_performance_mode(engine)
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    with session_factory() as db:
+        db.add_all([db_schema.Cluster(name=f"bench-{index}", total_cpu=10 ** 9, total_ram=10 ** 9, total_gpu=10 ** 9,
+                                      available_cpu=10 ** 9, available_ram=10 ** 9, available_gpu=10 ** 9)
+                    for index in range(4)])
+        db.commit()
+    return engine, session_factory
+
+
+def writer(session_factory, transactions, errors, next_priority, priority_lock):
+    for _ in range(transactions):
+        with priority_lock:
+            priority = next_priority[0]
+            next_priority[0] += 1
+        try:
+            with session_factory() as db:
+                cluster = db.get(db_schema.Cluster, 1 + priority % 4)
+                db.add(db_schema.Deployment(name=f"deployment-{priority}", image_path="bench/image", cpu_required=1,
+                                            ram_required=1, gpu_required=1, priority=priority, cluster_id=cluster.id,
+                                            status="Running"))
+                cluster.available_cpu -= 1
+                db.commit()
+        except OperationalError as error:
+            errors.append(str(error.orig))
+
+
+def reader(session_factory, stop, latencies):
+    while not stop.is_set():
+        started = time.perf_counter()
+        with session_factory() as db:
+            db.execute(select(db_schema.Cluster)).scalars().all()
+            db.execute(select(db_schema.Deployment).order_by(db_schema.Deployment.id.desc()).limit(20)).all()
+        latencies.append((time.perf_counter() - started) * 1000)
+
+
+def run(performance, writers, readers, transactions):
+    with tempfile.TemporaryDirectory() as directory:
+        engine, session_factory = prepare(f"sqlite:///{os.path.join(directory, 'bench.db')}", performance)
+        errors, latencies, stop = [], [], threading.Event()
+        next_priority, priority_lock = [1], threading.Lock()
+        reader_threads = [threading.Thread(target=reader, args=(session_factory, stop, latencies))
+                          for _ in range(readers)]
+        writer_threads = [threading.Thread(target=writer, args=(session_factory, transactions, errors, next_priority,
+                                                                priority_lock))
+                          for _ in range(writers)]
+        for thread in reader_threads:
+            thread.start()
+        started = time.perf_counter()
+        for thread in writer_threads:
+            thread.start()
+        for thread in writer_threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        stop.set()
+        for thread in reader_threads:
+            thread.join()
+        engine.dispose()
+
+    committed = writers * transactions - len(errors)
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else [0] * 99
+    return {
+        "committed writes": committed,
+        "failed writes": len(errors),
+        "writes / s": committed / elapsed,
+        "reads": len(latencies),
+        "read p50 ms": quantiles[49],
+        "read p99 ms": quantiles[98],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--transactions", type=int, default=200, help="write transactions of every writer")
+    args = parser.parse_args()
+
+    results = {mode: run(mode == "performance", args.writers, args.readers, args.transactions)
+               for mode in ("default", "performance")}
+    print(f"{'':>18}" + "".join(f"{mode:>14}" for mode in results))
+    for metric in results["default"]:
+        values = [results[mode][metric] for mode in results]
+        print(f"{metric:>18}" + "".join(f"{value:>14.2f}" if isinstance(value, float) else f"{value:>14}"
+                                        for value in values))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Replay a synthetic create/complete workload over many clusters and report the decision latency (p50/p99), redis
+round trips and commands per decision, preemptions and cluster utilization.
+
+    python -m benchmarks.bench_workload --deployments 5000 --clusters 20 --priorities uniform --shapes mixed
+    python -m benchmarks.bench_workload --engine lua --redis-url redis://localhost:6379/15
+    python -m benchmarks.bench_workload --priorities ascending --preemption greedy min_cost
+
+Runs against fakeredis unless --redis-url is given. The database of --redis-url is flushed before the run.
+"""
+import argparse
+import random
+import statistics
+import time
+
+import redis
+from sortedcontainers import SortedList
+
+from app.db.db_schema import Cluster, Deployment
+from app.services import scheduler, memory_scheduler, preemption
+from benchmarks.counting_redis import CountingRedis, CountingStrictRedis
+
+# (cpu, ram, gpu) demands a deployment is drawn from, for every resource shape
+SHAPES = {
+    "small": [(1, 2, 0), (2, 4, 0), (1, 1, 1), (2, 8, 0)],
+    "mixed": [(1, 2, 0), (4, 16, 0), (8, 32, 1), (16, 64, 4), (2, 8, 2)],
+    "gpu": [(2, 8, 1), (4, 16, 2), (8, 32, 4), (4, 64, 8)],
+}
+# Order in which priorities arrive: uniform at random, ascending (every new deployment outranks the running ones,
+# the worst case for preemption) or descending (every new deployment is outranked, the backlog grows)
+PRIORITIES = ("uniform", "ascending", "descending")
+
+
+def make_workload(seed, deployments, clusters, priorities, shape, complete_ratio):
+    """
+    Create the operations of a workload: ("new", deployment id, cluster id, priority, (cpu, ram, gpu)) and
+    ("complete", cluster id, pick) where pick in [0, 1) selects which running deployment of the cluster completes
+    """
+    rng = random.Random(seed)
+    ordered = list(range(1, deployments + 1))
+    if priorities == "uniform":
+        rng.shuffle(ordered)
+    elif priorities == "descending":
+        ordered.reverse()
+
+    operations = []
+    for deployment_id, priority in enumerate(ordered, start=1):
+        cluster_id = rng.randint(1, clusters)
+        operations.append(("new", deployment_id, cluster_id, priority, rng.choice(SHAPES[shape])))
+        if rng.random() < complete_ratio:
+            operations.append(("complete", rng.randint(1, clusters), rng.random()))
+    return operations
+
+
+def make_cluster(cluster_id, capacity):
+    cpu, ram, gpu = capacity
+    return Cluster(id=cluster_id, name=f"bench-{cluster_id}", total_cpu=cpu, total_ram=ram, total_gpu=gpu,
+                   available_cpu=cpu, available_ram=ram, available_gpu=gpu)
+
+
+def used(cluster):
+    return (cluster.total_cpu - cluster.available_cpu, cluster.total_ram - cluster.available_ram,
+            cluster.total_gpu - cluster.available_gpu)
+
+
+def run(operations, clusters, capacity, engine, client):
+    """
+    Replay the operations with the given engine and redis client, returning the measured metrics
+    """
+    redis.StrictRedis = lambda *args, **kwargs: client
+    scheduler.SCHEDULER_ENGINE = engine
+    memory_scheduler.drop_cluster_queues()
+    clusters = {cluster_id: make_cluster(cluster_id, capacity) for cluster_id in range(1, clusters + 1)}
+    totals = [sum(getattr(cluster, f"total_{resource}") for cluster in clusters.values())
+              for resource in ("cpu", "ram", "gpu")]
+    in_use = [0, 0, 0]
+    utilization = [0.0, 0.0, 0.0]
+    deployments = {}
+    running = {cluster_id: SortedList() for cluster_id in clusters}
+    latencies, preemptions, decisions = [], 0, 0
+
+    client.reset_counters()
+    for operation in operations:
+        if operation[0] == "new":
+            _, deployment_id, cluster_id, priority, (cpu, ram, gpu) = operation
+            deployment = Deployment(id=deployment_id, name=f"deployment-{deployment_id}", image_path="bench/image",
+                                    cpu_required=cpu, ram_required=ram, gpu_required=gpu, priority=priority,
+                                    cluster_id=cluster_id, status="Pending")
+            deployments[deployment_id] = deployment
+            decide = scheduler.new_deploy
+        else:
+            _, cluster_id, pick = operation
+            if not running[cluster_id]:
+                continue
+            deployment = deployments.pop(running[cluster_id][int(pick * len(running[cluster_id]))])
+            running[cluster_id].remove(deployment.id)
+            decide = scheduler.complete_deploy
+
+        cluster = clusters[cluster_id]
+        before = used(cluster)
+        started = time.perf_counter()
+        status_change = decide(deployment, cluster)
+        latencies.append((time.perf_counter() - started) * 1000)
+        decisions += 1
+
+        if deployment.status == "Running":
+            running[cluster_id].add(deployment.id)
+        for changed_id, (old_status, new_status) in status_change.items():
+            deployments[changed_id].status = new_status
+            if new_status == "Running":
+                running[cluster_id].add(changed_id)
+            else:
+                running[cluster_id].remove(changed_id)
+                preemptions += old_status == "Running"
+        for index, (old_used, new_used) in enumerate(zip(before, used(cluster))):
+            in_use[index] += new_used - old_used
+            utilization[index] += in_use[index] / totals[index] if totals[index] else 0
+
+    memory_scheduler.flush_journal()
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        "decisions": decisions,
+        "p50 ms": quantiles[49],
+        "p99 ms": quantiles[98],
+        "round trips / decision": client.round_trips / max(decisions, 1),
+        "commands / decision": client.commands / max(decisions, 1),
+        "preemptions": preemptions,
+        "cpu utilization": utilization[0] / max(decisions, 1),
+        "ram utilization": utilization[1] / max(decisions, 1),
+        "gpu utilization": utilization[2] / max(decisions, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--deployments", type=int, default=2000)
+    parser.add_argument("--clusters", type=int, default=10)
+    parser.add_argument("--capacity", type=int, nargs=3, default=[64, 256, 16], metavar=("CPU", "RAM", "GPU"))
+    parser.add_argument("--priorities", choices=PRIORITIES, default="uniform")
+    parser.add_argument("--shapes", choices=sorted(SHAPES), default="mixed")
+    parser.add_argument("--complete-ratio", type=float, default=0.5,
+                        help="chance of completing a running deployment after every new one")
+    parser.add_argument("--engine", nargs="+", choices=["python", "lua", "memory"], default=["python"])
+    parser.add_argument("--preemption", nargs="+", choices=["greedy", "min_cost"], default=["greedy"],
+                        help="preemption policies to run every engine with")
+    parser.add_argument("--redis-url", help="redis server to run against instead of fakeredis, it is flushed")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    operations = make_workload(args.seed, args.deployments, args.clusters, args.priorities, args.shapes,
+                               args.complete_ratio)
+    results = {}
+    for engine in args.engine:
+        for policy in args.preemption:
+            preemption.PREEMPTION_POLICY = policy
+            client = CountingStrictRedis.from_url(args.redis_url) if args.redis_url else CountingRedis()
+            client.flushdb()
+            name = engine if len(args.preemption) == 1 else f"{engine}/{policy}"
+            results[name] = run(operations, args.clusters, args.capacity, engine, client)
+
+    print(f"{'':>24}" + "".join(f"{name:>16}" for name in results))
+    for metric in next(iter(results.values())):
+        values = [results[name][metric] for name in results]
+        print(f"{metric:>24}" + "".join(f"{value:>16.3f}" if isinstance(value, float) else f"{value:>16}"
+                                        for value in values))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import fakeredis
+import redis
+from redis.client import Pipeline
+
+
+class CountingPipeline(Pipeline):
+    """Pipeline that reports its round trips and commands to the client that created it."""
+
+    def __init__(self, owner, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.owner = owner
+
+    def immediate_execute_command(self, *args, **options):
+        self.owner.round_trips += 1
+        self.owner.commands += 1
+        return super().immediate_execute_command(*args, **options)
+
+    def execute(self, raise_on_error=True):
+        if self.command_stack:
+            self.owner.round_trips += 1
+            self.owner.commands += len(self.command_stack)
+        return super().execute(raise_on_error)
+
+
+class CountingMixin:
+    """
+    Redis client mixin counting round trips (one per command, or one per executed pipeline) and redis commands
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.round_trips = 0
+        self.commands = 0
+
+    def execute_command(self, *args, **options):
+        self.round_trips += 1
+        self.commands += 1
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return CountingPipeline(self, self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+    def reset_counters(self):
+        self.round_trips = 0
+        self.commands = 0
+
+
+class CountingRedis(CountingMixin, fakeredis.FakeStrictRedis):
+    """fakeredis client counting its round trips and commands."""
+
+
+class CountingStrictRedis(CountingMixin, redis.StrictRedis):
+    """Client of a real redis server counting its round trips and commands."""
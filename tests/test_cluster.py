@@ -1,7 +1,8 @@
 import pytest
+from sqlalchemy import event
 from fastapi.testclient import TestClient
 from app.main import app
-from app.db.base import Base, engine, SessionLocal
+from app.db.base import Base, engine, get_async_engine, SessionLocal
 
 @pytest.fixture(scope="function")
 def db():
@@ -51,6 +52,11 @@ def test_create_cluster(client, db):
     assert result == {'name': 'clusterCreate', 'total_ram': 140, 'total_cpu': 140.0, 'total_gpu': 140,
                                'available_ram': 140, 'available_cpu': 140.0, 'available_gpu': 140}
 
+    for total_ram in (-1, 2 ** 32):
+        response = client.post("/clusters/create/", headers={"Authorization": f"Bearer {token}"},
+                               json={**create_data, "name": "clusterCreateOutOfBounds", "total_ram": total_ram})
+        assert response.status_code == 422
+
 # Test for user login
 def test_get_cluster(client, db):
     token = create_user(client, "GetCluster")
@@ -79,3 +85,49 @@ def test_get_cluster(client, db):
     del result['id']
     assert result == {'name': 'GetCluster', 'total_ram': 140, 'total_cpu': 140.0, 'total_gpu': 140,
                                'available_ram': 140, 'available_cpu': 140.0, 'available_gpu': 140}
+
+
+def test_get_cluster_makes_no_auth_query_once_token_cached(client, db):
+    token = create_user(client, "cachedAuthCluster")
+    response = client.post(
+        "/clusters/create/",
+        headers={"Authorization": f"Bearer {token}"},
+        json={"name": "cachedAuthCluster", "total_ram": 10, "total_cpu": 10, "total_gpu": 10}
+    )
+    assert response.status_code == 200
+    cluster_id = response.json()["id"]
+
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(get_async_engine().sync_engine, "before_cursor_execute", record)
+    try:
+        for _ in range(3):
+            response = client.get("/clusters/get_cluster/", headers={"Authorization": f"Bearer {token}"},
+                                  params={"id": cluster_id})
+            assert response.status_code == 200
+    finally:
+        event.remove(get_async_engine().sync_engine, "before_cursor_execute", record)
+
+    assert statements
+    assert not [statement for statement in statements if "FROM users" in statement]
+
+def test_list_clusters(client, db):
+    token = create_user(client, "listClusters")
+    for index in range(3):
+        response = client.post("/clusters/create/", headers={"Authorization": f"Bearer {token}"},
+                               json={"name": f"listClusters-{index}", "total_ram": 1, "total_cpu": 1, "total_gpu": 1})
+        assert response.status_code == 200
+
+    names, cursor = [], None
+    while True:
+        response = client.get("/clusters/list/", headers={"Authorization": f"Bearer {token}"},
+                              params={"fields": "id,name", "limit": 2, **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        assert all(set(item) == {"id", "name"} for item in response.json()["items"])
+        names += [item["name"] for item in response.json()["items"]]
+        cursor = response.json()["next_cursor"]
+        if cursor is None:
+            break
+    assert names[-3:] == [f"listClusters-{index}" for index in range(3)]
+    assert len(names) == len(set(names))
@@ -0,0 +1,57 @@
+import threading
+import pytest
+from sqlalchemy import create_engine, text, update
+from sqlalchemy.orm import sessionmaker
+from app.db import db_schema
+from app.db import base
+from app.db.base import Base, enable_sqlite_performance_mode
+
+
+def test_sqlite_performance_mode(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'performance.db'}", connect_args={"check_same_thread": False})
+    enable_sqlite_performance_mode(engine)
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    with session_factory() as db:
+        db.add(db_schema.Cluster(name="performance", total_cpu=100, total_ram=100, total_gpu=100,
+                                 available_cpu=100, available_ram=100, available_gpu=100))
+        db.commit()
+        assert db.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert db.execute(text("PRAGMA synchronous")).scalar() == 1
+
+    errors = []
+    def write(offset):
+        try:
+            for index in range(10):
+                with session_factory() as db:
+                    db.add(db_schema.Deployment(name=f"deployment-{offset}-{index}", image_path="test_path/test",
+                                                cpu_required=1, ram_required=1, gpu_required=1,
+                                                priority=offset * 100 + index, cluster_id=1, status="Running"))
+                    db.execute(update(db_schema.Cluster).where(db_schema.Cluster.id == 1)
+                               .values(available_cpu=db_schema.Cluster.available_cpu - 1))
+                    db.commit()
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=write, args=(offset,)) for offset in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    with session_factory() as db:
+        assert db.query(db_schema.Deployment).count() == 80
+        assert db.get(db_schema.Cluster, 1).available_cpu == 20
+    engine.dispose()
+
+
+def test_async_engine_created_on_first_use(monkeypatch):
+    def missing_driver(*args, **kwargs):
+        raise ModuleNotFoundError("No module named 'asyncpg'")
+
+    monkeypatch.setattr(base, "_async_engine", None)
+    monkeypatch.setattr(base, "create_async_engine", missing_driver)
+    with pytest.raises(RuntimeError, match="driver is not installed"):
+        base.async_session()
+    assert base._async_engine is None
@@ -1,8 +1,18 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
 import pytest
 import redis
 import fakeredis
+from fastapi import HTTPException
+from sqlalchemy import event, update
 from fastapi.testclient import TestClient
 from app.main import app
+from app.db import db_schema
+from app import utils
+from app.utils import encode_cursor
+from app.services import events, placement, reconcile
+from app.services.resource_management import CapacityLedger, allocate_resources, free_resources
 from app.db.base import Base, engine, SessionLocal
 
 
@@ -73,9 +83,17 @@ def test_create_deployment(client, db, mock_redis_client):
     result = response.json()
     del result['id']
     assert result == {'name': 'TestDeployment 1', 'cluster_id': cluster_id, 'image_path': "test_path/test",
-                      'ram_required': 35, 'cpu_required': 35.0, 'gpu_required': 35, 'status': 'Running', 'priority': 1}
+                      'ram_required': 35, 'cpu_required': 35.0, 'gpu_required': 35, 'status': 'Running', 'priority': 1,
+                      'group_id': None}
 
-def test_get_deployment(client, db):
+    # Out of the bounds of the scheduler records, rejected before reaching it
+    for cpu_required in (-1, 2 ** 32):
+        response = client.post("/deployments/create/", headers={"Authorization": f"Bearer {token}"},
+                               json={**create_data, "name": "TestDeployment 2", "priority": 3,
+                                     "cpu_required": cpu_required})
+        assert response.status_code == 422
+
+def test_get_deployment(client, db, mock_redis_client):
     response, token = create_cluster(client, 'getDeployment')
     cluster_id = response.json()['id']
     create_data = {
@@ -84,11 +102,482 @@ def test_get_deployment(client, db):
         "ram_required": 35,
         "cpu_required": 35,
         "gpu_required": 35,
-        "priority": 1
+        "priority": 2,
+        "cluster_id": cluster_id
     }
+    headers = {"Authorization": f"Bearer {token}"}
+    response = client.post("/deployments/create/", headers=headers, json=create_data)
+    assert response.status_code == 200
+    created = response.json()
+
+    for params in ({"id": created["id"]}, {"deployment_name": "getDeployment"}):
+        response = client.get("/deployments/get_deployment/", headers=headers, params=params)
+        assert response.status_code == 200
+        assert response.json() == {**create_data, "id": created["id"], "status": "Running", "group_id": None}
+
+    response = client.get("/deployments/get_deployment/", headers=headers,
+                          params={"deployment_name": "getDeployment-missing"})
+    assert response.status_code == 404
+    response = client.get("/deployments/get_deployment/", headers=headers)
+    assert response.status_code == 400
+
+def test_create_deployments_batch(client, db, mock_redis_client):
+    response, token = create_cluster(client, "createBatchUser")
+    cluster_id = response.json()['id']
+
+    def item(name, priority, size, target=cluster_id):
+        return {"name": name, "cluster_id": target, "image_path": "test_path/test", "ram_required": size,
+                "cpu_required": size, "gpu_required": size, "priority": priority}
+
+    batch = [item("batch-low", 101, 35), item("batch-high", 103, 70), item("batch-mid", 102, 70),
+             item("batch-duplicate", 102, 1), item("batch-no-cluster", 104, 1, target=999999),
+             item("batch-too-large", 105, 200)]
     response = client.post(
-        "/deployments/create/",
+        "/deployments/create_batch/",
         headers={"Authorization": f"Bearer {token}"},
-        json=create_data
+        json={"deployments": batch}
     )
+    assert response.status_code == 200
+    result = response.json()
+    assert (result["created"], result["failed"]) == (3, 3)
+    statuses = [(item["name"], item["status"], item["error"]) for item in result["deployments"]]
+    assert statuses == [("batch-low", "Pending", None), ("batch-high", "Running", None),
+                        ("batch-mid", "Running", None), ("batch-duplicate", None, "Priority should be unique"),
+                        ("batch-no-cluster", None, "Cluster ID not found"),
+                        ("batch-too-large", None, "Not Enough Resources on the cluster for this deployment")]
+    assert all(item["id"] for item in result["deployments"][:3])
+
+    response = client.get("/clusters/get_cluster/", headers={"Authorization": f"Bearer {token}"},
+                          params={"id": cluster_id})
+    assert response.json()["available_cpu"] == 0
+
+def test_list_deployments(client, db, mock_redis_client):
+    response, token = create_cluster(client, "listDeploymentsUser")
+    cluster_id = response.json()['id']
+    db.add_all([db_schema.Deployment(name=f"list-{priority}", image_path="test_path/test", cpu_required=1,
+                                     ram_required=1, gpu_required=1, priority=priority, cluster_id=cluster_id,
+                                     status="Running" if priority % 2 else "Pending")
+                for priority in range(5000, 5025)])
+    db.commit()
+
+    pages, cursor = [], None
+    while True:
+        params = {"cluster_id": cluster_id, "status": "Running", "min_priority": 5003, "sort": "priority",
+                  "fields": "name,priority", "limit": 4, **({"cursor": cursor} if cursor else {})}
+        response = client.get("/deployments/list/", headers={"Authorization": f"Bearer {token}"}, params=params)
+        assert response.status_code == 200
+        pages.append(response.json()["items"])
+        cursor = response.json()["next_cursor"]
+        if cursor is None:
+            break
+    assert [len(page) for page in pages] == [4, 4, 3]
+    assert [item for page in pages for item in page] == [{"name": f"list-{priority}", "priority": priority}
+                                                         for priority in range(5003, 5025, 2)]
+
+    response = client.get("/deployments/list/", headers={"Authorization": f"Bearer {token}"},
+                          params={"fields": "name,password"})
+    assert response.status_code == 400
+    response = client.get("/deployments/list/", headers={"Authorization": f"Bearer {token}"},
+                          params={"sort": "id", "cursor": encode_cursor("priority", 5003)})
+    assert response.status_code == 400
+
+def test_export_deployments(client, db, mock_redis_client, monkeypatch):
+    monkeypatch.setattr(utils, "EXPORT_BATCH_SIZE", 3)
+    response, token = create_cluster(client, "exportDeploymentsUser")
+    cluster_id = response.json()['id']
+    db.add_all([db_schema.Deployment(name=f"export-{priority}", image_path="test_path/test", cpu_required=1,
+                                     ram_required=1, gpu_required=1, priority=priority, cluster_id=cluster_id,
+                                     status="Pending")
+                for priority in range(6000, 6010)])
+    db.commit()
+
+    for encoding, compressed in (("identity", False), ("gzip", True), ("gzip;q=0, identity", False),
+                                 ("br, gzip; q=0.5", True), ("*", True), ("gzip;q=0, *", False)):
+        response = client.get("/deployments/export/", headers={"Authorization": f"Bearer {token}",
+                                                               "Accept-Encoding": encoding},
+                              params={"cluster_id": cluster_id, "fields": "name,priority"})
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        assert response.headers.get("content-encoding") == ("gzip" if compressed else None)
+        assert [json.loads(line) for line in response.text.splitlines()] == [
+            {"name": f"export-{priority}", "priority": priority} for priority in range(6000, 6010)]
+
+def test_create_and_complete_deployment_in_one_transaction(client, db, mock_redis_client):
+    response, token = create_cluster(client, "oneTransactionUser")
+    cluster_id = response.json()['id']
+
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement.split()[0])
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        response = client.post("/deployments/create/", headers={"Authorization": f"Bearer {token}"},
+                               json={"name": "oneTransaction", "cluster_id": cluster_id, "image_path": "test_path/test",
+                                     "ram_required": 5, "cpu_required": 5, "gpu_required": 5, "priority": 8000})
+        assert response.status_code == 200
+        created = list(statements)
+        statements.clear()
+        response = client.post("/deployments/complete/", headers={"Authorization": f"Bearer {token}"},
+                               params={"id": response.json()["id"]})
+        assert response.status_code == 200
+        assert response.json()["status"] == "Completed"
+        completed = list(statements)
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+    # The leading UPDATE takes the SQLite write lock (see begin_write), the cluster is read once and locked, then the
+    # new deployment, its status and the cluster resources are written in the same transaction
+    assert created == ["UPDATE", "SELECT", "INSERT", "UPDATE", "UPDATE"]
+    assert completed == ["UPDATE", "SELECT", "UPDATE", "UPDATE"]
+
+def test_complete_queued_deployment_only(client, db, mock_redis_client):
+    response, token = create_cluster(client, "completeRunningUser")
+    cluster_id = response.json()['id']
+    headers = {"Authorization": f"Bearer {token}"}
+
+    def create(name, priority):
+        return client.post("/deployments/create/", headers=headers,
+                           json={"name": name, "cluster_id": cluster_id, "image_path": "test_path/test",
+                                 "ram_required": 100, "cpu_required": 100, "gpu_required": 100,
+                                 "priority": priority}).json()
+
+    def available():
+        response = client.get("/clusters/get_cluster/", headers=headers, params={"id": cluster_id})
+        return response.json()["available_cpu"], response.json()["available_ram"], response.json()["available_gpu"]
+
+    running = create("complete-running", 8150)
+    pending = create("complete-pending", 8149)
+    assert (running["status"], pending["status"]) == ("Running", "Pending")
+    # Cancelled while pending, it frees nothing and is not backfilled anymore
+    response = client.post("/deployments/complete/", headers=headers, params={"id": pending["id"]})
+    assert (response.status_code, response.json()["status"]) == (200, "Completed")
+    assert available() == (40, 40, 40)
+    assert mock_redis_client.zscore(f"PENDING_QUEUE:{{{cluster_id}}}", pending["id"]) is None
+
+    assert client.post("/deployments/complete/", headers=headers, params={"id": running["id"]}).status_code == 200
+    assert available() == (140, 140, 140)
+    # Completed already, a second completion frees nothing
+    assert client.post("/deployments/complete/", headers=headers, params={"id": running["id"]}).status_code == 409
+    assert client.post("/deployments/complete/", headers=headers, params={"id": pending["id"]}).status_code == 409
+    assert available() == (140, 140, 140)
+
+def test_concurrent_deployments_do_not_lose_cluster_updates(client, db, mock_redis_client):
+    response, token = create_cluster(client, "concurrentDeploymentsUser")
+    cluster_id = response.json()['id']
+
+    def create(index):
+        return client.post("/deployments/create/", headers={"Authorization": f"Bearer {token}"},
+                           json={"name": f"concurrent-{index}", "cluster_id": cluster_id,
+                                 "image_path": "test_path/test", "ram_required": 1, "cpu_required": 1,
+                                 "gpu_required": 1, "priority": 8100 + index}).json()["id"]
+
+    def complete(deployment_id):
+        return client.post("/deployments/complete/", headers={"Authorization": f"Bearer {token}"},
+                           params={"id": deployment_id}).status_code
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        deployment_ids = list(executor.map(create, range(20)))
+        response = client.get("/clusters/get_cluster/", headers={"Authorization": f"Bearer {token}"},
+                              params={"id": cluster_id})
+        assert response.json()["available_cpu"] == 120
+        assert list(executor.map(complete, deployment_ids[:10])) == [200] * 10
+
+    response = client.get("/clusters/get_cluster/", headers={"Authorization": f"Bearer {token}"},
+                          params={"id": cluster_id})
+    assert (response.json()["available_cpu"], response.json()["available_ram"]) == (130, 130)
+
+def test_capacity_ledger_applies_deltas_once_per_version(client, db):
+    cluster = db_schema.Cluster(name="ledgerCluster", total_cpu=10, total_ram=10, total_gpu=10, available_cpu=10,
+                                available_ram=10, available_gpu=10)
+    db.add(cluster)
+    db.commit()
+    cluster_id = cluster.id
+
+    ledger = CapacityLedger([cluster])
+    allocate_resources(cluster, db_schema.Deployment(id=0, cpu_required=4, ram_required=3, gpu_required=0))
+    assert ledger.deltas() == {cluster_id: (-4, -3, 0)}
+    ledger.apply(db, {})
+    db.commit()
+    assert (cluster.available_cpu, cluster.available_ram, cluster.version) == (6, 7, 1)
+
+    ledger = CapacityLedger([cluster])
+    with SessionLocal() as other_db:
+        other_db.execute(update(db_schema.Cluster).where(db_schema.Cluster.id == cluster_id)
+                         .values(version=db_schema.Cluster.version + 1))
+        other_db.commit()
+    free_resources(cluster, db_schema.Deployment(id=0, cpu_required=4, ram_required=3, gpu_required=0))
+    with pytest.raises(HTTPException) as error:
+        ledger.apply(db, {})
+    assert error.value.status_code == 409
+    db.rollback()
+    db.refresh(cluster)
+    assert (cluster.available_cpu, cluster.available_ram, cluster.version) == (6, 7, 2)
+
+def test_deployment_events_stream_status_changes(client, db, monkeypatch):
+    server = fakeredis.FakeServer()
+    fake_redis = fakeredis.FakeStrictRedis(server=server)
+    monkeypatch.setattr(redis, "StrictRedis", lambda *args, **kwargs: fake_redis)
+    monkeypatch.setattr(events, "get_async_redis_client", lambda: fakeredis.FakeAsyncRedis(server=server))
+    monkeypatch.setattr(events, "EVENT_STREAM_BLOCK_MS", 10)
+    response, token = create_cluster(client, "eventsUser")
+    cluster_id = response.json()['id']
+    headers = {"Authorization": f"Bearer {token}"}
+
+    def create(name, priority, size):
+        return client.post("/deployments/create/", headers=headers,
+                           json={"name": name, "cluster_id": cluster_id, "image_path": "test_path/test",
+                                 "ram_required": size, "cpu_required": size, "gpu_required": size,
+                                 "priority": priority}).json()["id"]
+
+    low = create("events-low", 8200, 100)
+    high = create("events-high", 8201, 100)
+    assert client.post("/deployments/complete/", headers=headers, params={"id": high}).status_code == 200
+
+    async def read(count, **filters):
+        stream, received = events.stream_events(**filters), []
+        async for message in stream:
+            if not message.startswith(":"):
+                received.append(message)
+            if len(received) == count:
+                break
+        await stream.aclose()
+        return [json.loads(message.split("data: ", 1)[1]) for message in received]
+
+    changes = asyncio.run(read(3, cursor="0-0", deployment_ids=[low]))
+    assert [(event["old_status"], event["new_status"]) for event in changes] == [
+        (None, "Running"), ("Running", "Pending"), ("Pending", "Running")]
+    assert [event["cluster_id"] for event in changes] == [cluster_id] * 3
+
+    # Resuming from the cursor of an event streams the events after it only
+    resumed = asyncio.run(read(2, cursor=changes[0]["cursor"], cluster_ids=[cluster_id]))
+    assert [(event["deployment_id"], event["new_status"]) for event in resumed] == [(high, "Running"), (low, "Pending")]
+
+    response = client.get("/deployments/events/", headers={**headers, "Last-Event-ID": "not-a-cursor"})
+    assert response.status_code == 400
+
+def test_create_deployment_places_on_best_fit_cluster(client, db, mock_redis_client):
+    placement.reset_index()
+    _, token = create_cluster(client, "placementUser")
+    headers = {"Authorization": f"Bearer {token}"}
+    cluster_ids = {}
+    for name, size in (("placement-large", 4000), ("placement-small", 1500), ("placement-medium", 2500)):
+        response = client.post("/clusters/create/", headers=headers,
+                               json={"name": name, "total_ram": size, "total_cpu": size, "total_gpu": size})
+        cluster_ids[name] = response.json()["id"]
+
+    def create(name, priority, size):
+        response = client.post("/deployments/create/", headers=headers,
+                               json={"name": name, "image_path": "test_path/test", "ram_required": size,
+                                     "cpu_required": size, "gpu_required": size, "priority": priority})
+        assert response.status_code == 200
+        return response.json()
+
+    # The smallest cluster with room is chosen, and the index follows the resources taken
+    assert create("placed-1", 8300, 1000)["cluster_id"] == cluster_ids["placement-small"]
+    assert create("placed-2", 8301, 1000)["cluster_id"] == cluster_ids["placement-medium"]
+    assert create("placed-3", 8302, 1500)["cluster_id"] == cluster_ids["placement-medium"]
+    placed = create("placed-4", 8303, 3000)
+    assert (placed["cluster_id"], placed["status"]) == (cluster_ids["placement-large"], "Running")
+    # Once no cluster has room, the deployment waits on the smallest cluster large enough for it
+    placed = create("placed-5", 8299, 3500)
+    assert (placed["cluster_id"], placed["status"]) == (cluster_ids["placement-large"], "Pending")
+
+    response = client.post("/deployments/create/", headers=headers,
+                           json={"name": "placed-too-large", "image_path": "test_path/test", "ram_required": 5000,
+                                 "cpu_required": 5000, "gpu_required": 5000, "priority": 8305})
+    assert response.status_code == 422
+
+def test_capacity_index_keeps_looking_past_the_first_fitting_bucket():
+    index = placement.CapacityIndex({1: (1, 1, 32), 2: (4, 4, 4), 3: (2, 2, 2)}.items())
+    # Cluster 1 is in the smallest bucket holding the demand, clusters 3 then 2 have less resources left in total
+    assert index.best_fit((1, 1, 1)) == 3
+    assert index.best_fit((1, 1, 3)) == 2
+    assert index.best_fit((1, 1, 5)) == 1
+    assert index.best_fit((5, 1, 1)) is None
+
+def test_deployment_group_runs_all_or_nothing(client, db, mock_redis_client):
+    response, token = create_cluster(client, "groupUser")
+    cluster_id = response.json()["id"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    def member(name, priority, size):
+        return {"name": name, "image_path": "test_path/test", "ram_required": size, "cpu_required": size,
+                "gpu_required": size, "priority": priority}
+
+    def statuses():
+        response = client.get("/deployments/list/", headers=headers, params={"cluster_id": cluster_id})
+        return {item["name"]: item["status"] for item in response.json()["items"]}
+
+    response = client.post("/deployments/create/", headers=headers,
+                           json={**member("group-low", 8400, 60), "cluster_id": cluster_id})
+    assert response.json()["status"] == "Running"
+
+    # The group needs 90 of the 80 left, the lower priority deployment is preempted so all of it runs
+    response = client.post("/deployments/create_group/", headers=headers, json={"cluster_id": cluster_id, "deployments": [
+        member("group-a-1", 8410, 30), member("group-a-2", 8411, 30), member("group-a-3", 8412, 30)]})
+    assert response.status_code == 200
+    group_a = response.json()
+    assert (group_a["status"], group_a["cluster_id"]) == ("Running", cluster_id)
+    lead_id = next(item["id"] for item in group_a["deployments"] if item["priority"] == 8412)
+    assert group_a["group_id"] == lead_id
+    assert [(item["status"], item["group_id"]) for item in group_a["deployments"]] == [("Running", lead_id)] * 3
+
+    # One member of this group would fit the 50 left, but the group does not and waits as a whole
+    response = client.post("/deployments/create_group/", headers=headers, json={"deployments": [
+        member("group-b-1", 8401, 40), member("group-b-2", 8402, 40)], "cluster_id": cluster_id})
+    assert response.json()["status"] == "Pending"
+    assert statuses() == {"group-low": "Pending", "group-a-1": "Running", "group-a-2": "Running",
+                          "group-a-3": "Running", "group-b-1": "Pending", "group-b-2": "Pending"}
+
+    # Completing a member completes its group, whose resources start the pending group then the pending deployment
+    response = client.post("/deployments/complete/", headers=headers, params={"id": group_a["deployments"][1]["id"]})
+    assert response.json()["status"] == "Completed"
+    assert statuses() == {"group-low": "Running", "group-a-1": "Completed", "group-a-2": "Completed",
+                          "group-a-3": "Completed", "group-b-1": "Running", "group-b-2": "Running"}
+
+    response = client.post("/deployments/create_group/", headers=headers, json={"cluster_id": cluster_id, "deployments": [
+        {**member("group-c-1", 8420, 1), "cluster_id": cluster_id + 1}]})
     assert response.status_code == 422
+    response = client.post("/deployments/create_group/", headers=headers, json={"cluster_id": cluster_id, "deployments": [
+        member("group-c-1", 8420, 80), member("group-c-2", 8421, 80)]})
+    assert response.status_code == 422
+
+def test_tick_mode_schedules_intents_in_background(client, db, mock_redis_client, monkeypatch):
+    monkeypatch.setattr(reconcile, "SCHEDULING_MODE", "tick")
+    response, token = create_cluster(client, "tickUser")
+    cluster_id = response.json()["id"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    def create(name, priority, size):
+        response = client.post("/deployments/create/", headers=headers,
+                               json={"name": name, "cluster_id": cluster_id, "image_path": "test_path/test",
+                                     "ram_required": size, "cpu_required": size, "gpu_required": size,
+                                     "priority": priority})
+        assert (response.status_code, response.json()["status"]) == (202, "Pending")
+        return response.json()["id"]
+
+    def statuses():
+        response = client.get("/deployments/list/", headers=headers, params={"cluster_id": cluster_id})
+        return {item["name"]: item["status"] for item in response.json()["items"]}
+
+    create("tick-low", 8500, 100)
+    high = create("tick-high", 8501, 100)
+    assert statuses() == {"tick-low": "Pending", "tick-high": "Pending"}
+
+    # Both are placed by one pass, highest priority first
+    assert reconcile.reconcile_once() == 2
+    assert statuses() == {"tick-low": "Pending", "tick-high": "Running"}
+
+    response = client.post("/deployments/complete/", headers=headers, params={"id": high})
+    assert (response.status_code, response.json()["status"]) == (202, "Running")
+    # Created and completed within one tick, it is never scheduled
+    response = client.post("/deployments/complete/", headers=headers, params={"id": create("tick-short", 8502, 30)})
+    assert response.status_code == 202
+
+    assert reconcile.reconcile_once() == 3
+    assert statuses() == {"tick-low": "Running", "tick-high": "Completed", "tick-short": "Completed"}
+    cluster = db.get(db_schema.Cluster, cluster_id)
+    assert (cluster.available_cpu, cluster.available_ram, cluster.available_gpu) == (40, 40, 40)
+    assert reconcile.reconcile_once() == 0
+
+def test_tick_mode_requeues_intents_of_a_failed_cluster(client, db, mock_redis_client, monkeypatch):
+    monkeypatch.setattr(reconcile, "SCHEDULING_MODE", "tick")
+    clusters = {}
+    for username in ("tickFailingUser", "tickWorkingUser"):
+        response, token = create_cluster(client, username)
+        clusters[username] = (response.json()["id"], {"Authorization": f"Bearer {token}"})
+
+    def create(username, name, priority):
+        cluster_id, headers = clusters[username]
+        response = client.post("/deployments/create/", headers=headers,
+                               json={"name": name, "cluster_id": cluster_id, "image_path": "test_path/test",
+                                     "ram_required": 10, "cpu_required": 10, "gpu_required": 10,
+                                     "priority": priority})
+        assert response.status_code == 202
+        return response.json()["id"]
+
+    failing = create("tickFailingUser", "tick-failing", 8600)
+    working = create("tickWorkingUser", "tick-working", 8601)
+    failing_cluster = clusters["tickFailingUser"][0]
+    lock_clusters = reconcile.lock_clusters
+
+    def lock_failing_once(cluster_ids, db):
+        if failing_cluster in cluster_ids:
+            monkeypatch.setattr(reconcile, "lock_clusters", lock_clusters)
+            raise RuntimeError("Cluster unavailable")
+        return lock_clusters(cluster_ids, db)
+
+    monkeypatch.setattr(reconcile, "lock_clusters", lock_failing_once)
+    # The working cluster is committed on its own, the intent of the failing one waits for the next tick
+    assert reconcile.reconcile_once() == 1
+    db.expire_all()
+    assert (db.get(db_schema.Deployment, failing).status, db.get(db_schema.Deployment, working).status) == \
+           ("Pending", "Running")
+    assert mock_redis_client.lrange(reconcile.SCHEDULING_INTENTS, 0, -1) == [f"new:{failing}".encode()]
+    assert mock_redis_client.llen(reconcile.SCHEDULING_INTENTS_PROCESSING) == 0
+
+    assert reconcile.reconcile_once() == 1
+    db.expire_all()
+    assert db.get(db_schema.Deployment, failing).status == "Running"
+    assert reconcile.reconcile_once() == 0
+
+def test_tick_mode_rebuilds_cluster_failing_after_its_passes(client, db, mock_redis_client, monkeypatch):
+    monkeypatch.setattr(reconcile, "SCHEDULING_MODE", "tick")
+    response, token = create_cluster(client, "tickRebuildUser")
+    cluster_id = response.json()["id"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    def create(name, priority):
+        response = client.post("/deployments/create/", headers=headers,
+                               json={"name": name, "cluster_id": cluster_id, "image_path": "test_path/test",
+                                     "ram_required": 100, "cpu_required": 100, "gpu_required": 100,
+                                     "priority": priority})
+        assert response.status_code == 202
+        return response.json()["id"]
+
+    low = create("tick-rebuild-low", 8700)
+    assert reconcile.reconcile_once() == 1
+    high = create("tick-rebuild-high", 8701)
+
+    class FailingLedger(CapacityLedger):
+        def apply(self, db, status_change):
+            monkeypatch.setattr(reconcile, "CapacityLedger", CapacityLedger)
+            raise HTTPException(status_code=409, detail="Cluster capacity changed during scheduling")
+
+    # The pass preempted the low deployment in redis before the ledger failed: the queues are rebuilt from the
+    # database and the intent is scheduled again on them
+    monkeypatch.setattr(reconcile, "CapacityLedger", FailingLedger)
+    assert reconcile.reconcile_once() == 0
+    running_queue = f"RUNNING_QUEUE:{{{cluster_id}}}"
+    assert mock_redis_client.zrange(running_queue, 0, -1) == [str(low).encode()]
+    assert mock_redis_client.zcard(f"PENDING_QUEUE:{{{cluster_id}}}") == 0
+
+    assert reconcile.reconcile_once() == 1
+    db.expire_all()
+    assert (db.get(db_schema.Deployment, low).status, db.get(db_schema.Deployment, high).status) == \
+           ("Pending", "Running")
+    assert mock_redis_client.zrange(running_queue, 0, -1) == [str(high).encode()]
+    assert mock_redis_client.zrange(f"PENDING_QUEUE:{{{cluster_id}}}", 0, -1) == [str(low).encode()]
+
+def test_tick_mode_requeues_intents_of_a_crashed_reconciler(client, db, mock_redis_client, monkeypatch):
+    monkeypatch.setattr(reconcile, "SCHEDULING_MODE", "tick")
+    response, token = create_cluster(client, "tickCrashUser")
+    cluster_id = response.json()["id"]
+    response = client.post("/deployments/create/", headers={"Authorization": f"Bearer {token}"},
+                           json={"name": "tick-crash", "cluster_id": cluster_id, "image_path": "test_path/test",
+                                 "ram_required": 10, "cpu_required": 10, "gpu_required": 10, "priority": 8800})
+    deployment_id = response.json()["id"]
+
+    # Another worker leads and claims the intent, then dies before scheduling it
+    mock_redis_client.set(reconcile.SCHEDULING_RECONCILER, "crashed-worker")
+    assert reconcile.reconcile_once() == 0
+    assert reconcile._claim_intents(mock_redis_client) == [f"new:{deployment_id}".encode()]
+    mock_redis_client.delete(reconcile.SCHEDULING_RECONCILER)
+
+    # Its lease expired, this worker takes it over and schedules the intent it left claimed
+    assert reconcile.reconcile_once() == 1
+    db.expire_all()
+    assert db.get(db_schema.Deployment, deployment_id).status == "Running"
+    assert mock_redis_client.llen(reconcile.SCHEDULING_INTENTS_PROCESSING) == 0
+    reconcile.resign(mock_redis_client)
+    assert mock_redis_client.get(reconcile.SCHEDULING_RECONCILER) is None
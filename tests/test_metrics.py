@@ -0,0 +1,69 @@
+import pytest
+import redis
+import fakeredis
+from fastapi.testclient import TestClient
+from app.main import app
+from app.db import redis_client
+from app.db.base import Base, engine, SessionLocal
+
+
+@pytest.fixture(scope="function")
+def db():
+    Base.metadata.create_all(bind=engine)
+    db_session = SessionLocal()
+    yield db_session
+    db_session.close()
+
+
+@pytest.fixture(scope="module")
+def client():
+    Base.metadata.create_all(bind=engine)
+    client = TestClient(app)
+    yield client
+    Base.metadata.drop_all(bind=engine)
+
+
+@pytest.fixture
+def fake_pool(monkeypatch):
+    """Fixture that installs a small instrumented pool of fakeredis connections as the application pool."""
+    pool = redis_client.InstrumentedConnectionPool(connection_class=fakeredis.FakeConnection,
+                                                   server=fakeredis.FakeServer(), max_connections=2, timeout=0.01)
+    monkeypatch.setattr(redis_client, "_pool", pool)
+    return pool
+
+
+def create_user(client, username):
+    user_data = {"username": username, "password": "testpassword"}
+    response = client.post("/users/register", json=user_data)
+    assert response.status_code == 200
+
+    login_data = {"username": username, "password": "testpassword"}
+    response = client.post("/users/login", json=login_data)
+    assert response.status_code == 200
+
+    return response.json().get("access_token")
+
+
+def test_redis_pool_metrics(client, db, fake_pool):
+    token = create_user(client, "redisPoolMetrics")
+    redis_client.get_redis_client().ping()
+
+    response = client.get("/metrics/redis_pool/", headers={"Authorization": f"Bearer {token}"})
+
+    assert response.status_code == 200
+    assert response.json() == {"max_connections": 2, "created": 1, "in_use": 0, "idle": 1, "saturation": 0.0,
+                               "checkouts": 1, "waits": 0, "timeouts": 0}
+
+
+def test_redis_pool_saturation(fake_pool):
+    held = [fake_pool.get_connection("PING") for _ in range(2)]
+    with pytest.raises(redis.exceptions.ConnectionError):
+        fake_pool.get_connection("PING")
+
+    metrics = redis_client.redis_pool_metrics()
+    assert metrics["saturation"] == 1.0
+    assert (metrics["waits"], metrics["timeouts"]) == (1, 1)
+
+    for connection in held:
+        fake_pool.release(connection)
+    assert redis_client.redis_pool_metrics()["in_use"] == 0
@@ -2,6 +2,7 @@ import pytest
 from fastapi.testclient import TestClient
 from app.main import app
 from app.db.base import Base, engine, SessionLocal
+from app.services import auth
 
 @pytest.fixture(scope="function")
 def db():
@@ -62,3 +63,28 @@ def test_join_valid_invite_code(client, db):
     )
     assert response.status_code == 200
     assert response.json() == {'message': 'User org2user joined organization Test Organization 2'}
+
+
+def test_join_invalidates_cached_user(client, db):
+    token = create_user(client, "orgCacheUser")
+    response = client.post(
+        "/organizations/create/",
+        headers={"Authorization": f"Bearer {token}"},
+        json={"name": "Cached Organization"}
+    )
+    assert response.status_code == 200
+    organization = response.json()
+    assert auth.validate_user_access(token, db).organization_id is None
+    hits = auth.user_cache_metrics()["hits"]
+    assert auth.validate_user_access(token, db).organization_id is None
+    assert auth.user_cache_metrics()["hits"] == hits + 1
+
+    response = client.post(
+        "/organizations/join/",
+        headers={"Authorization": f"Bearer {token}"},
+        params={"invite_code": organization["invite_code"]}
+    )
+    assert response.status_code == 200
+
+    assert auth.user_cache_metrics()["invalidations"] >= 1
+    assert auth.validate_user_access(token, db).organization_id == organization["id"]
@@ -0,0 +1,98 @@
+import io
+import json
+import pytest
+import redis
+import fakeredis
+from app.db.base import Base, engine, SessionLocal
+from app.db.db_schema import Deployment, Cluster
+from app.services import restore, scheduler, memory_scheduler
+
+
+@pytest.fixture(scope="module")
+def tables():
+    Base.metadata.create_all(bind=engine)
+    yield
+    Base.metadata.drop_all(bind=engine)
+
+@pytest.fixture(scope="function")
+def db(tables):
+    db_session = SessionLocal()
+    yield db_session
+    db_session.close()
+
+@pytest.fixture
+def mock_redis_client(monkeypatch):
+    """Fixture that replaces redis.StrictRedis with fakeredis.FakeStrictRedis."""
+    fake_redis = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(redis, "StrictRedis", lambda *args, **kwargs: fake_redis)
+    return fake_redis
+
+
+def test_import_and_rebuild(db, mock_redis_client, monkeypatch):
+    monkeypatch.setattr(restore, "RESTORE_BATCH_SIZE", 2)
+    cluster = Cluster(name="restore", total_cpu=10, total_ram=10, total_gpu=10, available_cpu=10, available_ram=10,
+                      available_gpu=10)
+    db.add(cluster)
+    db.commit()
+    mock_redis_client.zadd(f"RUNNING_QUEUE:{{{cluster.id}}}", {"999999": 1})
+    mock_redis_client.zadd(f"PENDING_BUCKET_1.1.1:{{{cluster.id}}}", {"999999": 1})
+    # Buckets of a cluster the database does not know are left alone
+    mock_redis_client.zadd("PENDING_BUCKET_1.1.1:{unknown}", {"999999": 1})
+
+    def line(name, priority, status, size=3, **extra):
+        return json.dumps({"name": name, "image_path": "test_path/test", "cpu_required": size, "ram_required": size,
+                           "gpu_required": size, "priority": priority, "cluster_id": cluster.id, "status": status,
+                           **extra})
+
+    lines = [line("restore-1", 7001, "Running"), line("restore-2", 7002, "Running", id=7002), "",
+             line("restore-3", 7003, "Pending", size=5), line("restore-4", 7004, "Completed"),
+             line("restore-5", 7005, "Pending", size=1)]
+    assert restore.import_deployments(io.StringIO("\n".join(lines)), db) == 5
+    assert db.get(Deployment, 7002).name == "restore-2"
+
+    assert restore.rebuild(db) == 4
+    db.refresh(cluster)
+    assert (cluster.available_cpu, cluster.available_ram, cluster.available_gpu) == (4, 4, 4)
+    running = mock_redis_client.zrange(f"RUNNING_QUEUE:{{{cluster.id}}}", 0, -1, withscores=True)
+    assert [priority for _, priority in running] == [7001, 7002]
+    pending = mock_redis_client.zrange(f"PENDING_QUEUE:{{{cluster.id}}}", 0, -1, withscores=True)
+    assert [priority for _, priority in pending] == [7003, 7005]
+    bucket = mock_redis_client.zrange(f"PENDING_BUCKET_1.1.1:{{{cluster.id}}}", 0, -1, withscores=True)
+    assert [priority for _, priority in bucket] == [7005]
+    assert mock_redis_client.zcard("PENDING_BUCKET_1.1.1:{unknown}") == 1
+
+    completed = scheduler.QueuedDeployment(7002, 3, 3, 3, 7002, "Running")
+    status_change = scheduler.complete_deploy(completed, cluster)
+    assert sorted(new for _, new in status_change.values()) == ["Running", "Running"]
+    assert cluster.available_cpu == 1
+
+
+def test_import_reports_missing_fields(db):
+    with pytest.raises(ValueError, match="Line 1: missing priority"):
+        restore.import_deployments(io.StringIO(json.dumps({"name": "restore-bad", "image_path": "test_path/test",
+                                                           "cpu_required": 1, "ram_required": 1, "gpu_required": 1,
+                                                           "cluster_id": 1})), db)
+
+def test_rebuild_queues_group_as_one_deployment(db, mock_redis_client, monkeypatch):
+    cluster = Cluster(name="restore-group", total_cpu=10, total_ram=10, total_gpu=10, available_cpu=10,
+                      available_ram=10, available_gpu=10)
+    db.add(cluster)
+    db.commit()
+
+    def line(deployment_id, priority, status, group_id):
+        return json.dumps({"id": deployment_id, "name": f"restore-group-{deployment_id}", "image_path": "test_path/test",
+                           "cpu_required": 2, "ram_required": 3, "gpu_required": 1, "priority": priority,
+                           "cluster_id": cluster.id, "status": status, "group_id": group_id})
+
+    lines = [line(7102, 7102, "Pending", 7103), line(7103, 7103, "Pending", 7103), line(7101, 7101, "Pending", 7103),
+             line(7104, 7104, "Pending", None)]
+    restore.import_deployments(io.StringIO("\n".join(lines)), db)
+
+    monkeypatch.setattr(memory_scheduler, "_clusters", {cluster.id: memory_scheduler.ClusterQueues()})
+    restore.rebuild_queues(db)
+    # The memory engine loads the rebuilt queues instead of deciding on the ones it had
+    assert memory_scheduler._clusters == {}
+    pending = mock_redis_client.zrange(f"PENDING_QUEUE:{{{cluster.id}}}", 0, -1, withscores=True)
+    assert pending == [(b"7103", 7103), (b"7104", 7104)]
+    record = mock_redis_client.hget(f"DEPLOYMENT_RECORDS:{{{cluster.id}}}", "7103")
+    assert scheduler._unpack_record(7103, record, 7103, "Pending").cpu_required == 6
@@ -0,0 +1,489 @@
+import random
+import threading
+import pytest
+import redis
+import fakeredis
+from fastapi import HTTPException
+from app.db.db_schema import Deployment, Cluster
+from app.services import scheduler, memory_scheduler, preemption, resource_management, groups
+from benchmarks.counting_redis import CountingRedis
+
+
+@pytest.fixture
+def mock_redis_client(monkeypatch):
+    """Fixture that replaces redis.StrictRedis with fakeredis.FakeStrictRedis."""
+    fake_redis = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(redis, "StrictRedis", lambda *args, **kwargs: fake_redis)
+    return fake_redis
+
+def make_cluster(cluster_id, cpu=10, ram=10, gpu=10):
+    return Cluster(id=cluster_id, name=f"cluster-{cluster_id}", total_cpu=cpu, total_ram=ram, total_gpu=gpu,
+                   available_cpu=cpu, available_ram=ram, available_gpu=gpu)
+
+def make_deployment(deployment_id, cluster_id, priority, cpu=10, ram=10, gpu=10):
+    return Deployment(id=deployment_id, name=f"deployment-{deployment_id}", image_path="test_path/test",
+                      cpu_required=cpu, ram_required=ram, gpu_required=gpu, priority=priority,
+                      cluster_id=cluster_id, status="Pending")
+
+
+def test_new_deploy_does_not_preempt_other_clusters(mock_redis_client):
+    cluster_a, cluster_b = make_cluster(1), make_cluster(2)
+    assert scheduler.new_deploy(make_deployment(1, 1, priority=1), cluster_a) == {}
+    assert scheduler.new_deploy(make_deployment(2, 2, priority=2), cluster_b) == {}
+
+    status_change = scheduler.new_deploy(make_deployment(3, 2, priority=3), cluster_b)
+
+    assert status_change == {2: ("Running", "Pending")}
+    assert cluster_a.available_cpu == 0
+    assert mock_redis_client.zcard("RUNNING_QUEUE:{1}") == 1
+    assert mock_redis_client.zcard("RUNNING_QUEUE:{2}") == 1
+
+
+def test_complete_deploy_backfills_from_own_cluster_only(mock_redis_client):
+    cluster_a, cluster_b = make_cluster(1), make_cluster(2)
+    running = make_deployment(1, 1, priority=5)
+    scheduler.new_deploy(running, cluster_a)
+    scheduler.new_deploy(make_deployment(2, 1, priority=1), cluster_a)
+    scheduler.new_deploy(make_deployment(3, 2, priority=2), cluster_b)
+    scheduler.new_deploy(make_deployment(4, 2, priority=3), cluster_b)
+
+    status_change = scheduler.complete_deploy(running, cluster_a)
+
+    assert status_change == {2: ("Pending", "Running")}
+    assert cluster_b.available_cpu == 0
+
+
+def queue_pending(pipe, deployment):
+    scheduler._save_record(pipe, deployment.cluster_id, deployment)
+    scheduler._add_pending(pipe, deployment.cluster_id, deployment)
+
+
+def legacy_member(deployment):
+    return (f"{deployment.id}|{deployment.image_path}|{deployment.cpu_required}|{deployment.ram_required}|"
+            f"{deployment.gpu_required}|{deployment.priority}|{deployment.cluster_id}|{deployment.status}|"
+            f"{deployment.name}")
+
+
+def test_migrate_global_queues(mock_redis_client):
+    running = make_deployment(1, 1, priority=2)
+    running.status = "Running"
+    mock_redis_client.zadd("RUNNING_QUEUE", {legacy_member(running): 2})
+    mock_redis_client.zadd("PENDING_QUEUE_2", {legacy_member(make_deployment(2, 1, priority=1)): 1})
+    mock_redis_client.zadd("PENDING_QUEUE_1:{2}", {legacy_member(make_deployment(3, 2, priority=3)): 3})
+    mock_redis_client.zadd("PENDING_QUEUE:{3}", {legacy_member(make_deployment(4, 3, priority=4, cpu=3)): 4})
+    mock_redis_client.zadd("PENDING_CPU_DEMAND:{3}", {legacy_member(make_deployment(4, 3, priority=4, cpu=3)): 3})
+
+    assert scheduler.migrate_global_queues() == 4
+    assert scheduler.migrate_global_queues() == 0
+
+    assert not mock_redis_client.exists("RUNNING_QUEUE", "PENDING_QUEUE_1", "PENDING_QUEUE_2", "PENDING_QUEUE_1:{2}")
+    assert mock_redis_client.zrange("RUNNING_QUEUE:{1}", 0, -1, withscores=True) == [(b"1", 2)]
+    assert mock_redis_client.zrange("PENDING_QUEUE:{1}", 0, -1) == [b"2"]
+    assert mock_redis_client.zrange("PENDING_QUEUE:{2}", 0, -1) == [b"3"]
+    assert mock_redis_client.zrange("PENDING_CPU_DEMAND:{3}", 0, -1, withscores=True) == [(b"4", 3)]
+    assert mock_redis_client.hgetall("PENDING_BUCKETS:{3}") == {b"2.4.4": b"1"}
+    assert mock_redis_client.hget("DEPLOYMENT_RECORDS:{2}", "3") == scheduler._pack_record(make_deployment(3, 2, 3))
+
+
+def run_workload(monkeypatch, engine, operations):
+    """Replay create/complete operations against a fresh fake redis with the given engine."""
+    fake_redis = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(redis, "StrictRedis", lambda *args, **kwargs: fake_redis)
+    monkeypatch.setattr(scheduler, "SCHEDULER_ENGINE", engine)
+    monkeypatch.setattr(memory_scheduler, "_clusters", {})
+    cluster = make_cluster(1, cpu=16, ram=16, gpu=16)
+    deployments, results = {}, []
+    for operation, deployment_id, priority, size in operations:
+        if operation == "new":
+            deployment = make_deployment(deployment_id, 1, priority, cpu=size, ram=size, gpu=size)
+            deployments[deployment_id] = deployment
+            status_change = scheduler.new_deploy(deployment, cluster)
+        else:
+            if deployment_id is None:
+                running = [known_id for known_id, known in deployments.items() if known.status == "Running"]
+                if not running:
+                    continue
+                deployment_id = min(running)
+            assert deployments[deployment_id].status == "Running"
+            status_change = scheduler.complete_deploy(deployments.pop(deployment_id), cluster)
+        for changed_id, (_, new_status) in status_change.items():
+            deployments[changed_id].status = new_status
+        results.append((status_change, cluster.available_cpu, cluster.available_ram, cluster.available_gpu))
+    memory_scheduler.flush_journal()
+    running = fake_redis.zrange("RUNNING_QUEUE:{1}", 0, -1)
+    pending = fake_redis.zrange("PENDING_QUEUE:{1}", 0, -1)
+    return results, sorted(running), sorted(pending)
+
+
+def test_lua_engine_matches_python_engine(monkeypatch):
+    pytest.importorskip("lupa")
+    operations = [("new", 1, 5, 6), ("new", 2, 3, 6), ("new", 3, 8, 8), ("new", 4, 1, 2), ("new", 5, 9, 12),
+                  ("complete", 5, None, None), ("new", 6, 2, 4), ("new", 7, 7, 3), ("complete", 3, None, None)]
+
+    python_run = run_workload(monkeypatch, "python", operations)
+    lua_run = run_workload(monkeypatch, "lua", operations)
+
+    assert lua_run == python_run
+
+
+def random_workload(seed, size):
+    rng = random.Random(seed)
+    operations = []
+    for deployment_id, priority in enumerate(rng.sample(range(1, 10000), size), start=1):
+        operations.append(("new", deployment_id, priority, rng.choice([1, 2, 3, 5, 8, 13])))
+        if rng.random() < 0.4:
+            operations.append(("complete", None, None, None))
+    return operations
+
+
+def test_memory_engine_matches_python_engine(monkeypatch):
+    operations = random_workload(7, 300)
+
+    python_run = run_workload(monkeypatch, "python", operations)
+    memory_run = run_workload(monkeypatch, "memory", operations)
+
+    assert memory_run == python_run
+
+
+def test_memory_engine_recovers_from_journal(monkeypatch, mock_redis_client):
+    monkeypatch.setattr(scheduler, "SCHEDULER_ENGINE", "memory")
+    monkeypatch.setattr(memory_scheduler, "_clusters", {})
+    cluster = make_cluster(1, cpu=16, ram=16, gpu=16)
+    for deployment_id, priority, size in [(1, 5, 6), (2, 3, 6), (3, 8, 8), (4, 1, 2), (5, 9, 12), (6, 2, 4)]:
+        scheduler.new_deploy(make_deployment(deployment_id, 1, priority, cpu=size, ram=size, gpu=size), cluster)
+    memory_scheduler.flush_journal()
+
+    def state(queues):
+        deployments = {deployment_id: (deployment.cpu_required, deployment.ram_required, deployment.gpu_required,
+                                       deployment.priority, deployment.status)
+                       for deployment_id, deployment in queues.deployments.items()}
+        return list(queues.running), list(queues.pending), [list(demands) for demands in queues.pending_demands], \
+            deployments
+
+    before = state(memory_scheduler._clusters[1])
+    memory_scheduler.drop_cluster_queues()
+    with memory_scheduler._locked_cluster_queues(1) as queues:
+        after = state(queues)
+
+    assert after == before
+    assert [deployment_id for _, deployment_id in after[0]] == [6, 5]
+    assert len(after[1]) == 4
+
+
+def test_memory_engine_schedules_clusters_independently(monkeypatch, mock_redis_client):
+    monkeypatch.setattr(scheduler, "SCHEDULER_ENGINE", "memory")
+    monkeypatch.setattr(memory_scheduler, "_clusters", {})
+    cluster_b = make_cluster(2)
+    deployment = make_deployment(1, 2, priority=1)
+
+    # A decision held on one cluster does not keep another cluster from being scheduled
+    with memory_scheduler._locked_cluster_queues(1):
+        worker = threading.Thread(target=scheduler.new_deploy, args=(deployment, cluster_b))
+        worker.start()
+        worker.join(timeout=5)
+        assert not worker.is_alive()
+    assert deployment.status == "Running"
+    memory_scheduler.flush_journal()
+
+
+def test_lua_engine_matches_python_engine_on_random_workload(monkeypatch):
+    pytest.importorskip("lupa")
+    rng = random.Random(4)
+    priorities = rng.sample(range(1, 10000), 300)
+    operations = []
+    for deployment_id, priority in enumerate(priorities, start=1):
+        operations.append(("new", deployment_id, priority, rng.choice([1, 2, 3, 5, 8, 13])))
+        if rng.random() < 0.4:
+            operations.append(("complete", None, None, None))
+
+    python_run = run_workload(monkeypatch, "python", operations)
+    lua_run = run_workload(monkeypatch, "lua", operations)
+
+    assert lua_run == python_run
+    assert any(status_change for status_change, *_ in python_run[0])
+
+
+def test_backfill_jumps_to_fitting_bucket(monkeypatch):
+    fake_redis = CountingRedis()
+    monkeypatch.setattr(redis, "StrictRedis", lambda *args, **kwargs: fake_redis)
+    cluster = make_cluster(1, cpu=16, ram=16, gpu=16)
+    running = make_deployment(1, 1, priority=10000, cpu=4, ram=4, gpu=4)
+    scheduler.new_deploy(make_deployment(2, 1, priority=10001, cpu=12, ram=12, gpu=12), cluster)
+    scheduler.new_deploy(running, cluster)
+    pipe = fake_redis.pipeline(transaction=False)
+    queue_pending(pipe, make_deployment(3, 1, priority=9999, cpu=16, ram=16, gpu=16))
+    for index in range(1000):
+        queue_pending(pipe, make_deployment(index + 4, 1, priority=index + 1, cpu=5, ram=5, gpu=5))
+    queue_pending(pipe, make_deployment(2000, 1, priority=5000, cpu=2, ram=3, gpu=2))
+    pipe.execute()
+
+    fake_redis.reset_counters()
+    status_change = scheduler.complete_deploy(running, cluster)
+
+    assert status_change == {2000: ("Pending", "Running")}
+    assert fake_redis.round_trips < 10
+
+
+@pytest.mark.parametrize("backlog_size", [10, 500])
+def test_backfill_cost_independent_of_backlog_when_nothing_fits(monkeypatch, backlog_size):
+    fake_redis = CountingRedis()
+    monkeypatch.setattr(redis, "StrictRedis", lambda *args, **kwargs: fake_redis)
+    cluster = make_cluster(1, cpu=16, ram=16, gpu=16)
+    small = make_deployment(1, 1, priority=backlog_size + 2, cpu=4, ram=4, gpu=4)
+    scheduler.new_deploy(make_deployment(2, 1, priority=backlog_size + 1, cpu=12, ram=12, gpu=12), cluster)
+    scheduler.new_deploy(small, cluster)
+    pipe = fake_redis.pipeline(transaction=False)
+    for index in range(backlog_size):
+        queue_pending(pipe, make_deployment(index + 3, 1, priority=index + 1, cpu=8, ram=8, gpu=8))
+    pipe.execute()
+
+    fake_redis.reset_counters()
+    assert scheduler.complete_deploy(small, cluster) == {}
+
+    # WATCH, the early stop check and the MULTI/EXEC block
+    assert fake_redis.round_trips == 3
+    assert fake_redis.zcard("PENDING_QUEUE:{1}") == backlog_size
+
+
+def test_preemption_round_trips_independent_of_victims(monkeypatch):
+    fake_redis = CountingRedis()
+    monkeypatch.setattr(redis, "StrictRedis", lambda *args, **kwargs: fake_redis)
+    round_trips = []
+    for victims in (2, 8):
+        fake_redis.flushall()
+        cluster = make_cluster(victims, cpu=victims, ram=victims, gpu=victims)
+        for index in range(victims):
+            scheduler.new_deploy(make_deployment(index + 1, victims, priority=index + 1, cpu=1, ram=1, gpu=1), cluster)
+
+        fake_redis.reset_counters()
+        big = make_deployment(100, victims, priority=100, cpu=victims, ram=victims, gpu=victims)
+        status_change = scheduler.new_deploy(big, cluster)
+
+        assert big.status == "Running"
+        assert len(status_change) == victims
+        round_trips.append(fake_redis.round_trips)
+
+    assert round_trips[0] == round_trips[1]
+
+
+def test_pass_retried_when_queues_change(monkeypatch, mock_redis_client):
+    cluster = make_cluster(1, cpu=4, ram=4, gpu=4)
+    scheduler.new_deploy(make_deployment(1, 1, priority=1, cpu=4, ram=4, gpu=4), cluster)
+    concurrent = make_deployment(2, 1, priority=2, cpu=4, ram=4, gpu=4)
+    find_best_fit_pending = scheduler._find_best_fit_pending
+    calls = []
+
+    def queue_concurrently(*args):
+        # Another worker queues a deployment while the first pass is being planned
+        if not calls:
+            pipe = mock_redis_client.pipeline(transaction=True)
+            queue_pending(pipe, concurrent)
+            pipe.execute()
+        calls.append(args)
+        return find_best_fit_pending(*args)
+
+    monkeypatch.setattr(scheduler, "_find_best_fit_pending", queue_concurrently)
+    new_deployment = make_deployment(3, 1, priority=3, cpu=4, ram=4, gpu=4)
+    status_change = scheduler.new_deploy(new_deployment, cluster)
+
+    assert status_change == {1: ("Running", "Pending")}
+    assert new_deployment.status == "Running"
+    assert (cluster.available_cpu, cluster.available_ram, cluster.available_gpu) == (0, 0, 0)
+    assert len(calls) > 1
+    assert mock_redis_client.zrange("RUNNING_QUEUE:{1}", 0, -1) == [b"3"]
+    assert mock_redis_client.zrange("PENDING_QUEUE:{1}", 0, -1) == [b"1", b"2"]
+
+
+def test_pass_gives_up_when_queues_keep_changing(monkeypatch, mock_redis_client):
+    cluster = make_cluster(1, cpu=4, ram=4, gpu=4)
+    running = make_deployment(1, 1, priority=1, cpu=4, ram=4, gpu=4)
+    scheduler.new_deploy(running, cluster)
+    find_best_fit_pending = scheduler._find_best_fit_pending
+
+    def always_queue_concurrently(*args):
+        mock_redis_client.zincrby("PENDING_QUEUE:{1}", 1, "999")
+        return find_best_fit_pending(*args)
+
+    monkeypatch.setattr(scheduler, "_find_best_fit_pending", always_queue_concurrently)
+    with pytest.raises(HTTPException) as error:
+        scheduler.complete_deploy(running, cluster)
+
+    assert error.value.status_code == 409
+    assert running.status == "Running"
+    assert (cluster.available_cpu, cluster.available_ram, cluster.available_gpu) == (0, 0, 0)
+    assert mock_redis_client.zrange("RUNNING_QUEUE:{1}", 0, -1) == [b"1"]
+
+
+@pytest.mark.parametrize("engine", ["python", "memory", "lua"])
+def test_batch_placed_in_priority_order(monkeypatch, mock_redis_client, engine):
+    if engine == "lua":
+        pytest.importorskip("lupa")
+    monkeypatch.setattr(scheduler, "SCHEDULER_ENGINE", engine)
+    monkeypatch.setattr(memory_scheduler, "_clusters", {})
+    cluster = make_cluster(1, cpu=16, ram=16, gpu=16)
+    scheduler.new_deploy(make_deployment(1, 1, priority=5, cpu=8, ram=8, gpu=8), cluster)
+    scheduler.new_deploy(make_deployment(2, 1, priority=50, cpu=8, ram=8, gpu=8), cluster)
+    batch = [make_deployment(3, 1, priority=10, cpu=4, ram=4, gpu=4),
+             make_deployment(4, 1, priority=60, cpu=8, ram=8, gpu=8),
+             make_deployment(5, 1, priority=40, cpu=8, ram=8, gpu=8)]
+
+    status_change = scheduler.new_deploy_batch(batch, cluster)
+    memory_scheduler.flush_journal()
+
+    assert status_change == {1: ("Running", "Pending")}
+    assert [deployment.status for deployment in batch] == ["Pending", "Running", "Pending"]
+    assert mock_redis_client.zrange("RUNNING_QUEUE:{1}", 0, -1) == [b"2", b"4"]
+    assert mock_redis_client.zrange("PENDING_QUEUE:{1}", 0, -1) == [b"1", b"3", b"5"]
+
+
+def test_choose_victims_prefers_one_large_victim():
+    small = [make_deployment(index, 1, priority=index, cpu=2, ram=2, gpu=2) for index in range(1, 5)]
+    large = make_deployment(5, 1, priority=5, cpu=8, ram=8, gpu=8)
+
+    assert preemption.choose_victims(small + [large], (8, 8, 8)) == [large]
+    assert preemption.choose_victims(small + [large], (20, 8, 8)) is None
+    # Among sets of the same size, the lowest priorities are preempted
+    assert preemption.choose_victims(small, (4, 4, 4)) == small[:2]
+
+
+def test_min_cost_preemption_evicts_fewer_deployments(monkeypatch, mock_redis_client):
+    monkeypatch.setattr(preemption, "PREEMPTION_POLICY", "min_cost")
+    cluster = make_cluster(1, cpu=16, ram=16, gpu=16)
+    for deployment_id in range(1, 5):
+        scheduler.new_deploy(make_deployment(deployment_id, 1, priority=deployment_id, cpu=2, ram=2, gpu=2), cluster)
+    scheduler.new_deploy(make_deployment(5, 1, priority=5, cpu=8, ram=8, gpu=8), cluster)
+
+    status_change = scheduler.new_deploy(make_deployment(6, 1, priority=6, cpu=8, ram=8, gpu=8), cluster)
+
+    assert status_change == {5: ("Running", "Pending")}
+    assert cluster.available_cpu == 0
+
+
+@pytest.mark.parametrize("engine", ["python", "memory", "lua"])
+def test_preemptions_counted_by_every_engine(monkeypatch, mock_redis_client, engine):
+    if engine == "lua":
+        pytest.importorskip("lupa")
+    mock_redis_client.flushall()
+    monkeypatch.setattr(scheduler, "SCHEDULER_ENGINE", engine)
+    monkeypatch.setattr(memory_scheduler, "_clusters", {})
+    cluster = make_cluster(1, cpu=4, ram=4, gpu=4)
+    for deployment_id in range(1, 3):
+        scheduler.new_deploy(make_deployment(deployment_id, 1, priority=deployment_id, cpu=2, ram=2, gpu=2), cluster)
+    before = preemption.preemption_metrics()
+
+    high = make_deployment(3, 1, priority=3, cpu=4, ram=4, gpu=4)
+    scheduler.new_deploy(high, cluster)
+    assert scheduler.complete_deploy(high, cluster) == {1: ("Pending", "Running"), 2: ("Pending", "Running")}
+    memory_scheduler.flush_journal()
+
+    after = preemption.preemption_metrics()
+    # The backfill after the completion moves pending deployments to running, it preempts nothing
+    assert (after["preempting_decisions"] - before["preempting_decisions"],
+            after["preemptions"] - before["preemptions"]) == (1, 2)
+
+
+@pytest.mark.parametrize("policy", ["greedy", "min_cost"])
+def test_preemptions_counted_once_when_pass_is_retried(monkeypatch, mock_redis_client, policy):
+    monkeypatch.setattr(preemption, "PREEMPTION_POLICY", policy)
+    cluster = make_cluster(1, cpu=4, ram=4, gpu=4)
+    for deployment_id in range(1, 3):
+        scheduler.new_deploy(make_deployment(deployment_id, 1, priority=deployment_id, cpu=2, ram=2, gpu=2), cluster)
+    write_moves, retries = scheduler._write_moves, []
+
+    def write_moves_once_discarded(pipe, cluster_id, moved):
+        if not retries:
+            # Another worker touches the watched running queue before EXEC, the plan is discarded and made again
+            retries.append(cluster_id)
+            mock_redis_client.zadd("RUNNING_QUEUE:{1}", {"other": 0})
+            mock_redis_client.zrem("RUNNING_QUEUE:{1}", "other")
+        write_moves(pipe, cluster_id, moved)
+
+    monkeypatch.setattr(scheduler, "_write_moves", write_moves_once_discarded)
+    before = preemption.preemption_metrics()
+
+    status_change = scheduler.new_deploy(make_deployment(3, 1, priority=3, cpu=4, ram=4, gpu=4), cluster)
+
+    after = preemption.preemption_metrics()
+    assert retries == [1]
+    assert status_change == {1: ("Running", "Pending"), 2: ("Running", "Pending")}
+    assert (after["preempting_decisions"] - before["preempting_decisions"],
+            after["preemptions"] - before["preemptions"]) == (1, 2)
+
+
+@pytest.mark.parametrize("policy", ["greedy", "min_cost"])
+def test_memory_engine_matches_python_engine_with_preemption_policy(monkeypatch, policy):
+    monkeypatch.setattr(preemption, "PREEMPTION_POLICY", policy)
+    operations = random_workload(11, 300)
+
+    python_run = run_workload(monkeypatch, "python", operations)
+    memory_run = run_workload(monkeypatch, "memory", operations)
+
+    assert memory_run == python_run
+
+
+def test_fitting_keeps_candidates_that_fit_in_order():
+    candidates = [make_deployment(1, 1, 1, cpu=4, ram=4, gpu=0), make_deployment(2, 1, 2, cpu=2, ram=8, gpu=0),
+                  make_deployment(3, 1, 3, cpu=1, ram=1, gpu=1), make_deployment(4, 1, 4, cpu=4, ram=2, gpu=0)]
+
+    assert resource_management.fitting(candidates, (4, 4, 0)) == [candidates[0], candidates[3]]
+    assert resource_management.fitting(candidates, (0, 0, 0)) == []
+    assert resource_management.fitting([], (4, 4, 4)) == []
+
+
+def test_resource_changes_logged_with_deployment_and_cluster(caplog, mock_redis_client):
+    cluster = make_cluster(1, cpu=4, ram=4, gpu=4)
+    deployment = make_deployment(1, 1, 1, cpu=1, ram=1, gpu=1)
+
+    with caplog.at_level("DEBUG", logger=resource_management.__name__):
+        resource_management.allocate_resources(cluster, deployment)
+        resource_management.free_resources(cluster, deployment)
+
+    assert [(record.getMessage(), record.deployment_id, record.cluster_id) for record in caplog.records] == [
+        ("Resources allocated for deployment 1 on cluster 1", 1, 1),
+        ("Resources freed by deployment 1 on cluster 1", 1, 1)]
+    assert resource_management.available_of(cluster) == (4, 4, 4)
+
+
+def test_group_costs_one_deployment_of_summed_size(monkeypatch):
+    client = CountingRedis()
+    monkeypatch.setattr(redis, "StrictRedis", lambda *args, **kwargs: client)
+    members = [make_deployment(index, 1, priority=index, cpu=1, ram=2, gpu=0) for index in range(1, 65)]
+    group = groups.queued_group(members)
+    assert (group.id, group.priority, group.cpu_required, group.ram_required, group.gpu_required) == (64, 64, 64, 128, 0)
+
+    client.reset_counters()
+    scheduler.new_deploy(group, make_cluster(1, cpu=64, ram=128, gpu=0))
+    group_cost = (client.round_trips, client.commands)
+    client.reset_counters()
+    scheduler.new_deploy(make_deployment(100, 2, priority=100, cpu=64, ram=128, gpu=0),
+                         make_cluster(2, cpu=64, ram=128, gpu=0))
+
+    assert group_cost == (client.round_trips, client.commands)
+    assert group.status == "Running"
+
+
+@pytest.mark.parametrize("engine", ["python", "memory", "lua"])
+def test_complete_pending_deployment_leaves_pending_queues(monkeypatch, mock_redis_client, engine):
+    if engine == "lua":
+        pytest.importorskip("lupa")
+    monkeypatch.setattr(scheduler, "SCHEDULER_ENGINE", engine)
+    monkeypatch.setattr(memory_scheduler, "_clusters", {})
+    mock_redis_client.flushall()
+    cluster = make_cluster(1, cpu=16, ram=16, gpu=16)
+    scheduler.new_deploy(make_deployment(1, 1, priority=50, cpu=12, ram=12, gpu=12), cluster)
+    pending = make_deployment(2, 1, priority=5, cpu=8, ram=8, gpu=8)
+    scheduler.new_deploy(pending, cluster)
+    assert pending.status == "Pending"
+
+    assert scheduler.complete_deploy(pending, cluster) == {}
+    memory_scheduler.flush_journal()
+
+    # Nothing freed, and no entry of the completed deployment is left without its record
+    assert (cluster.available_cpu, cluster.available_ram, cluster.available_gpu) == (4, 4, 4)
+    assert mock_redis_client.zrange("PENDING_QUEUE:{1}", 0, -1) == []
+    assert mock_redis_client.zrange("PENDING_BUCKET_4.4.4:{1}", 0, -1) == []
+    assert all(mock_redis_client.zrange(f"{queue}:{{1}}", 0, -1) == [] for queue in scheduler.PENDING_DEMAND_QUEUES)
+    later = make_deployment(3, 1, priority=6, cpu=8, ram=8, gpu=8)
+    scheduler.new_deploy(later, cluster)
+    memory_scheduler.flush_journal()
+    assert later.status == "Pending"
@@ -1,8 +1,12 @@
+import asyncio
+import threading
+import httpx
 import pytest
 from fastapi.testclient import TestClient
 from app.main import app
 from app.db.base import Base, engine, SessionLocal
 from app.db import db_schema
+from app.services import auth
 
 
 @pytest.fixture(scope="function")
@@ -66,3 +70,38 @@ def test_user_register_existing_username(client, db):
 
     assert response.status_code == 409
     assert response.json() == {"detail": "Username already exists"}
+
+
+def test_login_storm_does_not_starve_other_routes(client, db, monkeypatch):
+    monkeypatch.setattr(auth, "BCRYPT_ROUNDS", 4)
+    user_data = {"username": "stormUser", "password": "testpassword"}
+    client.post("/users/register/", json=user_data)
+    token = client.post("/users/login/", json=user_data).json()["access_token"]
+    deployment = db_schema.Deployment(name="stormDeployment", image_path="test_path/test", cpu_required=1,
+                                      ram_required=1, gpu_required=1, priority=424242, cluster_id=1, status="Running")
+    db.add(deployment)
+    db.commit()
+
+    # Every password check hangs until released, like bcrypt under a storm of logins far larger than the pool
+    release = threading.Event()
+    verify_password = auth.verify_password
+    monkeypatch.setattr(auth, "verify_password", lambda *args: release.wait(10) and verify_password(*args))
+
+    async def storm():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as async_client:
+            logins = [asyncio.create_task(async_client.post("/users/login/", json=user_data)) for _ in range(60)]
+            await asyncio.sleep(0.5)
+            try:
+                response = await asyncio.wait_for(async_client.get(
+                    "/deployments/get_deployment/", headers={"Authorization": f"Bearer {token}"},
+                    params={"id": deployment.id}), timeout=5)
+            finally:
+                release.set()
+            return response, await asyncio.gather(*logins)
+
+    response, logins = asyncio.run(storm())
+
+    assert response.status_code == 200
+    assert response.json()["name"] == "stormDeployment"
+    assert all(login.status_code == 200 for login in logins)